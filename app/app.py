@@ -342,6 +342,90 @@ def get_stats(user):
         'redrat_devices': redrat_devices_count
     })
 
+@app.route('/api/queue/stats')
+@login_required()
+def get_queue_stats(user):
+    """
+    Get Command Queue Statistics
+    ---
+    tags:
+      - Dashboard
+    summary: Get command queue depth and scheduling metrics
+    description: Retrieve queue depth, dispatch counters, queue and port cooldown wait times, and the IR ports currently cooling down, overall and per device lane
+    security:
+      - SessionAuth: []
+    responses:
+      200:
+        description: Command queue statistics
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+              example: true
+            stats:
+              type: object
+              properties:
+                queued:
+                  type: integer
+                  description: Commands not yet admitted by the worker
+                  example: 0
+                pending:
+                  type: integer
+                  description: Commands waiting for their IR ports
+                  example: 2
+                waiting_for_cooldown:
+                  type: integer
+                  description: Pending commands whose ports are cooling down
+                  example: 1
+                dispatched:
+                  type: integer
+                  example: 120
+                succeeded:
+                  type: integer
+                  example: 118
+                failed:
+                  type: integer
+                  example: 2
+                deferred:
+                  type: integer
+                  description: Commands that had to wait for a port cooldown
+                  example: 7
+                cooldown_wait_total:
+                  type: number
+                  description: Seconds spent waiting for port cooldowns
+                  example: 31.5
+                cooldown_wait_max:
+                  type: number
+                  example: 9.8
+                queue_wait_avg:
+                  type: number
+                  description: Average seconds from queueing to dispatch
+                  example: 0.4
+                queue_wait_max:
+                  type: number
+                  example: 9.9
+                cooling_ports:
+                  type: object
+                  description: Remaining cooldown seconds per device and IR port
+                  example: {"192.168.1.100:10001": {"1": 4.2}}
+                lanes:
+                  type: object
+                  description: Per-device lane counters keyed by RedRat device ID
+      401:
+        description: Unauthorized - Login required
+    """
+    try:
+        from app.services.command_queue import command_queue_instance
+
+        return jsonify({
+            'success': True,
+            'stats': command_queue_instance.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"Error getting command queue stats: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/remotes')
 @login_required()
 def get_remotes(user):
@@ -622,6 +706,11 @@ def remote_detail(user, remote_id):
                 return jsonify({"error": "Remote not found"}), 404
             
             # Delete related command templates first (they reference remote_id in JSON)
+            cursor.execute(
+                "SELECT id FROM command_templates WHERE JSON_EXTRACT(template_data, '$.remote_id') = %s",
+                (remote_id,)
+            )
+            deleted_template_ids = [row['id'] for row in cursor.fetchall()]
             cursor.execute(
                 "DELETE FROM command_templates WHERE JSON_EXTRACT(template_data, '$.remote_id') = %s", 
                 (remote_id,)
@@ -634,6 +723,12 @@ def remote_detail(user, remote_id):
             cursor.execute("DELETE FROM remotes WHERE id = %s", (remote_id,))
             conn.commit()
             
+            from app.services.signal_cache import compiled_signal_cache
+            from app.services.template_index import template_index
+            for template_id in deleted_template_ids:
+                compiled_signal_cache.invalidate(template_id)
+                template_index.remove_template(template_id)
+            
             return jsonify({"message": f"Remote {remote_id} deleted successfully"})
 
 @app.route('/api/remotes/<int:remote_id>/commands', methods=['GET'])
@@ -689,6 +784,166 @@ def get_remote_commands(user, remote_id):
         print(f"Error fetching commands for remote {remote_id}: {e}")
         return jsonify({'error': 'Failed to fetch commands'}), 500
 
+def parse_ir_ports(data):
+    """Parse the optional multi-port target of a command request.
+    
+    Accepts 'ir_ports' as a list of port numbers or of {"port": n, "power": p}
+    objects, and an optional 'port_power' object mapping port to power.
+    
+    Returns:
+        Tuple of (ports list or None, port_power dict or None)
+        
+    Raises:
+        ValueError: If a port or power value is invalid
+    """
+    ir_ports = data.get('ir_ports')
+    if not ir_ports:
+        return None, None
+    if not isinstance(ir_ports, list):
+        raise ValueError('ir_ports must be a list')
+    
+    ports = []
+    port_power = {}
+    for entry in ir_ports:
+        if isinstance(entry, dict):
+            port = int(entry.get('port', 0))
+            if entry.get('power') is not None:
+                port_power[port] = int(entry['power'])
+        else:
+            port = int(entry)
+        if not 1 <= port <= 16:
+            raise ValueError(f'Invalid IR port {port}. Must be between 1 and 16')
+        if port not in ports:
+            ports.append(port)
+    
+    for port, power in (data.get('port_power') or {}).items():
+        port_power[int(port)] = int(power)
+    for port, power in port_power.items():
+        if port not in ports:
+            raise ValueError(f'port_power given for port {port} which is not in ir_ports')
+        if not 0 <= power <= 100:
+            raise ValueError(f'Invalid power {power} for port {port}. Must be between 0 and 100')
+    
+    return ports, port_power or None
+
+def parse_queue_options(data, default_priority='interactive', user=None):
+    """Parse the optional queue priority class and deadline of a request.
+    
+    Accepts 'priority' (interactive, scheduled or bulk) and 'deadline_ms',
+    the number of milliseconds from now after which the item is expired
+    instead of sent. The requesting user or API key becomes the item's
+    tenant, so one client's backlog cannot starve the others.
+    
+    Returns:
+        Dict with 'priority', 'deadline' (epoch seconds or None) and 'tenant'
+        
+    Raises:
+        ValueError: If the priority or deadline is invalid
+    """
+    from app.services.command_queue import PRIORITY_CLASSES, tenant_for_user
+    
+    priority = data.get('priority') or default_priority
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Invalid priority '{priority}'. Must be one of: {', '.join(PRIORITY_CLASSES)}")
+    
+    deadline = None
+    if data.get('deadline_ms') is not None:
+        deadline_ms = int(data['deadline_ms'])
+        if deadline_ms <= 0:
+            raise ValueError('deadline_ms must be a positive number of milliseconds')
+        deadline = time.time() + deadline_ms / 1000.0
+    
+    return {'priority': priority, 'deadline': deadline, 'tenant': tenant_for_user(user)}
+
+def load_sequence_for_execution(user, sequence_id):
+    """Get a sequence of the user with the commands to execute.
+    
+    Returns:
+        Tuple of (sequence row (id, name, description) or None if the user
+        has no such sequence, list of command dicts in order)
+    """
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT s.id, s.name, s.description
+            FROM sequences s
+            WHERE s.id = %s AND s.created_by = %s
+        """, (sequence_id, user['id']))
+        
+        sequence = cursor.fetchone()
+        if not sequence:
+            return None, []
+        
+        # Get commands for this sequence
+        cursor.execute("""
+            SELECT sc.id, sc.command, sc.device, sc.remote_id, sc.position, sc.delay_ms,
+                   r.name as remote_name, sc.ir_port, sc.power, sc.parallel_group, sc.redrat_device_id
+            FROM sequence_commands sc
+            JOIN remotes r ON sc.remote_id = r.id
+            WHERE sc.sequence_id = %s
+            ORDER BY sc.position
+        """, (sequence_id,))
+        
+        commands = []
+        for row in cursor.fetchall():
+            commands.append({
+                'id': row[0],
+                'command': row[1],
+                'device': row[2],
+                'remote_id': row[3],
+                'position': row[4],
+                'delay_ms': row[5],
+                'remote_name': row[6],
+                'ir_port': row[7] if row[7] is not None else 1,
+                'power': row[8] if row[8] is not None else 50,
+                'parallel_group': row[9],
+                'redrat_device_id': row[10]
+            })
+    return sequence, commands
+
+def queue_saturated_response(error):
+    """Build a 429 response telling the client when to retry a refused request."""
+    response = jsonify({
+        'success': False,
+        'error': str(error),
+        'retry_after': error.retry_after,
+        'redrat_device_id': error.device_id
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+def parse_wait_option(data):
+    """Get how long an execute request should block for its result.
+    
+    Accepts 'wait' (true to wait) and 'timeout' (seconds, default 30, at
+    most 60) in the JSON body or the query string.
+    
+    Returns:
+        Seconds to wait, or None to return as soon as the item is queued
+        
+    Raises:
+        ValueError: If the timeout is invalid
+    """
+    wait = data.get('wait', request.args.get('wait'))
+    if str(wait).lower() not in ('1', 'true', 'yes'):
+        return None
+    timeout = float(data.get('timeout', request.args.get('timeout', 30)))
+    return min(max(timeout, 0.0), 60.0)
+
+def wait_for_outcome(handle, timeout):
+    """Block until a queued command or sequence finished, at most timeout seconds.
+    
+    Returns:
+        Outcome dict with 'done', 'status', 'success', 'message' and 'result'
+    """
+    from app.services.command_queue import command_queue_instance
+    
+    if handle.kind == 'command':
+        return command_queue_instance.wait_for_command(handle.item_id, timeout)
+    handle.wait(timeout)
+    return handle.to_dict()
+
 @app.route('/api/commands', methods=['GET', 'POST'])
 @login_required()
 def handle_commands(user):
@@ -728,11 +983,40 @@ def handle_commands(user):
               description: RedRat IR output port (1-16)
               example: 1
               default: 1
+            ir_ports:
+              type: array
+              description: |
+                Send to several ports in one transmission (overrides ir_port).
+                Items are port numbers or {"port": n, "power": p} objects.
+              items:
+                type: integer
+              example: [1, 2, 3, 4]
+            port_power:
+              type: object
+              description: Power (0-100) per port in ir_ports; other ports use power
+              example: {"3": 25}
             power:
               type: integer
               description: IR signal power (1-100)
               example: 100
               default: 100
+            priority:
+              type: string
+              enum: [interactive, scheduled, bulk]
+              description: Queue priority class; interactive work is served first
+              default: interactive
+            deadline_ms:
+              type: integer
+              description: Expire the command instead of sending it if it has not started within this many milliseconds
+              example: 5000
+            wait:
+              type: boolean
+              description: Block until the command was sent and return its result in outcome
+              default: false
+            timeout:
+              type: number
+              description: Seconds to wait when wait is true (at most 60)
+              default: 30
     responses:
       200:
         description: |
@@ -775,6 +1059,10 @@ def handle_commands(user):
         description: Bad request - Missing required parameters for POST
       401:
         description: Unauthorized - Login required
+      429:
+        description: |
+          The RedRat device's queue is saturated or cannot meet deadline_ms;
+          the Retry-After header gives the seconds to wait before retrying
     """
     if request.method == 'GET':
         with db.get_connection() as conn:
@@ -801,6 +1089,21 @@ def handle_commands(user):
         required_fields = ['remote_id', 'command', 'redrat_device_id']
         if not all(field in data for field in required_fields):
             return jsonify({'error': 'Missing required fields'}), 400
+        
+        try:
+            ir_ports, port_power = parse_ir_ports(data)
+            queue_options = parse_queue_options(data, user=user)
+            wait_timeout = parse_wait_option(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        ir_port = ir_ports[0] if ir_ports else data.get('ir_port', 1)
+        
+        # Refuse before storing the command if its device is saturated
+        from app.services.command_queue import command_queue_instance, QueueSaturatedError
+        try:
+            command_queue_instance.check_admission(data['redrat_device_id'], queue_options['deadline'])
+        except QueueSaturatedError as e:
+            return queue_saturated_response(e)
             
         with db.get_connection() as conn:
             cursor = conn.cursor()
@@ -815,16 +1118,23 @@ def handle_commands(user):
             if not cursor.fetchone():
                 return jsonify({'error': f'RedRat Device ID {data["redrat_device_id"]} does not exist'}), 400
             
+            # Multi-port commands store every target port with its power
+            stored_port_power = None
+            if ir_ports:
+                stored_port_power = json.dumps({str(p): (port_power or {}).get(p, data.get('power', 50))
+                                                for p in ir_ports})
+            
             cursor.execute("""
-                INSERT INTO commands (remote_id, command, device, status, created_by, ir_port, power)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                INSERT INTO commands (remote_id, command, device, status, created_by, ir_port, power, port_power)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
             """, (data['remote_id'], data['command'], f"RedRat Device {data['redrat_device_id']}", 'pending', user['id'], 
-                  data.get('ir_port', 1), data.get('power', 50)))
+                  ir_port, data.get('power', 50), stored_port_power))
             conn.commit()
             
             command_id = cursor.lastrowid
             
             # Add command to execution queue
+            handle = None
             try:
                 from app.services.command_queue import add_command
                 command_data = {
@@ -833,15 +1143,24 @@ def handle_commands(user):
                     'command': data['command'],
                     'device': f"RedRat Device {data['redrat_device_id']}",
                     'redrat_device_id': data['redrat_device_id'],
-                    'ir_port': data.get('ir_port', 1),
-                    'power': data.get('power', 50)
+                    'ir_port': ir_port,
+                    'power': data.get('power', 50),
+                    'ir_ports': ir_ports,
+                    'port_power': port_power,
+                    **queue_options
                 }
                 
-                if add_command(command_data):
+                handle = add_command(command_data)
+                if handle:
                     logger.info(f"Command {command_id} queued for execution")
                 else:
                     logger.error(f"Failed to queue command {command_id}")
                     
+            except QueueSaturatedError as e:
+                # The lane filled up since the check above
+                cursor.execute("UPDATE commands SET status = 'failed' WHERE id = %s", (command_id,))
+                conn.commit()
+                return queue_saturated_response(e)
             except Exception as e:
                 logger.error(f"Error queuing command {command_id}: {str(e)}")
             
@@ -853,12 +1172,16 @@ def handle_commands(user):
                 WHERE c.id = %s
             """, (command_id,))
             command = cursor.fetchone()
-            
-        return jsonify({
+        
+        response = {
             'success': True,
             'message': 'Command queued successfully',
             'command': command
-        }), 201
+        }
+        # Optionally block until the press went out (outside the DB connection)
+        if handle and wait_timeout is not None:
+            response['outcome'] = wait_for_outcome(handle, wait_timeout)
+        return jsonify(response), 201
 
 @app.route('/api/activity')
 @login_required()
@@ -1127,6 +1450,9 @@ def create_command_template(user):
                   data.get('template_data', ''), user['id']))
             
             conn.commit()
+            
+            from app.services.template_index import template_index
+            template_index.reload_template(cursor.lastrowid)
             return jsonify({'success': True, 'message': 'Command template created successfully'}), 201
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1189,6 +1515,11 @@ def update_command_template(user, template_id):
                   data.get('template_data', ''), template_id))
             
             conn.commit()
+            
+            from app.services.signal_cache import compiled_signal_cache
+            from app.services.template_index import template_index
+            compiled_signal_cache.invalidate(template_id)
+            template_index.reload_template(template_id)
             return jsonify({'success': True, 'message': 'Command template updated successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1202,6 +1533,11 @@ def delete_command_template(user, template_id):
             cursor = conn.cursor()
             cursor.execute("DELETE FROM command_templates WHERE id = %s", (template_id,))
             conn.commit()
+            
+            from app.services.signal_cache import compiled_signal_cache
+            from app.services.template_index import template_index
+            compiled_signal_cache.invalidate(template_id)
+            template_index.remove_template(template_id)
             return jsonify({'success': True, 'message': 'Command template deleted successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1334,7 +1670,7 @@ def get_sequence(user, sequence_id):
             # Get commands for this sequence
             cursor.execute("""
                 SELECT sc.id, sc.command, sc.device, sc.remote_id, sc.position, sc.delay_ms,
-                       r.name as remote_name, sc.ir_port, sc.power
+                       r.name as remote_name, sc.ir_port, sc.power, sc.parallel_group, sc.redrat_device_id
                 FROM sequence_commands sc
                 JOIN remotes r ON sc.remote_id = r.id
                 WHERE sc.sequence_id = %s
@@ -1352,7 +1688,9 @@ def get_sequence(user, sequence_id):
                     'delay_ms': row[5],
                     'remote_name': row[6],
                     'ir_port': row[7] if row[7] is not None else 1,
-                    'power': row[8] if row[8] is not None else 50
+                    'power': row[8] if row[8] is not None else 50,
+                    'parallel_group': row[9],
+                    'redrat_device_id': row[10]
                 })
             
             return jsonify({
@@ -1424,6 +1762,9 @@ def delete_sequence(user, sequence_id):
             cursor.execute("DELETE FROM command_sequences WHERE id = %s AND user_id = %s", (sequence_id, user['id']))
             
             conn.commit()
+            
+            from app.services.sequence_plan import sequence_plan_cache
+            sequence_plan_cache.invalidate(sequence_id)
             return jsonify({'success': True, 'message': 'Sequence deleted successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1684,6 +2025,14 @@ def add_command_to_sequence(user, sequence_id):
               type: integer
               description: IR power level (0-100)
               default: 100
+            parallel_group:
+              type: integer
+              description: Run together with the adjacent commands of the same group;
+                commands on different ports or RedRat devices run concurrently and
+                the next command starts when all of them are done
+            redrat_device_id:
+              type: integer
+              description: RedRat device for this command (default the device running the sequence)
     responses:
       201:
         description: Command added to sequence successfully
@@ -1698,6 +2047,13 @@ def add_command_to_sequence(user, sequence_id):
         delay_ms = data.get('delay_ms', 0)
         ir_port = data.get('ir_port', 1)  # Default to port 1
         power = data.get('power', 50)  # Default to half power
+        parallel_group = data.get('parallel_group')
+        redrat_device_id = data.get('redrat_device_id')
+        try:
+            parallel_group = int(parallel_group) if parallel_group is not None else None
+            redrat_device_id = int(redrat_device_id) if redrat_device_id is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'parallel_group and redrat_device_id must be integers'}), 400
         
         # First, get the command template to extract command info
         with db.get_connection() as conn:
@@ -1724,12 +2080,18 @@ def add_command_to_sequence(user, sequence_id):
             
             # Insert the command into the sequence
             cursor.execute("""
-                INSERT INTO sequence_commands (sequence_id, command, device, remote_id, position, delay_ms, ir_port, power)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ON DUPLICATE KEY UPDATE delay_ms = VALUES(delay_ms), ir_port = VALUES(ir_port), power = VALUES(power)
-            """, (sequence_id, template[0], '', template[1], next_position, delay_ms, ir_port, power))
+                INSERT INTO sequence_commands (sequence_id, command, device, remote_id, position, delay_ms, ir_port, power,
+                                               parallel_group, redrat_device_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE delay_ms = VALUES(delay_ms), ir_port = VALUES(ir_port), power = VALUES(power),
+                                        parallel_group = VALUES(parallel_group), redrat_device_id = VALUES(redrat_device_id)
+            """, (sequence_id, template[0], '', template[1], next_position, delay_ms, ir_port, power,
+                  parallel_group, redrat_device_id))
             
             conn.commit()
+            
+            from app.services.sequence_plan import sequence_plan_cache
+            sequence_plan_cache.invalidate(sequence_id)
             return jsonify({'success': True, 'message': 'Command added to sequence'}), 201
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1750,6 +2112,9 @@ def remove_command_from_sequence(user, sequence_id, command_id):
                 return jsonify({'success': False, 'error': 'Command not found in sequence'}), 404
             
             conn.commit()
+            
+            from app.services.sequence_plan import sequence_plan_cache
+            sequence_plan_cache.invalidate(sequence_id)
             return jsonify({'success': True, 'message': 'Command removed from sequence'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1799,6 +2164,9 @@ def move_command_up(user, sequence_id, command_id):
             """, (current_position, target_command[0]))
             
             conn.commit()
+            
+            from app.services.sequence_plan import sequence_plan_cache
+            sequence_plan_cache.invalidate(sequence_id)
             return jsonify({'success': True, 'message': 'Command moved up successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1856,6 +2224,9 @@ def move_command_down(user, sequence_id, command_id):
             """, (current_position, target_command[0]))
             
             conn.commit()
+            
+            from app.services.sequence_plan import sequence_plan_cache
+            sequence_plan_cache.invalidate(sequence_id)
             return jsonify({'success': True, 'message': 'Command moved down successfully'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1865,62 +2236,46 @@ def move_command_down(user, sequence_id, command_id):
 def execute_sequence(user, sequence_id):
     """Execute a sequence of commands"""
     try:
-        # Get sequence and its commands
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT s.id, s.name, s.description
-                FROM sequences s
-                WHERE s.id = %s AND s.created_by = %s
-            """, (sequence_id, user['id']))
-            
-            sequence = cursor.fetchone()
-            if not sequence:
-                return jsonify({'success': False, 'error': 'Sequence not found'}), 404
-            
-            # Get commands for this sequence
-            cursor.execute("""
-                SELECT sc.id, sc.command, sc.device, sc.remote_id, sc.position, sc.delay_ms,
-                       r.name as remote_name, sc.ir_port, sc.power
-                FROM sequence_commands sc
-                JOIN remotes r ON sc.remote_id = r.id
-                WHERE sc.sequence_id = %s
-                ORDER BY sc.position
-            """, (sequence_id,))
-            
-            commands = []
-            for row in cursor.fetchall():
-                commands.append({
-                    'id': row[0],
-                    'command': row[1],
-                    'device': row[2],
-                    'remote_id': row[3],
-                    'position': row[4],
-                    'delay_ms': row[5],
-                    'remote_name': row[6],
-                    'ir_port': row[7] if row[7] is not None else 1,
-                    'power': row[8] if row[8] is not None else 50
-                })
+        sequence, commands = load_sequence_for_execution(user, sequence_id)
+        if not sequence:
+            return jsonify({'success': False, 'error': 'Sequence not found'}), 404
         
         if not commands:
             return jsonify({'success': False, 'error': 'No commands found in sequence'}), 400
         
+        # Optional target device (otherwise the queue picks the least-loaded
+        # one), priority class and deadline
+        data = request.get_json(silent=True) or {}
+        try:
+            queue_options = parse_queue_options(data, user=user)
+            wait_timeout = parse_wait_option(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
         # Add sequence to execution queue
+        from app.services.command_queue import add_sequence, QueueSaturatedError
         try:
-            from app.services.command_queue import add_sequence
             sequence_data = {
                 'id': sequence_id,
                 'name': sequence[1],
-                'commands': commands
+                'commands': commands,
+                'redrat_device_id': data.get('redrat_device_id'),
+                **queue_options
             }
             
-            if add_sequence(sequence_data):
+            handle = add_sequence(sequence_data)
+            if handle:
                 logger.info(f"Sequence {sequence_id} queued for execution")
-                return jsonify({'success': True, 'message': 'Sequence execution started'})
+                response = {'success': True, 'message': 'Sequence execution started'}
+                if wait_timeout is not None:
+                    response['outcome'] = wait_for_outcome(handle, wait_timeout)
+                return jsonify(response)
             else:
                 logger.error(f"Failed to queue sequence {sequence_id}")
                 return jsonify({'success': False, 'error': 'Failed to queue sequence'}), 500
                 
+        except QueueSaturatedError as e:
+            return queue_saturated_response(e)
         except Exception as e:
             logger.error(f"Error queuing sequence {sequence_id}: {str(e)}")
             return jsonify({'success': False, 'error': 'Failed to queue sequence'}), 500
@@ -1929,6 +2284,179 @@ def execute_sequence(user, sequence_id):
         logger.error(f"Error executing sequence {sequence_id}: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/sequences/<int:sequence_id>/execute-on-targets', methods=['POST'])
+@login_required()
+def execute_sequence_on_targets(user, sequence_id):
+    """
+    Run a sequence on many RedRat devices and IR ports at once
+    ---
+    tags:
+      - Sequences
+    security:
+      - SessionAuth: []
+    parameters:
+      - name: sequence_id
+        in: path
+        type: integer
+        required: true
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - targets
+          properties:
+            targets:
+              type: array
+              description: |
+                (device, port) pairs, e.g. one set-top box per port. The whole
+                sequence runs on every target; the ports and devices stored on
+                its steps are ignored.
+              items:
+                type: object
+                properties:
+                  redrat_device_id:
+                    type: integer
+                    example: 1
+                  ir_port:
+                    type: integer
+                    example: 3
+                  ir_ports:
+                    type: array
+                    description: Several ports of the device (instead of ir_port)
+                    items:
+                      type: integer
+                    example: [1, 2, 3, 4]
+            priority:
+              type: string
+              enum: ["interactive", "scheduled", "bulk"]
+              default: interactive
+            deadline_ms:
+              type: integer
+              description: Expire targets that have not started within this many milliseconds
+            stream:
+              type: boolean
+              description: Stream progress as server-sent events instead of returning at once
+              default: true
+    responses:
+      200:
+        description: |
+          text/event-stream of fleet_progress events with the aggregated
+          progress (targets and steps done/failed, per-target status) and a
+          final fleet_done event
+      202:
+        description: Fleet run queued (stream false); poll /api/fleet-runs/{run_id}
+      400:
+        description: Invalid targets, unknown device or empty sequence
+      404:
+        description: Sequence not found
+      429:
+        description: A target device's queue is saturated; nothing was queued
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        targets = []
+        for target in data.get('targets') or []:
+            device_id = int(target['redrat_device_id'])
+            ports = target.get('ir_ports') or [target.get('ir_port', 1)]
+            for port in ports:
+                if not 1 <= int(port) <= 16:
+                    raise ValueError(f'Invalid IR port {port}. Must be between 1 and 16')
+                if {'redrat_device_id': device_id, 'ir_port': int(port)} in targets:
+                    raise ValueError(f'Duplicate target: device {device_id} port {port}')
+                targets.append({'redrat_device_id': device_id, 'ir_port': int(port)})
+        if not targets:
+            raise ValueError('targets must list at least one redrat_device_id and ir_port')
+        queue_options = parse_queue_options(data, user=user)
+    except KeyError:
+        return jsonify({'success': False, 'error': 'Every target needs a redrat_device_id'}), 400
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    try:
+        device_ids = sorted({target['redrat_device_id'] for target in targets})
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT id FROM redrat_devices
+                WHERE is_active = TRUE AND id IN ({', '.join(['%s'] * len(device_ids))})
+            """, tuple(device_ids))
+            active = {row[0] for row in cursor.fetchall()}
+        for device_id in device_ids:
+            if device_id not in active:
+                return jsonify({'success': False,
+                                'error': f'RedRat device {device_id} is not active or does not exist'}), 400
+        
+        sequence, commands = load_sequence_for_execution(user, sequence_id)
+        if not sequence:
+            return jsonify({'success': False, 'error': 'Sequence not found'}), 404
+        if not commands:
+            return jsonify({'success': False, 'error': 'No commands found in sequence'}), 400
+        
+        from app.services.command_queue import command_queue_instance, QueueSaturatedError
+        from app.services.fleet_service import fleet_runs
+        try:
+            run = fleet_runs.start(command_queue_instance,
+                                   {'id': sequence_id, 'name': sequence[1], 'commands': commands},
+                                   targets, queue_options, user_id=user['id'])
+        except QueueSaturatedError as e:
+            return queue_saturated_response(e)
+    except Exception as e:
+        logger.error(f"Error starting fleet run of sequence {sequence_id}: {str(e)}")
+        return jsonify({'success': False, 'error': 'Failed to queue sequence'}), 500
+    
+    stream = data.get('stream', request.args.get('stream', 'true'))
+    if str(stream).lower() in ('false', '0', 'no'):
+        return jsonify({'success': True, 'message': 'Fleet run started', **run.snapshot()}), 202
+    
+    def event_stream():
+        # Send progress whenever it changes, with a heartbeat every 15 seconds
+        last, last_sent = None, 0.0
+        while True:
+            snapshot = run.snapshot()
+            progress = (snapshot['steps_sent'], snapshot['steps_failed'], snapshot['targets_done'],
+                        snapshot['targets_failed'])
+            if snapshot['done']:
+                yield f"data: {json.dumps({'type': 'fleet_done', **snapshot})}\n\n"
+                return
+            if progress != last:
+                last, last_sent = progress, time.monotonic()
+                yield f"data: {json.dumps({'type': 'fleet_progress', **snapshot})}\n\n"
+            elif time.monotonic() - last_sent >= 15:
+                last_sent = time.monotonic()
+                yield f"data: {json.dumps({'type': 'heartbeat', 'time': datetime.now().isoformat()})}\n\n"
+            time.sleep(0.25)
+    
+    return Response(event_stream(), mimetype="text/event-stream")
+
+@app.route('/api/fleet-runs/<run_id>', methods=['GET'])
+@login_required()
+def get_fleet_run(user, run_id):
+    """
+    Get the progress of a fleet run
+    ---
+    tags:
+      - Sequences
+    security:
+      - SessionAuth: []
+    parameters:
+      - name: run_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: Aggregated progress with per-target status and results
+      404:
+        description: Unknown or expired run (runs are kept for an hour after they finish)
+    """
+    from app.services.fleet_service import fleet_runs
+    run = fleet_runs.get(run_id)
+    if not run or (run.user_id != user['id'] and not user.get('is_admin')):
+        return jsonify({'success': False, 'error': 'Fleet run not found'}), 404
+    return jsonify({'success': True, **run.snapshot()})
+
 @app.route('/api/schedules', methods=['GET'])
 @login_required()
 def get_schedules(user):
@@ -2358,6 +2886,76 @@ def delete_schedule(user, schedule_id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 # Command execution endpoint
+@app.route('/api/commands/<int:command_id>/wait', methods=['GET'])
+@login_required()
+def wait_for_command(user, command_id):
+    """
+    Wait for a queued command to finish
+    ---
+    tags:
+      - Commands
+    security:
+      - SessionAuth: []
+    description: |
+      Long-polls until the command has been sent (or failed, expired or was
+      dropped), so clients need not poll /api/commands.
+    parameters:
+      - in: path
+        name: command_id
+        type: integer
+        required: true
+        description: ID of the command
+      - in: query
+        name: timeout
+        type: number
+        required: false
+        default: 30
+        description: Seconds to wait (at most 60)
+    responses:
+      200:
+        description: Command finished; outcome holds the device result
+        schema:
+          type: object
+          properties:
+            success:
+              type: boolean
+            command_id:
+              type: integer
+            outcome:
+              type: object
+              properties:
+                done:
+                  type: boolean
+                status:
+                  type: string
+                  enum: [executed, failed, expired]
+                success:
+                  type: boolean
+                message:
+                  type: string
+                result:
+                  type: object
+      202:
+        description: Timeout reached while the command is still queued
+      400:
+        description: Invalid timeout
+      401:
+        description: Authentication required
+      404:
+        description: Command not found
+    """
+    from app.services.command_queue import command_queue_instance
+    
+    try:
+        timeout = min(max(float(request.args.get('timeout', 30)), 0.0), 60.0)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'timeout must be a number of seconds'}), 400
+    
+    outcome = command_queue_instance.wait_for_command(command_id, timeout)
+    if outcome is None:
+        return jsonify({'success': False, 'error': 'Command not found'}), 404
+    return jsonify({'success': True, 'command_id': command_id, 'outcome': outcome}), 200 if outcome['done'] else 202
+
 @app.route('/api/commands/<int:command_id>/execute', methods=['POST'])
 @login_required()
 def execute_command(user, command_id):
@@ -2381,31 +2979,44 @@ def execute_command(user, command_id):
         data = request.get_json() or {}
         ir_port = data.get('ir_port', 1)
         power = data.get('power', 50)
+        try:
+            queue_options = parse_queue_options(data, user=user)
+            wait_timeout = parse_wait_option(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
         # Add command to execution queue
+        from app.services.command_queue import add_command, QueueSaturatedError
         try:
-            from app.services.command_queue import add_command
             command_data = {
                 'id': command_id,
                 'remote_id': command['remote_id'],
                 'command': command['command'],
                 'device': command['device'],
                 'ir_port': ir_port,
-                'power': power
+                'power': power,
+                'redrat_device_id': data.get('redrat_device_id'),
+                **queue_options
             }
             
-            if add_command(command_data):
+            handle = add_command(command_data)
+            if handle:
                 logger.info(f"Command {command_id} queued for immediate execution")
-                return jsonify({
+                response = {
                     'success': True, 
                     'message': f"Command '{command['command']}' sent to {command['remote_name']}",
                     'command': command['command'],
                     'remote': command['remote_name']
-                })
+                }
+                if wait_timeout is not None:
+                    response['outcome'] = wait_for_outcome(handle, wait_timeout)
+                return jsonify(response)
             else:
                 logger.error(f"Failed to queue command {command_id}")
                 return jsonify({'success': False, 'error': 'Failed to queue command'}), 500
                 
+        except QueueSaturatedError as e:
+            return queue_saturated_response(e)
         except Exception as e:
             logger.error(f"Error queuing command {command_id}: {str(e)}")
             return jsonify({'success': False, 'error': 'Failed to queue command'}), 500
@@ -2433,35 +3044,48 @@ def execute_remote_command(user, remote_id, command_name):
         data = request.get_json() or {}
         ir_port = data.get('ir_port', 1)
         power = data.get('power', 50)
+        try:
+            queue_options = parse_queue_options(data, user=user)
+            wait_timeout = parse_wait_option(data)
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         device = data.get('device', remote['name'])
         
         # Create temporary command for execution
         temp_command_id = int(time.time() * 1000000)  # Unique temporary ID
         
         # Add command to execution queue
+        from app.services.command_queue import add_command, QueueSaturatedError
         try:
-            from app.services.command_queue import add_command
             command_data = {
                 'id': temp_command_id,
                 'remote_id': remote_id,
                 'command': command_name,
                 'device': device,
                 'ir_port': ir_port,
-                'power': power
+                'power': power,
+                'redrat_device_id': data.get('redrat_device_id'),
+                **queue_options
             }
             
-            if add_command(command_data):
+            handle = add_command(command_data)
+            if handle:
                 logger.info(f"Direct command '{command_name}' queued for remote {remote['name']}")
-                return jsonify({
+                response = {
                     'success': True, 
                     'message': f"Command '{command_name}' sent to {remote['name']}",
                     'command': command_name,
                     'remote': remote['name']
-                })
+                }
+                if wait_timeout is not None:
+                    response['outcome'] = wait_for_outcome(handle, wait_timeout)
+                return jsonify(response)
             else:
                 logger.error(f"Failed to queue direct command '{command_name}'")
                 return jsonify({'success': False, 'error': 'Failed to queue command'}), 500
                 
+        except QueueSaturatedError as e:
+            return queue_saturated_response(e)
         except Exception as e:
             logger.error(f"Error queuing direct command '{command_name}': {str(e)}")
             return jsonify({'success': False, 'error': 'Failed to queue command'}), 500
@@ -2517,36 +3141,8 @@ def translate_netbox_type(netbox_type_value):
     except Exception:
         return f"IRNetBox (Unknown Type {netbox_type_value})"
 
-def device_model_to_int(device_model_string):
-    """Convert device model string to integer for database storage"""
-    if device_model_string is None:
-        return None
-    
-    # Handle already numeric values
-    if isinstance(device_model_string, int):
-        return device_model_string
-    
-    # Map string device models to integers
-    string_to_int_map = {
-        'MK-I': 1,
-        'MK-II': 2,
-        'MK-III': 3,
-        'MK-IV': 4,
-        'Unknown': 0
-    }
-    
-    # Try exact match first
-    if device_model_string in string_to_int_map:
-        return string_to_int_map[device_model_string]
-    
-    # Try partial matches
-    device_upper = device_model_string.upper()
-    for model_string, model_int in string_to_int_map.items():
-        if model_string.upper() in device_upper:
-            return model_int
-    
-    # Default to 0 (Unknown) if no match found
-    return 0
+# Model string to redrat_devices.device_model mapping, shared with the device service
+from app.models.redrat_device import device_model_to_int  # noqa: E402,F401
 
 # RedRat Devices API Endpoints
 @app.route('/api/redrat/devices', methods=['GET'])
@@ -3205,9 +3801,9 @@ def validate_redrat_device_port(user, device_id):
             
             device_ip, device_port = device
         
-        # Create RedRat service instance and validate port
-        from app.services.redrat_service import RedRatService
-        redrat_service = RedRatService(device_ip, device_port)
+        # Use the device's shared RedRat service and validate port
+        from app.services.redrat_service import create_redrat_service
+        redrat_service = create_redrat_service(device_ip, device_port)
         
         logger.info(f"Validating RedRat device {device_id} ({device_ip}:{device_port}) port {ir_port}")
         validation_result = redrat_service.validate_device_and_port(ir_port)
@@ -46,6 +46,8 @@ def get_current_user():
                     if user:
                         # Update last_used_at timestamp for the API key
                         api_key_obj.update_last_used()
+                        # Identifies the key for fair queueing of its commands
+                        user['api_key_id'] = api_key_obj.id
                         return user
         except Exception:
             pass  # Continue to return None
@@ -104,6 +106,7 @@ def api_key_required(admin_only=False):
                     
                     # Update last_used_at timestamp for the API key
                     api_key_obj.update_last_used()
+                    user['api_key_id'] = api_key_obj.id
                     
                     return f(*args, **kwargs, user=user)
             except Exception as e:
@@ -13,6 +13,38 @@ from app.mysql_db import db
 from app.utils.logger import logger
 
 
+def device_model_to_int(device_model_string):
+    """Convert device model string to integer for database storage"""
+    if device_model_string is None:
+        return None
+    
+    # Handle already numeric values
+    if isinstance(device_model_string, int):
+        return device_model_string
+    
+    # Map string device models to integers
+    string_to_int_map = {
+        'MK-I': 1,
+        'MK-II': 2,
+        'MK-III': 3,
+        'MK-IV': 4,
+        'Unknown': 0
+    }
+    
+    # Try exact match first
+    if device_model_string in string_to_int_map:
+        return string_to_int_map[device_model_string]
+    
+    # Try partial matches
+    device_upper = device_model_string.upper()
+    for model_string, model_int in string_to_int_map.items():
+        if model_string.upper() in device_upper:
+            return model_int
+    
+    # Default to 0 (Unknown) if no match found
+    return 0
+
+
 class RedRatDevice:
     """Model for RedRat devices."""
     
@@ -31,6 +63,8 @@ class RedRatDevice:
         self.last_status = 'offline'
         self.device_model = None
         self.device_ports = None
+        self.firmware_version = None
+        self.serial_number = None
         self.port_descriptions = None  # JSON object mapping port numbers to descriptions
         self.created_at = None
         self.updated_at = None
@@ -45,7 +79,8 @@ class RedRatDevice:
                 cursor.execute("""
                     SELECT id, name, ip_address, port, description, is_active,
                            last_status_check, last_status, device_model, device_ports,
-                           created_by, created_at, updated_at, port_descriptions
+                           created_by, created_at, updated_at, port_descriptions,
+                           firmware_version, serial_number
                     FROM redrat_devices
                     ORDER BY name
                 """)
@@ -67,6 +102,8 @@ class RedRatDevice:
                     device.updated_at = row[12]
                     # Parse port_descriptions JSON
                     device.port_descriptions = json.loads(row[13]) if row[13] else {}
+                    device.firmware_version = row[14]
+                    device.serial_number = row[15]
                     devices.append(device)
                     
         except Exception as e:
@@ -83,7 +120,8 @@ class RedRatDevice:
                 cursor.execute("""
                     SELECT id, name, ip_address, port, description, is_active,
                            last_status_check, last_status, device_model, device_ports,
-                           created_by, created_at, updated_at, port_descriptions
+                           created_by, created_at, updated_at, port_descriptions,
+                           firmware_version, serial_number
                     FROM redrat_devices
                     WHERE id = %s
                 """, (device_id,))
@@ -106,6 +144,8 @@ class RedRatDevice:
                     device.updated_at = row[12]
                     # Parse port_descriptions JSON
                     device.port_descriptions = json.loads(row[13]) if row[13] else {}
+                    device.firmware_version = row[14]
+                    device.serial_number = row[15]
                     return device
                     
         except Exception as e:
@@ -186,6 +226,28 @@ class RedRatDevice:
             logger.error(f"Error updating device status: {str(e)}")
             return False
     
+    @classmethod
+    def update_identity(cls, ip_address: str, device_model: int = None,
+                        firmware_version: str = None, serial_number: str = None) -> bool:
+        """Persist discovered device identity for all devices at an IP address."""
+        try:
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    UPDATE redrat_devices
+                    SET device_model = COALESCE(%s, device_model),
+                        firmware_version = COALESCE(%s, firmware_version),
+                        serial_number = COALESCE(%s, serial_number)
+                    WHERE ip_address = %s
+                """, (device_model, firmware_version, serial_number, ip_address))
+                
+                conn.commit()
+                return True
+                
+        except Exception as e:
+            logger.error(f"Error updating device identity for {ip_address}: {str(e)}")
+            return False
+    
     def to_dict(self) -> Dict[str, Any]:
         """Convert device to dictionary."""
         return {
@@ -199,6 +261,8 @@ class RedRatDevice:
             'last_status': self.last_status,
             'device_model': self.device_model,
             'device_ports': self.device_ports,
+            'firmware_version': self.firmware_version,
+            'serial_number': self.serial_number,
             'port_descriptions': self.port_descriptions,
             'created_by': self.created_by,
             'created_at': self.created_at.isoformat() if self.created_at else None,
@@ -1,8 +1,14 @@
+import bisect
+import itertools
+import math
+import os
 import queue
 import threading
 import logging
 import time
-from typing import Dict, Any, Optional
+import uuid
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
 
 # Set up logger if app.utils.logger is not available
 try:
@@ -17,12 +23,23 @@ except ImportError:
 
 # Import the enhanced RedRat service
 try:
-    from app.services.redrat_service import create_redrat_service
+    from app.services.redrat_service import create_redrat_service, redrat_service_registry
     from app.services.redrat_device_service import RedRatDeviceService
+    from app.services.template_index import template_index
+    from app.services.sequence_plan import sequence_plan_cache
+    from app.services.fleet_service import fleet_runs
 except ImportError:
     logger.warning("RedRat service not available")
     create_redrat_service = lambda host, port: None
+    redrat_service_registry = None
     RedRatDeviceService = None
+    template_index = None
+    sequence_plan_cache = None
+    fleet_runs = None
+
+from app.services.port_scheduler import PortScheduler
+from app.services.device_router import device_router
+from app.services.durable_queue import create_queue_backend
 
 # Use get_db if available, otherwise just pass
 try:
@@ -33,17 +50,570 @@ except ImportError:
             return None
     db = MockDB()
 
+_LANE_STATS = ('dispatched', 'succeeded', 'failed', 'expired', 'deferred', 'coalesced', 'cooldown_wait_total',
+               'cooldown_wait_max', 'queue_wait_total', 'queue_wait_max')
+
+# Priority classes, served in this order
+PRIORITY_CLASSES = {
+    'interactive': 0,  # Key presses from the web UI and API
+    'scheduled': 1,    # Sequences started by SchedulingService
+    'bulk': 2          # Automation and batch jobs
+}
+DEFAULT_PRIORITY = 'interactive'
+
+# Weight of the newest measurement in a lane's service time average
+SERVICE_TIME_ALPHA = 0.2
+
+
+class QueueSaturatedError(Exception):
+    """Raised when a RedRat device's lane is full or cannot meet a deadline.
+    
+    Attributes:
+        retry_after: Whole seconds after which the lane is expected to have room
+        device_id: redrat_devices.id of the saturated lane, if known
+    """
+    
+    def __init__(self, message: str, retry_after: int, device_id: int = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.device_id = device_id
+
+
+class CommandHandle:
+    """Completion future of a queued command or sequence.
+    
+    Returned by add_command/add_sequence; resolved by the dispatcher once the
+    item was executed, failed, expired or dropped.
+    """
+    
+    def __init__(self, kind: str, item_id: Any):
+        self.kind = kind  # 'command' or 'sequence'
+        self.item_id = item_id  # Command ID or sequence run ID
+        self.status = 'queued'
+        self.result = None  # RedRatService send_command/send_sequence result
+        self.error = None
+        self.completed_at = None  # time.monotonic() of resolution
+        self.row_id = None  # command_queue row of an item in a durable backend
+        self._event = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+    
+    def done(self) -> bool:
+        """Whether the item has finished."""
+        return self._event.is_set()
+    
+    def wait(self, timeout: float = None) -> bool:
+        """Block until the item has finished or timeout seconds passed.
+        
+        Returns:
+            True if the item has finished
+        """
+        return self._event.wait(timeout)
+    
+    def add_done_callback(self, callback):
+        """Call callback(handle) once the item has finished (immediately if it has)."""
+        with self._callbacks_lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the outcome in API form."""
+        result = self.result or {}
+        return {
+            'done': self.done(),
+            'status': self.status,
+            'success': self.status == 'executed',
+            'message': result.get('message') or self.error or '',
+            'result': self.result
+        }
+    
+    def _resolve(self, status: str, result: Dict[str, Any] = None, error: str = None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.completed_at = time.monotonic()
+        with self._callbacks_lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Command handle callback failed: {str(e)}")
+
+
+# Tenant of work queued without a user (e.g. internal callers)
+DEFAULT_TENANT = 'system'
+
+
+def tenant_for_user(user: Optional[Dict[str, Any]]) -> str:
+    """Get the fair-queueing tenant of a request: its API key, else its user."""
+    if not user:
+        return DEFAULT_TENANT
+    if user.get('api_key_id'):
+        return f"key:{user['api_key_id']}"
+    return f"user:{user['id']}"
+
+
+def press_key(item: Dict[str, Any]) -> tuple:
+    """Identity of a key press for coalescing: remote, command, ports and power."""
+    ports = tuple(int(p) for p in (item.get('ir_ports') or [item.get('ir_port', 1)]))
+    port_power = tuple(sorted((int(p), v) for p, v in (item.get('port_power') or {}).items()))
+    return (item.get('remote_id'), item.get('command'), ports, item.get('power', 50), port_power)
+
+
+def sequence_ports(item: Dict[str, Any], device_id: int) -> List[int]:
+    """IR ports of a device that a queued sequence sends on: its fleet ports, else its steps' ports."""
+    if item.get('ports'):
+        return sorted({int(p) for p in item['ports']})
+    return sorted({int(cmd.get('ir_port') or 1) for cmd in item.get('commands') or []
+                   if cmd.get('redrat_device_id') is None or int(cmd['redrat_device_id']) == device_id})
+
+
+def parse_tenant_weights(spec: str) -> Dict[str, float]:
+    """Parse tenant weights of the form 'key:3=1,user:1=4' (unlisted tenants weigh 1)."""
+    weights = {}
+    for part in (spec or '').split(','):
+        if '=' not in part:
+            continue
+        tenant, weight = part.rsplit('=', 1)
+        try:
+            weights[tenant.strip()] = max(0.01, float(weight))
+        except ValueError:
+            logger.warning(f"Ignoring invalid tenant weight '{part}'")
+    return weights
+
+
+class DeviceLane:
+    """Pending commands and worker thread for one RedRat device.
+    
+    Commands wait in the lane until the IR ports they use are ready; the
+    worker serves the highest priority class first and shares each class
+    between tenants (users or API keys) by weighted deficit round robin;
+    within a tenant, work runs earliest deadline first, then in arrival
+    order. An MK-IV port cooldown delays only the commands for that port,
+    and a long sequence only holds up its own device. Commands whose
+    deadline passes while waiting are expired instead of sent.
+    
+    With a coalescing window, a press identical to the one submitted just
+    before it, still waiting, joins that entry's press train instead of
+    queueing on its own.
+    """
+    
+    def __init__(self, owner: 'CommandQueue', device_info: Dict[str, Any]):
+        self.owner = owner
+        self.device_id = device_info.get('id')
+        self.device_info = device_info
+        self.running = False
+        self.retired = False
+        self.worker_thread = None
+        self._cond = threading.Condition()
+        self._pending = []  # Routed commands waiting for their ports, in entry['order']
+        self._busy = False  # A command or sequence is executing
+        self._busy_cost = 0  # IR sends of the executing command or sequence
+        self._service_time = owner.service_time  # Moving average of seconds per IR send
+        self._stats = dict.fromkeys(_LANE_STATS, 0)
+        self._last_submitted = None  # Entry the next identical press may join
+        self._drr = {}  # Key: priority rank, Value: round-robin ring, pointer and deficits
+        self._tenant_stats = {}  # Key: tenant, Value: dispatched count and queue wait
+    
+    @property
+    def device_key(self) -> tuple:
+        return (self.device_info['ip_address'], int(self.device_info['port']))
+    
+    @property
+    def name(self) -> str:
+        return self.device_info.get('name') or f"{self.device_key[0]}:{self.device_key[1]}"
+    
+    def depth(self) -> int:
+        """Number of commands waiting in or executing on this lane."""
+        with self._cond:
+            return len(self._pending) + (1 if self._busy else 0)
+    
+    def load(self) -> int:
+        """IR sends waiting in or executing on this lane (a sequence counts each step)."""
+        with self._cond:
+            return sum(self._cost(entry) for entry in self._pending) + self._busy_cost
+    
+    def drain_estimate(self, sends: int = None) -> float:
+        """Estimate the seconds until this lane has worked off its first sends IR sends.
+        
+        Uses the average service time per send; MK-IV lanes whose backlog is
+        concentrated on few ports are bounded by the port cooldown instead.
+        
+        Args:
+            sends: Number of sends to work off (default: the whole load)
+        """
+        now = time.monotonic()
+        with self._cond:
+            load = sum(self._cost(entry) for entry in self._pending) + self._busy_cost
+            sends = load if sends is None else min(sends, load)
+            estimate = sends * self._service_time
+            per_port = {}
+            counted = self._busy_cost
+            for entry in self._pending:
+                if counted >= sends:
+                    break
+                counted += self._cost(entry)
+                for port in entry['ports']:
+                    per_port[port] = per_port.get(port, 0) + 1
+        
+        cooldown = self.owner.scheduler.cooldown_for(self.device_key)
+        if cooldown and per_port:
+            for port, count in per_port.items():
+                ready_in = max(0.0, self.owner.scheduler.ready_at(self.device_key, [port]) - now)
+                estimate = max(estimate, ready_in + (count - 1) * cooldown)
+        return estimate
+    
+    def start(self):
+        """Start the lane worker thread."""
+        if not self.running:
+            self.running = True
+            self.worker_thread = threading.Thread(target=self._run, daemon=True,
+                                                  name=f"redrat-lane-{self.device_id}")
+            self.worker_thread.start()
+            logger.info(f"Command lane started for RedRat device {self.name}")
+    
+    def stop(self):
+        """Stop the lane worker thread; pending commands are left unsent."""
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        if self.worker_thread:
+            self.worker_thread.join(timeout=5)
+    
+    def retire(self) -> List[Dict[str, Any]]:
+        """Stop accepting commands and shut the worker down.
+        
+        Returns:
+            Entries that were still pending
+        """
+        with self._cond:
+            self.retired = True
+            self.running = False
+            pending, self._pending = self._pending, []
+            self._cond.notify_all()
+        logger.info(f"Command lane retired for RedRat device {self.name}")
+        return pending
+    
+    def submit(self, entry: Dict[str, Any]) -> bool:
+        """Add a routed command or sequence to the lane."""
+        item = entry['item']
+        if item.get('type') == 'sequence':
+            entry['ports'] = sequence_ports(item, self.device_id)
+        else:
+            entry['ports'] = [int(p) for p in (item.get('ir_ports') or [item.get('ir_port', 1)])]
+        with self._cond:
+            if self.retired:
+                return False
+            if self._coalesce(entry):
+                return True
+            self._pending.insert(bisect.bisect([e['order'] for e in self._pending], entry['order']), entry)
+            self._last_submitted = entry
+            self._cond.notify()
+        return True
+    
+    def _coalesce(self, entry: Dict[str, Any]) -> bool:
+        """Merge a repeated press into the identical press submitted just before it.
+        
+        The earlier entry must still be waiting, belong to the same tenant,
+        priority class and deadline, and have arrived within the owner's
+        coalesce_window. Each press of the train is sent as its own signal
+        with its own toggle state and, for a double signal, its own half, so
+        both alternate per press as they would for separate commands (called
+        with the lane lock held).
+        
+        Returns:
+            True if the entry was merged
+        """
+        window = self.owner.coalesce_window
+        last = self._last_submitted
+        item = entry['item']
+        if not window or last is None or item.get('type') == 'sequence' or last['item'].get('type') == 'sequence':
+            return False
+        if (last['tenant'] != entry['tenant'] or last['order'][0] != entry['order'][0]
+                or last['deadline'] != entry['deadline']
+                or entry['enqueued_at'] - last['enqueued_at'] > window
+                or press_key(last['item']) != press_key(item)
+                or not any(pending is last for pending in self._pending)):
+            return False
+        
+        last.setdefault('merged', []).append(entry)
+        last['item']['presses'] = last['item'].get('presses', 1) + 1
+        self._stats['coalesced'] += 1
+        return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get lane counters and depth."""
+        now = time.monotonic()
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+            stats['waiting_for_cooldown'] = sum(1 for entry in self._pending if entry['ready_at'] > now)
+            stats['pending_by_priority'] = {name: sum(1 for entry in self._pending
+                                                      if entry['item'].get('priority') == name)
+                                            for name in PRIORITY_CLASSES}
+            tenants = {tenant: dict(counters, pending=0) for tenant, counters in self._tenant_stats.items()}
+            for entry in self._pending:
+                tenants.setdefault(entry['tenant'], {'dispatched': 0, 'queue_wait_total': 0.0,
+                                                     'queue_wait_max': 0.0, 'pending': 0})['pending'] += 1
+            stats['tenants'] = tenants
+            stats['service_time'] = round(self._service_time, 4)
+        stats['load'] = self.load()
+        stats['capacity'] = self.owner.lane_capacity
+        stats['drain_estimate'] = round(self.drain_estimate(), 3)
+        stats['device'] = self.name
+        return stats
+    
+    def _run(self):
+        """Dispatch pending commands as their ports become ready."""
+        while self.running:
+            try:
+                with self._cond:
+                    expired = self._take_expired()
+                    entry = self._next_ready()
+                    if entry is None and not expired:
+                        self._cond.wait(self._next_wait())
+                        continue
+                for stale in expired:
+                    self.owner._expire(stale)
+                if entry:
+                    self._dispatch(entry)
+            except Exception as e:
+                logger.error(f"Error in command lane for {self.name}: {str(e)}")
+    
+    def _take_expired(self) -> List[Dict[str, Any]]:
+        """Remove pending commands whose deadline has passed (called with the lane lock held)."""
+        now = time.time()
+        expired = [entry for entry in self._pending if entry['deadline'] is not None and entry['deadline'] < now]
+        if expired:
+            self._pending = [entry for entry in self._pending if entry not in expired]
+            self._stats['expired'] += len(expired)
+        return expired
+    
+    def _next_ready(self) -> Optional[Dict[str, Any]]:
+        """Take the next command to send (called with the lane lock held).
+        
+        Candidates are the first ready command of each tenant in the highest
+        priority class that has one; deficit round robin picks between them.
+        A command never overtakes one of the same tenant ahead of it in the
+        lane that shares a port, so each tenant's per-port order follows
+        priority, deadline and arrival even for multi-port commands.
+        """
+        now = time.monotonic()
+        device_key = self.device_key
+        blocked = set()  # (tenant, port) held by an earlier command
+        present = {}  # Key: priority rank, Value: tenants with pending work
+        candidates = {}  # Key: tenant, Value: its first ready command in best_rank
+        best_rank = None
+        for entry in self._pending:
+            tenant, rank = entry['tenant'], entry['order'][0]
+            present.setdefault(rank, set()).add(tenant)
+            ports = set(entry['ports'])
+            slots = {(tenant, port) for port in ports}
+            if ports:
+                entry['ready_at'] = self.owner.scheduler.ready_at(device_key, ports)
+            if entry['ready_at'] <= now and not (slots & blocked):
+                if best_rank is None or rank < best_rank:
+                    best_rank, candidates = rank, {}
+                if rank == best_rank:
+                    candidates.setdefault(tenant, entry)
+            elif entry['deferred_at'] is None:
+                entry['deferred_at'] = now
+                self._stats['deferred'] += 1
+            blocked |= slots
+        
+        if not candidates:
+            return None
+        entry = self._drr_pick(best_rank, candidates, present[best_rank])
+        self._pending.remove(entry)
+        return entry
+    
+    def _drr_pick(self, rank: int, candidates: Dict[str, Dict[str, Any]], present: set) -> Dict[str, Any]:
+        """Choose between tenants' candidates by weighted deficit round robin.
+        
+        Each visit of the round-robin pointer credits a tenant its weight; a
+        command costs 1 and a sequence one per step. Tenants whose work is
+        only waiting for a port cooldown are skipped without credit, and a
+        tenant with nothing pending loses its credit.
+        """
+        state = self._drr.setdefault(rank, {'ring': [], 'next': 0, 'fresh': True, 'deficit': {}})
+        deficit = state['deficit']
+        for tenant in [t for t in deficit if t not in present]:
+            del deficit[tenant]
+        ring = [t for t in state['ring'] if t in present]
+        ring.extend(t for t in candidates if t not in ring)
+        if ring != state['ring']:
+            current = state['ring'][state['next']] if state['next'] < len(state['ring']) else None
+            if current in ring:
+                state['next'] = ring.index(current)
+            else:
+                state['next'], state['fresh'] = 0, True
+            state['ring'] = ring
+        
+        index = state['next']
+        for _ in range(len(ring) * 1000):
+            tenant = ring[index]
+            if tenant in candidates:
+                if state['fresh']:
+                    deficit[tenant] = deficit.get(tenant, 0.0) + self.owner.tenant_weight(tenant)
+                    state['fresh'] = False
+                cost = self._cost(candidates[tenant])
+                if deficit[tenant] >= cost:
+                    deficit[tenant] -= cost
+                    state['next'] = index
+                    return candidates[tenant]
+            index = (index + 1) % len(ring)
+            state['fresh'] = True
+        
+        # Unreachable with positive weights; fall back to arrival order
+        return min(candidates.values(), key=lambda e: e['order'])
+    
+    def _cost(self, entry: Dict[str, Any]) -> int:
+        """Fair-queueing cost of an entry: 1 per IR command sent."""
+        item = entry['item']
+        if item.get('type') == 'sequence':
+            return max(1, len(item.get('commands') or []) * len(item.get('ports') or [None]))
+        return item.get('presses', 1)
+    
+    def _next_wait(self) -> float:
+        """Seconds until the next port cooldown ends (at most 1; called with the lane lock held).
+        
+        Pending commands that are ready but not dispatched are waiting behind
+        another command on the same port, so only cooldowns matter here.
+        """
+        now = time.monotonic()
+        cooling = [entry['ready_at'] for entry in self._pending if entry['ready_at'] > now]
+        return min(1.0, min(cooling) - now) if cooling else 1.0
+    
+    def _dispatch(self, entry: Dict[str, Any]):
+        """Execute a pending command or sequence and record its timing."""
+        item = entry['item']
+        now = time.monotonic()
+        cost = self._cost(entry)
+        with self._cond:
+            self._busy = True
+            self._busy_cost = cost
+            self._stats['dispatched'] += 1
+            queue_wait = now - entry['enqueued_at']
+            self._stats['queue_wait_total'] += queue_wait
+            self._stats['queue_wait_max'] = max(self._stats['queue_wait_max'], queue_wait)
+            tenant = self._tenant_stats.setdefault(entry['tenant'], {'dispatched': 0, 'queue_wait_total': 0.0,
+                                                                     'queue_wait_max': 0.0})
+            tenant['dispatched'] += 1
+            tenant['queue_wait_total'] += queue_wait
+            tenant['queue_wait_max'] = max(tenant['queue_wait_max'], queue_wait)
+            if entry['deferred_at'] is not None:
+                cooldown_wait = now - entry['deferred_at']
+                self._stats['cooldown_wait_total'] += cooldown_wait
+                self._stats['cooldown_wait_max'] = max(self._stats['cooldown_wait_max'], cooldown_wait)
+        
+        error = None
+        try:
+            if item.get('type') == 'sequence':
+                result = entry['result'] = self.owner._execute_sequence(item, self.device_info)
+                # Start the cooldowns of every port the sequence sent on
+                for used in (result or {}).get('ports_used', ()):
+                    self.owner.scheduler.mark_used((used['host'], int(used['port'])), used['ports'])
+                with self._cond:
+                    self._stats['succeeded' if result and result['success'] else 'failed'] += 1
+                return
+            
+            result = entry['result'] = self.owner._execute_command(item, self.device_info)
+            succeeded = bool(result and result['success'])
+            if succeeded:
+                self.owner.scheduler.mark_used(self.device_key, entry['ports'])
+            else:
+                error = (result or {}).get('message') or 'Command failed'
+            for merged in entry.get('merged', ()):
+                self.owner._update_command_status(merged['item']['id'], 'executed' if succeeded else 'failed', error)
+            with self._cond:
+                self._stats['succeeded' if succeeded else 'failed'] += 1
+        finally:
+            elapsed = time.monotonic() - now
+            with self._cond:
+                self._busy = False
+                self._busy_cost = 0
+                self._service_time += SERVICE_TIME_ALPHA * (elapsed / cost - self._service_time)
+            self.owner._task_done(entry, error)
+
+
 class CommandQueue:
-    """Enhanced command queue with RedRat hardware integration."""
+    """Enhanced command queue with RedRat hardware integration.
+    
+    A router thread takes commands from the intake queue and hands them to
+    one DeviceLane per active RedRat device, so devices execute in parallel.
+    Lanes are created and retired as devices are added, deactivated or
+    removed in redrat_devices.
+    
+    With a durable backend, add_command/add_sequence store items in the
+    command_queue table and the router claims them from there, holding at
+    most max_claimed at a time. Only the process holding the backend's
+    dispatcher lease claims rows, since lanes keep per-device state (port
+    cooldowns, double-signal alternation) in memory; other processes only
+    enqueue until the holder stops.
+    """
     
-    def __init__(self):
+    def __init__(self, port_cooldown: float = None, reconcile_interval: float = 30.0,
+                 backend=None, max_claimed: int = 32, poll_interval: float = 0.5,
+                 retention: int = 86400, tenant_weights: Dict[str, float] = None,
+                 lane_capacity: int = 100, service_time: float = 0.5,
+                 handle_retention: float = 300.0, coalesce_window: float = 0.0,
+                 press_interval_ms: int = 400):
+        """
+        Args:
+            port_cooldown: Seconds between signals on the same MK-IV port
+            reconcile_interval: Seconds between device routing table reloads
+            backend: Durable queue storage (e.g. MySQLQueueBackend); None keeps
+                the queue in process memory
+            max_claimed: Durable rows this process holds (pending or executing) at once
+            poll_interval: Seconds between claim attempts when the durable queue is empty
+            retention: Seconds finished durable rows are kept
+            tenant_weights: Fair-queueing weight per tenant ('user:<id>' or
+                'key:<api key id>'); unlisted tenants weigh 1
+            lane_capacity: IR sends a device may have queued before new work
+                is refused with QueueSaturatedError (0 = unbounded)
+            service_time: Initial estimate of seconds per IR send, refined
+                per lane from observed execution times
+            handle_retention: Seconds a finished CommandHandle stays available
+                to wait_for_command
+            coalesce_window: Seconds within which repeated identical presses
+                waiting for a device merge into one press train (0 = off)
+            press_interval_ms: Spacing of the presses in a merged train
+        """
         self.queue = queue.Queue()
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # Guards the lane table
         self.running = False
         self.worker_thread = None
+        self.scheduler = PortScheduler() if port_cooldown is None else PortScheduler(port_cooldown)
+        self.reconcile_interval = reconcile_interval
+        self._lanes = {}  # Key: redrat_devices.id, Value: DeviceLane
+        self._retired_stats = dict.fromkeys(_LANE_STATS, 0)  # Counters of retired lanes
+        self._last_reconcile = 0.0
+        self._arrival = itertools.count()  # Tie-breaker keeping FIFO order within a class
+        self.tenant_weights = dict(tenant_weights or {})
+        self.lane_capacity = max(0, lane_capacity)
+        self.service_time = service_time
+        self._rejected = 0
+        self.handle_retention = handle_retention
+        self.coalesce_window = max(0.0, coalesce_window)
+        self.press_interval_ms = press_interval_ms
+        self._handles = OrderedDict()  # Key: (kind, item ID), Value: CommandHandle, oldest first
+        self._handles_lock = threading.Lock()
+        self._watcher_thread = None
+        self.backend = backend
+        self.max_claimed = max(1, max_claimed)
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._claimed = set()  # Durable row IDs held by this process
+        self._claimed_lock = threading.Lock()
+        self._last_renew = 0.0
+        self._dispatching = False  # Holds the durable backend's dispatcher lease
         
     def start(self):
-        """Start the command queue worker thread."""
+        """Start the command queue router thread."""
         if not self.running:
             self.running = True
             self.worker_thread = threading.Thread(target=self._process_queue, daemon=True)
@@ -51,98 +621,597 @@ class CommandQueue:
             logger.info("Command queue worker started")
         
     def stop(self):
-        """Stop the command queue worker thread."""
+        """Stop the router and all device lanes.
+        
+        Durable rows claimed but not started are returned to the queue for
+        another dispatcher; in-memory pending commands are dropped.
+        """
         self.running = False
         if self.worker_thread:
             self.worker_thread.join(timeout=5)
-            logger.info("Command queue worker stopped")
+        with self.lock:
+            lanes = list(self._lanes.values())
+            self._lanes.clear()
+        unstarted = []
+        for lane in lanes:
+            unstarted.extend(lane.retire())
+            lane.stop()
+        if self.backend:
+            row_ids = [entry['row_id'] for entry in unstarted if entry.get('row_id')]
+            try:
+                self.backend.release(row_ids)
+                if self._dispatching:
+                    self.backend.release_dispatcher()
+                    self._dispatching = False
+            except Exception as e:
+                logger.error(f"Error releasing claimed queue rows: {str(e)}")
+            with self._claimed_lock:
+                self._claimed.difference_update(row_ids)
+        logger.info("Command queue worker stopped")
         
-    def add_command(self, command: Dict[str, Any]) -> bool:
+    def add_command(self, command: Dict[str, Any]) -> Optional[CommandHandle]:
         """Add command to queue for processing.
         
         Args:
-            command: Command dictionary with required fields
+            command: Command dictionary with required fields; optional
+                'priority' (a PRIORITY_CLASSES name, default interactive) and
+                'deadline' (epoch seconds after which it is expired, not sent)
+                and 'tenant' (fair-queueing key, see tenant_for_user)
             
         Returns:
-            True if command was added to queue
+            CommandHandle resolved when the command has run, or None if it
+            was not added to the queue
+            
+        Raises:
+            QueueSaturatedError: If the target device's lane is full
         """
+        handle = None
         try:
             # Validate required fields
             required_fields = ['id', 'remote_id', 'command', 'device']
             if not all(field in command for field in required_fields):
                 logger.error(f"Command missing required fields: {command}")
-                return False
-                
-            self.queue.put(command)
+                return None
+            
+            command['priority'] = self._priority_name(command.get('priority'))
+            self.check_admission(command.get('redrat_device_id'), command.get('deadline'))
+            handle = self._register_handle('command', command['id'])
+            handle.row_id = self._enqueue(command)
             logger.info(f"Command {command['id']} added to queue")
-            return True
+            return handle
             
+        except QueueSaturatedError:
+            raise
         except Exception as e:
             logger.error(f"Error adding command to queue: {str(e)}")
-            return False
+            self._discard_handle(handle)
+            return None
             
-    def add_sequence(self, sequence: Dict[str, Any]) -> bool:
+    def add_sequence(self, sequence: Dict[str, Any]) -> Optional[CommandHandle]:
         """Add sequence to queue for processing.
         
         Args:
-            sequence: Sequence dictionary with commands
+            sequence: Sequence dictionary with commands; optional 'priority',
+                'deadline' and 'tenant' as for add_command, and 'ports' to run
+                the whole sequence on each of these IR ports of the device
+                (with 'fleet_run', the ID of the fleet run it belongs to)
             
         Returns:
-            True if sequence was added to queue
+            CommandHandle of this run of the sequence, or None if it was not
+            added to the queue
+            
+        Raises:
+            QueueSaturatedError: If the target device's lane is full
         """
+        handle = None
         try:
             # Validate sequence structure
             if 'id' not in sequence or 'commands' not in sequence:
                 logger.error(f"Sequence missing required fields: {sequence}")
-                return False
+                return None
                 
             # Add sequence as special command type
             sequence_command = {
                 'type': 'sequence',
+                'run_id': uuid.uuid4().hex,
                 'sequence_id': sequence['id'],
-                'commands': sequence['commands']
+                'commands': sequence['commands'],
+                'redrat_device_id': sequence.get('redrat_device_id'),
+                'priority': self._priority_name(sequence.get('priority')),
+                'deadline': sequence.get('deadline'),
+                'tenant': sequence.get('tenant')
             }
+            if sequence.get('ports'):
+                sequence_command['ports'] = list(sequence['ports'])
+                sequence_command['fleet_run'] = sequence.get('fleet_run')
             
-            self.queue.put(sequence_command)
+            self.check_admission(sequence_command['redrat_device_id'], sequence_command['deadline'])
+            handle = self._register_handle('sequence', sequence_command['run_id'])
+            handle.row_id = self._enqueue(sequence_command)
             logger.info(f"Sequence {sequence['id']} added to queue")
-            return True
+            return handle
             
+        except QueueSaturatedError:
+            raise
         except Exception as e:
             logger.error(f"Error adding sequence to queue: {str(e)}")
-            return False
+            self._discard_handle(handle)
+            return None
+    
+    def check_admission(self, device_id: int = None, deadline: float = None):
+        """Refuse new work for a device whose lane is full or too far behind.
+        
+        The lane's backlog (plus commands not yet routed) is compared with
+        lane_capacity; without a requested device the least-loaded device is
+        checked. With a durable backend the shared backlog in the
+        command_queue table is counted instead of this process's lanes.
+        
+        Args:
+            device_id: Requested redrat_devices.id, or None for any device
+            deadline: Epoch seconds by which the work must have run
+            
+        Raises:
+            QueueSaturatedError: With the estimated seconds until there is room
+        """
+        if not self.lane_capacity and deadline is None:
+            return
+        device = device_router.route(device_id, load=self._lane_depth)
+        if device is None:
+            return  # Unroutable work fails in the router as before
+        
+        lane = None
+        lane_load = 0
+        if self.backend:
+            backlog = self._durable_backlog(device_id)
+            if backlog is None:
+                return
+        else:
+            with self.lock:
+                lane = self._lanes.get(device['id'])
+            lane_load = lane.load() if lane else 0
+            backlog = lane_load + self.queue.qsize()  # Not yet routed work may be for this device
+        
+        def drain(sends: float) -> float:
+            """Seconds to work off the first sends of the backlog."""
+            routed = lane.drain_estimate(min(int(sends), lane_load)) if lane else 0.0
+            return routed + max(0, sends - lane_load) * self.service_time
+        
+        name = device.get('name') or device['id']
+        if self.lane_capacity and backlog >= self.lane_capacity:
+            self._reject()
+            raise QueueSaturatedError(f"RedRat device {name} is saturated ({backlog:.0f} queued sends)",
+                                      max(1, math.ceil(drain(backlog - self.lane_capacity + 1))), device['id'])
+        if deadline is not None:
+            wait = drain(backlog)
+            if time.time() + wait > deadline:
+                self._reject()
+                raise QueueSaturatedError(f"RedRat device {name} cannot run the request before its deadline "
+                                          f"(about {wait:.1f}s of queued work)",
+                                          max(1, math.ceil(wait - max(0.0, deadline - time.time()))),
+                                          device['id'])
+    
+    def get_handle(self, item_id: Any, kind: str = 'command') -> Optional[CommandHandle]:
+        """Get the handle of a command (or sequence run) queued by this process, if still retained."""
+        with self._handles_lock:
+            return self._handles.get((kind, item_id))
+    
+    def wait_for_command(self, command_id: Any, timeout: float,
+                         db_poll_interval: float = 0.5) -> Optional[Dict[str, Any]]:
+        """Wait until a command has finished.
+        
+        Blocks on the command's in-process handle. A command queued by
+        another process (or whose handle was dropped) is followed through its
+        commands.status row instead, polled every db_poll_interval seconds.
+        
+        Args:
+            command_id: Database ID of the command
+            timeout: Maximum seconds to wait
+            db_poll_interval: Seconds between status reads without a handle
+            
+        Returns:
+            Outcome dict (see CommandHandle.to_dict); 'done' is False on
+            timeout. None if the command is unknown.
+        """
+        handle = self.get_handle(command_id)
+        if handle and not self.backend:
+            handle.wait(timeout)
+            return handle.to_dict()
+        
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            if handle and handle.done():
+                return handle.to_dict()
+            status = self._command_status(command_id)
+            if status is None and handle is None:
+                return None
+            if status in ('executed', 'failed', 'expired'):
+                return {'done': True, 'status': status, 'success': status == 'executed',
+                        'message': '', 'result': None}
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return handle.to_dict() if handle else {'done': False, 'status': status, 'success': False,
+                                                         'message': '', 'result': None}
+            if handle:
+                handle.wait(min(remaining, db_poll_interval))
+            else:
+                time.sleep(min(remaining, db_poll_interval))
+    
+    def tenant_weight(self, tenant: str) -> float:
+        """Get the fair-queueing weight of a tenant."""
+        return self.tenant_weights.get(tenant, 1.0)
+    
+    def _priority_name(self, priority: Optional[str]) -> str:
+        """Validate a priority class name, falling back to the default."""
+        if priority is None:
+            return DEFAULT_PRIORITY
+        if priority not in PRIORITY_CLASSES:
+            logger.warning(f"Unknown queue priority '{priority}', using {DEFAULT_PRIORITY}")
+            return DEFAULT_PRIORITY
+        return priority
+    
+    def _register_handle(self, kind: str, item_id: Any) -> CommandHandle:
+        """Create the handle of a new item, dropping finished handles past retention."""
+        handle = CommandHandle(kind, item_id)
+        now = time.monotonic()
+        with self._handles_lock:
+            self._handles.pop((kind, item_id), None)
+            self._handles[(kind, item_id)] = handle
+            for key in list(self._handles):
+                oldest = self._handles[key]
+                if not oldest.done() or now - oldest.completed_at < self.handle_retention:
+                    break
+                del self._handles[key]
+        return handle
+    
+    def _start_handle_watcher(self):
+        """Start the thread following durable items' rows, if not running."""
+        with self._handles_lock:
+            if self._watcher_thread is not None:
+                return
+            self._watcher_thread = threading.Thread(target=self._watch_handles, daemon=True,
+                                                    name="redrat-queue-handles")
+        self._watcher_thread.start()
+    
+    def _watch_handles(self):
+        """Resolve handles of durable items from their command_queue rows.
+        
+        Any dispatcher may claim an item this process queued (and this
+        process may not dispatch at all), so handles are also resolved from
+        the row status: done becomes executed, failed and expired are kept.
+        Such an outcome has no result; a purged row counts as failed.
+        """
+        while True:
+            time.sleep(self.poll_interval)
+            with self._handles_lock:
+                waiting = {handle.row_id: handle for handle in self._handles.values()
+                           if handle.row_id is not None and not handle.done()}
+            if not waiting:
+                continue
+            try:
+                rows = self.backend.statuses(list(waiting))
+            except Exception as e:
+                logger.error(f"Error reading queue row status: {str(e)}")
+                continue
+            for row_id, handle in waiting.items():
+                status, error = rows.get(row_id, ('failed', 'Queue row no longer exists'))
+                if status in ('queued', 'claimed') or handle.done():
+                    continue
+                handle._resolve('executed' if status == 'done' else status, None, error)
+    
+    def _discard_handle(self, handle: Optional[CommandHandle]):
+        """Forget the handle of an item that could not be queued."""
+        if handle:
+            with self._handles_lock:
+                if self._handles.get((handle.kind, handle.item_id)) is handle:
+                    del self._handles[(handle.kind, handle.item_id)]
+    
+    def _resolve_handle(self, entry: Dict[str, Any], error: str = None, status: str = None):
+        """Complete the handle of a finished item."""
+        item = entry['item']
+        if item.get('type') == 'sequence':
+            key = ('sequence', item.get('run_id'))
+        else:
+            key = ('command', item.get('id'))
+        with self._handles_lock:
+            handle = self._handles.get(key)
+        if handle and not handle.done():
+            result = entry.get('result')
+            if status is None:
+                status = 'executed' if error is None and result and result.get('success') else 'failed'
+            handle._resolve(status, result, error or (result or {}).get('message'))
+    
+    def _reject(self):
+        """Count a request refused by admission control."""
+        with self.lock:
+            self._rejected += 1
+    
+    def _durable_backlog(self, device_id: int = None) -> Optional[float]:
+        """Queued durable rows per device: for device_id, or averaged over active devices."""
+        try:
+            backlog = self.backend.backlog(device_id)
+        except Exception as e:
+            logger.error(f"Error reading durable queue backlog: {str(e)}")
+            return None
+        if device_id is None:
+            backlog /= max(1, len(device_router.active_devices()))
+        return backlog
+    
+    def _enqueue(self, item: Dict[str, Any]) -> Optional[int]:
+        """Store an item in the durable backend or the in-memory intake queue.
+        
+        Returns:
+            command_queue row ID with a durable backend, else None
+        """
+        if self.backend:
+            row_id = self.backend.put(item, PRIORITY_CLASSES[item['priority']])
+            self._start_handle_watcher()
+            return row_id
+        self.queue.put(item)
+        return None
+    
+    def reconcile_lanes(self, devices: List[Dict[str, Any]] = None):
+        """Create lanes for active devices and retire lanes of removed or inactive ones.
+        
+        Registered as a device_router listener, so it runs on every routing
+        table refresh.
+        
+        Args:
+            devices: Device dicts (defaults to the routing table's active devices)
+        """
+        if devices is None:
+            devices = device_router.active_devices()
+        active = {d['id']: d for d in devices if d.get('is_active', False)}
+        
+        with self.lock:
+            retired = [self._lanes.pop(device_id) for device_id in list(self._lanes) if device_id not in active]
+            for device_id, device_info in active.items():
+                lane = self._lanes.get(device_id)
+                if lane is None:
+                    lane = self._lanes[device_id] = DeviceLane(self, device_info)
+                    lane.start()
+                elif (lane.device_info['ip_address'], lane.device_info['port']) != \
+                        (device_info['ip_address'], device_info['port']):
+                    # Address changed: drop cooldowns of the old address
+                    self.scheduler.forget(lane.device_key)
+                lane.device_info = device_info
+        
+        for lane in retired:
+            self._retire_lane(lane)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get queue depth, dispatch counters, wait times and cooling ports, overall and per lane."""
+        with self.lock:
+            lanes = list(self._lanes.values())
+            stats = dict(self._retired_stats)
+        lane_stats = {lane.device_id: lane.get_stats() for lane in lanes}
+        for lane in lane_stats.values():
+            for key in _LANE_STATS:
+                if key.endswith('_max'):
+                    stats[key] = max(stats[key], lane[key])
+                else:
+                    stats[key] += lane[key]
+        stats['queued'] = self.queue.qsize()
+        stats['rejected'] = self._rejected
+        stats['lane_capacity'] = self.lane_capacity
+        stats['pending'] = sum(lane['pending'] for lane in lane_stats.values())
+        stats['waiting_for_cooldown'] = sum(lane['waiting_for_cooldown'] for lane in lane_stats.values())
+        stats['queue_wait_avg'] = (stats['queue_wait_total'] / stats['dispatched']) if stats['dispatched'] else 0.0
+        stats['cooling_ports'] = self.scheduler.cooling_ports()
+        stats['routing'] = device_router.get_stats()
+        stats['services'] = redrat_service_registry.get_stats() if redrat_service_registry else {}
+        stats['templates'] = template_index.get_stats() if template_index else {}
+        stats['plans'] = sequence_plan_cache.get_stats() if sequence_plan_cache else {}
+        stats['tenants'] = self._tenant_totals(lane_stats)
+        stats['lanes'] = lane_stats
+        stats['backend'] = {'backend': 'memory'}
+        if self.backend:
+            with self._claimed_lock:
+                stats['claimed'] = len(self._claimed)
+            stats['dispatcher'] = self._dispatching
+            try:
+                stats['backend'] = self.backend.get_stats()
+            except Exception as e:
+                stats['backend'] = {'backend': 'mysql', 'error': str(e)}
+        return stats
         
     def _process_queue(self):
-        """Process commands in the queue."""
+        """Route queued commands to their device lanes."""
         logger.info("Command queue processing started")
         
+        if template_index:
+            # Warm the template index so the first command needs no query
+            try:
+                template_index.load()
+            except Exception as e:
+                logger.warning(f"Template index not loaded at startup: {str(e)}")
+        
         while self.running:
             try:
+                if RedRatDeviceService and time.monotonic() - self._last_reconcile >= self.reconcile_interval:
+                    # Picks up device changes made by other processes
+                    self._last_reconcile = time.monotonic()
+                    device_router.refresh()
+                    if self.backend:
+                        self.backend.purge_finished(self.retention)
+                
+                if self.backend:
+                    self._claim_durable()
+                    continue
+                
                 # Get command from queue with timeout
-                command = self.queue.get(timeout=1)
+                item = self.queue.get(timeout=1)
+                self._route(item)
                 
-                with self.lock:
-                    if command.get('type') == 'sequence':
-                        self._execute_sequence(command)
-                    else:
-                        self._execute_command(command)
-                        
             except queue.Empty:
                 continue
             except Exception as e:
                 logger.error(f"Error processing command queue: {str(e)}")
-            finally:
-                try:
-                    self.queue.task_done()
-                except:
-                    pass
                     
         logger.info("Command queue processing stopped")
+    
+    def _tenant_totals(self, lane_stats: Dict[Any, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Combine per-lane tenant counters into queue depth and wait time per tenant."""
+        totals = {}
+        for lane in lane_stats.values():
+            for tenant, counters in lane['tenants'].items():
+                total = totals.setdefault(tenant, {'pending': 0, 'dispatched': 0, 'queue_wait_total': 0.0,
+                                                   'queue_wait_max': 0.0, 'weight': self.tenant_weight(tenant)})
+                total['pending'] += counters['pending']
+                total['dispatched'] += counters['dispatched']
+                total['queue_wait_total'] += counters['queue_wait_total']
+                total['queue_wait_max'] = max(total['queue_wait_max'], counters['queue_wait_max'])
+        for total in totals.values():
+            total['queue_wait_avg'] = (total['queue_wait_total'] / total['dispatched']) if total['dispatched'] else 0.0
+        return totals
+    
+    def _claim_durable(self):
+        """Claim rows from the durable backend up to max_claimed and route them.
+        
+        Rows are only claimed while this process holds the dispatcher lease.
+        """
+        now = time.monotonic()
+        with self._claimed_lock:
+            held = list(self._claimed)
+        
+        # Keep the dispatcher lease and leases of held rows alive while they wait or execute
+        if now - self._last_renew >= self.backend.lease_seconds / 3:
+            self._last_renew = now
+            dispatching = self.backend.acquire_dispatcher()
+            if dispatching != self._dispatching:
+                logger.info(f"Command queue dispatcher lease {'acquired' if dispatching else 'held by another process'}")
+            self._dispatching = dispatching
+            if held:
+                self.backend.renew(held)
+        
+        if not self._dispatching:
+            time.sleep(self.poll_interval)
+            return
+        
+        claimed = self.backend.claim(self.max_claimed - len(held))
+        if not claimed:
+            time.sleep(self.poll_interval)
+            return
+        
+        with self._claimed_lock:
+            self._claimed.update(row_id for row_id, _ in claimed)
+        for row_id, item in claimed:
+            self._route(item, row_id)
+    
+    def _route(self, item: Dict[str, Any], row_id: int = None):
+        """Hand a queued command or sequence to the lane of its device."""
+        deadline = float(item['deadline']) if item.get('deadline') is not None else None
+        entry = {
+            'item': item,
+            'row_id': row_id,
+            'tenant': item.get('tenant') or DEFAULT_TENANT,
+            'ports': [],
+            'deadline': deadline,
+            # Lane order: priority class, then earliest deadline, then arrival
+            'order': (PRIORITY_CLASSES.get(item.get('priority'), PRIORITY_CLASSES[DEFAULT_PRIORITY]),
+                      deadline if deadline is not None else float('inf'), next(self._arrival)),
+            'enqueued_at': time.monotonic(),
+            'ready_at': 0.0,
+            'deferred_at': None
+        }
+        
+        if deadline is not None and deadline < time.time():
+            with self.lock:
+                self._retired_stats['expired'] += 1
+            self._expire(entry)
+            return
+        
+        lane = None
+        if RedRatDeviceService:
+            if item.get('type') == 'sequence':
+                device_info = self._get_redrat_device_for_sequence(item)
+            else:
+                device_info = self._get_redrat_device_for_command(item)
+            if device_info:
+                lane = self._lane_for(device_info)
+        
+        if lane is None or not lane.submit(entry):
+            # No usable device: execute inline so the failure is recorded
+            try:
+                if item.get('type') == 'sequence':
+                    self._execute_sequence(item)
+                else:
+                    self._execute_command(item)
+            finally:
+                self._task_done(entry, 'No RedRat device available')
+    
+    def _lane_for(self, device_info: Dict[str, Any]) -> DeviceLane:
+        """Get the lane of a device, creating it for a device not seen by the last reconcile."""
+        with self.lock:
+            lane = self._lanes.get(device_info['id'])
+            if lane is None:
+                lane = self._lanes[device_info['id']] = DeviceLane(self, device_info)
+                lane.start()
+            return lane
+    
+    def _retire_lane(self, lane: DeviceLane):
+        """Shut a lane down and fail the commands still waiting in it."""
+        pending = lane.retire()
+        lane_stats = lane.get_stats()
+        with self.lock:
+            for key in _LANE_STATS:
+                if key.endswith('_max'):
+                    self._retired_stats[key] = max(self._retired_stats[key], lane_stats[key])
+                else:
+                    self._retired_stats[key] += lane_stats[key]
+        self.scheduler.forget(lane.device_key)
+        
+        for entry in pending:
+            item = entry['item']
+            if item.get('type') == 'sequence':
+                logger.warning(f"Sequence {item['sequence_id']} dropped: RedRat device {lane.name} was removed")
+            else:
+                for dropped in [entry] + entry.get('merged', []):
+                    self._update_command_status(dropped['item']['id'], 'failed', 'RedRat device removed')
+            self._task_done(entry, 'RedRat device removed')
+    
+    def _expire(self, entry: Dict[str, Any]):
+        """Drop an item whose deadline passed before it could be sent."""
+        item = entry['item']
+        late = time.time() - entry['deadline']
+        if item.get('type') == 'sequence':
+            logger.warning(f"Sequence {item['sequence_id']} expired {late:.1f}s past its deadline")
+        else:
+            logger.warning(f"Command {item['id']} expired {late:.1f}s past its deadline")
+            for expired in [entry] + entry.get('merged', []):
+                self._update_command_status(expired['item']['id'], 'expired', 'Deadline passed before execution')
+        self._task_done(entry, 'Deadline passed before execution', status='expired')
+    
+    def _task_done(self, entry: Dict[str, Any], error: str = None, status: str = None):
+        """Mark a queued item as processed, acknowledging its durable row if any."""
+        self._resolve_handle(entry, error, status)
+        for merged in entry.get('merged', ()):
+            merged['result'] = entry.get('result')
+            self._task_done(merged, error, status)
+        row_id = entry.get('row_id')
+        if row_id is None:
+            try:
+                self.queue.task_done()
+            except ValueError:
+                pass
+            return
+        
+        with self._claimed_lock:
+            self._claimed.discard(row_id)
+        try:
+            self.backend.complete(row_id, error, status)
+        except Exception as e:
+            # The lease runs out and the row is redelivered
+            logger.error(f"Error completing queue row {row_id}: {str(e)}")
                 
-    def _execute_command(self, command):
+    def _execute_command(self, command, device_info: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
         """Execute a single command using RedRat service.
         
         Args:
             command: Command dictionary
+            device_info: RedRat device to use (looked up if not given)
+            
+        Returns:
+            send_command result, or None if the command could not be sent
         """
         try:
             logger.info(f"Executing command {command['id']}: {command['command']}")
@@ -155,7 +1224,7 @@ class CommandQueue:
                 return
             
             # Get the RedRat device information
-            device_info = self._get_redrat_device_for_command(command)
+            device_info = device_info or self._get_redrat_device_for_command(command)
             if not device_info:
                 logger.error(f"No RedRat device found for command {command['id']}")
                 self._update_command_status(command['id'], 'failed', 
@@ -176,23 +1245,36 @@ class CommandQueue:
                 command['remote_id'],
                 command['command'],
                 command.get('ir_port', 1),
-                command.get('power', 50)
+                command.get('power', 50),
+                ir_ports=command.get('ir_ports'),
+                port_power=command.get('port_power'),
+                enforce_timing=False,  # Port cooldowns are scheduled by the queue
+                presses=command.get('presses', 1),
+                press_interval_ms=self.press_interval_ms
             )
+            # Presses of later identical commands sent in this train
+            result['merged_presses'] = command.get('presses', 1) - 1
             
             if result['success']:
                 logger.info(f"Command {command['id']} executed successfully")
             else:
                 logger.error(f"Command {command['id']} failed: {result['message']}")
+            return result
                 
         except Exception as e:
             logger.error(f"Error executing command {command['id']}: {str(e)}")
             self._update_command_status(command['id'], 'failed', str(e))
+        return None
             
-    def _execute_sequence(self, sequence_command: Dict[str, Any]):
+    def _execute_sequence(self, sequence_command: Dict[str, Any], device_info: Dict[str, Any] = None):
         """Execute a sequence of commands using RedRat service.
         
         Args:
             sequence_command: Sequence command dictionary
+            device_info: RedRat device to use (looked up if not given)
+            
+        Returns:
+            send_sequence result, or None if the sequence could not be sent
         """
         try:
             sequence_id = sequence_command['sequence_id']
@@ -206,7 +1288,7 @@ class CommandQueue:
                 return
             
             # Get the RedRat device information for the sequence
-            device_info = self._get_redrat_device_for_sequence(sequence_id)
+            device_info = device_info or self._get_redrat_device_for_sequence(sequence_command)
             if not device_info:
                 logger.error(f"No RedRat device found for sequence {sequence_id}")
                 return
@@ -217,59 +1299,73 @@ class CommandQueue:
                 logger.error(f"Failed to create RedRat service for {device_info['ip_address']}:{device_info['port']}")
                 return
             
-            # Execute sequence
-            result = redrat_service.send_sequence(sequence_id, commands)
+            # Execute sequence, on every target port for a fleet run
+            ports = sequence_command.get('ports')
+            progress = None
+            if ports and fleet_runs:
+                progress = fleet_runs.progress_callback(sequence_command.get('fleet_run'), device_info['id'], ports)
+            # The lane dispatched the sequence once its ports were ready
+            result = redrat_service.send_sequence(sequence_id, commands, enforce_timing=False,
+                                                  ports=ports, progress=progress)
             
             if result['success']:
                 logger.info(f"Sequence {sequence_id} executed successfully")
             else:
                 logger.error(f"Sequence {sequence_id} failed: {result['message']}")
+            return result
                 
         except Exception as e:
             logger.error(f"Error executing sequence {sequence_command['sequence_id']}: {str(e)}")
+        return None
     
     def _get_redrat_device_for_command(self, command):
-        """Get RedRat device information for a command."""
+        """Get RedRat device information for a command.
+        
+        Uses the command's redrat_device_id when given, otherwise the active
+        device with the fewest queued commands.
+        """
         try:
-            # For now, get the first active RedRat device from database
-            # In the future, this could be based on command routing or device assignment
-            devices = RedRatDeviceService.get_all_devices()
-            active_devices = [d for d in devices if d.get('is_active', False)]
-            
-            if active_devices:
-                return active_devices[0]  # Return first active device
-            
-            logger.warning("No active RedRat devices found")
-            return None
+            return device_router.route(command.get('redrat_device_id'), load=self._lane_depth)
             
         except Exception as e:
             logger.error(f"Error getting RedRat device for command: {str(e)}")
             return None
     
-    def _get_redrat_device_for_sequence(self, sequence_id):
-        """Get RedRat device information for a sequence."""
+    def _get_redrat_device_for_sequence(self, sequence_command):
+        """Get RedRat device information for a sequence (same policy as commands)."""
         try:
-            # For now, get the first active RedRat device from database
-            # In the future, this could be based on sequence routing or device assignment
-            devices = RedRatDeviceService.get_all_devices()
-            active_devices = [d for d in devices if d.get('is_active', False)]
-            
-            if active_devices:
-                return active_devices[0]  # Return first active device
-            
-            logger.warning("No active RedRat devices found")
-            return None
+            return device_router.route(sequence_command.get('redrat_device_id'), load=self._lane_depth)
             
         except Exception as e:
             logger.error(f"Error getting RedRat device for sequence: {str(e)}")
             return None
+    
+    def _lane_depth(self, device_id: int) -> int:
+        """Number of commands waiting in or executing on a device's lane."""
+        with self.lock:
+            lane = self._lanes.get(device_id)
+        return lane.depth() if lane else 0
             
+    def _command_status(self, command_id: Any) -> Optional[str]:
+        """Read a command's status from the database (None if unknown)."""
+        try:
+            with db.get_connection() as conn:
+                if not conn:
+                    return None
+                cursor = conn.cursor()
+                cursor.execute("SELECT status FROM commands WHERE id = %s", (command_id,))
+                row = cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Error reading command status: {str(e)}")
+            return None
+    
     def _update_command_status(self, command_id: int, status: str, error_message: str = None):
         """Update command status in database.
         
         Args:
             command_id: Database ID of the command
-            status: New status ('executed', 'failed', 'pending')
+            status: New status ('executed', 'failed', 'expired', 'pending')
             error_message: Error message if failed
         """
         try:
@@ -291,24 +1387,46 @@ class CommandQueue:
             logger.error(f"Error updating command status: {str(e)}")
 
 
-# Create global command queue instance
-command_queue_instance = CommandQueue()
-
-# Start the queue automatically
-command_queue_instance.start()
+# Create global command queue instance; its lanes follow the device routing table.
+# REDRAT_QUEUE_BACKEND=mysql shares one durable backlog between processes, of
+# which one (the dispatcher lease holder) dispatches at a time. With
+# REDRAT_GATEWAY_ADDRESS set, web processes hand all work to the device gateway
+# (gateway.py) instead of talking to devices themselves.
+GATEWAY_ADDRESS = os.getenv('REDRAT_GATEWAY_ADDRESS')
+if GATEWAY_ADDRESS and os.getenv('REDRAT_GATEWAY_ROLE') != 'server':
+    from app.services.device_gateway import GatewayClient
+    command_queue_instance = GatewayClient(GATEWAY_ADDRESS)
+    device_router.add_listener(command_queue_instance.refresh_devices)
+else:
+    command_queue_instance = CommandQueue(
+        backend=create_queue_backend(db),
+        max_claimed=int(os.getenv('REDRAT_QUEUE_MAX_CLAIMED', '32')),
+        retention=int(os.getenv('REDRAT_QUEUE_RETENTION', '86400')),
+        tenant_weights=parse_tenant_weights(os.getenv('REDRAT_TENANT_WEIGHTS', '')),
+        lane_capacity=int(os.getenv('REDRAT_LANE_CAPACITY', '100')),
+        service_time=float(os.getenv('REDRAT_SERVICE_TIME', '0.5')),
+        coalesce_window=float(os.getenv('REDRAT_COALESCE_WINDOW_MS', '0')) / 1000.0,
+        press_interval_ms=int(os.getenv('REDRAT_PRESS_INTERVAL_MS', '400'))
+    )
+    device_router.add_listener(command_queue_instance.reconcile_lanes)
+    
+    # Start the queue automatically; with a durable backend, processes started
+    # with REDRAT_QUEUE_DISPATCH=0 only enqueue and leave dispatching to others
+    if not command_queue_instance.backend or os.getenv('REDRAT_QUEUE_DISPATCH', '1') != '0':
+        command_queue_instance.start()
 
 # Legacy compatibility functions
-def add_command(cmd: Dict[str, Any]) -> bool:
+def add_command(cmd: Dict[str, Any]) -> Optional[CommandHandle]:
     """Add command to the global command queue (legacy compatibility)."""
     return command_queue_instance.add_command(cmd)
 
-def add_sequence(seq: Dict[str, Any]) -> bool:
+def add_sequence(seq: Dict[str, Any]) -> Optional[CommandHandle]:
     """Add sequence to the global command queue."""
     return command_queue_instance.add_sequence(seq)
 
-# Export the queue for backwards compatibility
-command_queue = command_queue_instance.queue
-lock = command_queue_instance.lock
+# Export the queue for backwards compatibility (None when using the gateway)
+command_queue = getattr(command_queue_instance, 'queue', None)
+lock = getattr(command_queue_instance, 'lock', None)
 
 def process_queue():
     """Process the global command queue for backwards compatibility."""
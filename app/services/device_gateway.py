@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+
+"""Device gateway for the RedRat Proxy project.
+
+The gateway process (gateway.py) owns the command queue, the device lanes
+and every IRNetBox session, so port timing, signal alternation and toggle
+state live in exactly one place. Web workers started with
+REDRAT_GATEWAY_ADDRESS use GatewayClient, which stands in for the local
+CommandQueue and forwards work over a Unix socket or TCP connection.
+
+Protocol: one JSON object per line. Requests are {"id", "method", "params"}
+and are answered with {"id", "result"} or {"id", "error"}. For every queued
+command or sequence the gateway later pushes {"event": "done", "kind",
+"item_id", "outcome"} on the same connection, so clients learn results
+without polling. Requests are pipelined: the client writes everything that
+is pending in one batch and matches replies by id.
+"""
+
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from app.utils.logger import logger
+except ImportError:
+    logger = logging.getLogger("redrat_gateway")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+from app.services.command_queue import CommandHandle, QueueSaturatedError
+from app.services.device_router import device_router
+
+
+class GatewayError(Exception):
+    """Raised when the gateway cannot be reached or rejects a request."""
+    pass
+
+
+def parse_address(address: str) -> Tuple[int, Any]:
+    """Parse a gateway address: 'unix:/path', '/path' or 'host:port'.
+
+    Returns:
+        (socket family, socket address)
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"Invalid gateway address '{address}' (expected unix:/path or host:port)")
+    return socket.AF_INET, (host, int(port))
+
+
+def _encode(message: Dict[str, Any]) -> bytes:
+    """Serialize one protocol message as a JSON line."""
+    return (json.dumps(message, default=str) + '\n').encode('utf-8')
+
+
+def _decode_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Restore a queue item after JSON transport (port_power is keyed by port number)."""
+    if item.get('port_power'):
+        item['port_power'] = {int(port): power for port, power in item['port_power'].items()}
+    return item
+
+
+def _error_payload(error: Exception) -> Dict[str, Any]:
+    """Describe an exception for the client."""
+    payload = {'type': type(error).__name__, 'message': str(error)}
+    if isinstance(error, QueueSaturatedError):
+        payload['retry_after'] = error.retry_after
+        payload['device_id'] = error.device_id
+    return payload
+
+
+class GatewayServer:
+    """Serves a CommandQueue to web workers over a Unix socket or TCP."""
+
+    def __init__(self, command_queue, address: str):
+        """
+        Args:
+            command_queue: CommandQueue that executes the work
+            address: Listen address ('unix:/path', '/path' or 'host:port')
+        """
+        self.command_queue = command_queue
+        self.address = address
+        self.running = False
+        self._sock = None
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def serve_forever(self):
+        """Accept client connections until shutdown() is called."""
+        family, addr = parse_address(self.address)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.unlink(addr)  # Stale socket of a previous run
+        else:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(addr)
+        self._sock.listen(64)
+        self.running = True
+        logger.info(f"Device gateway listening on {self.address}")
+
+        while self.running:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break  # Socket closed by shutdown()
+            connection = _GatewayConnection(self, conn)
+            with self._lock:
+                self._connections.add(connection)
+            threading.Thread(target=connection.serve, daemon=True, name="redrat-gateway-conn").start()
+
+    def shutdown(self):
+        """Stop accepting connections and close the open ones."""
+        self.running = False
+        if self._sock:
+            self._sock.close()
+        with self._lock:
+            connections, self._connections = list(self._connections), set()
+        for connection in connections:
+            connection.close()
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+        logger.info("Device gateway stopped")
+
+    def _forget(self, connection: '_GatewayConnection'):
+        with self._lock:
+            self._connections.discard(connection)
+
+
+class _GatewayConnection:
+    """One web worker connection to the gateway."""
+
+    def __init__(self, server: GatewayServer, conn: socket.socket):
+        self.server = server
+        self.conn = conn
+        self.open = True
+        self._write_lock = threading.Lock()
+
+    def serve(self):
+        """Answer requests until the client disconnects."""
+        try:
+            with self.conn.makefile('rb') as reader:
+                for line in reader:
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                    except ValueError as e:
+                        logger.warning(f"Ignoring malformed gateway request: {str(e)}")
+                        continue
+                    if request.get('method') == 'wait_for_command':
+                        # Long polls must not hold up the requests behind them
+                        threading.Thread(target=self._handle, args=(request,), daemon=True).start()
+                    else:
+                        self._handle(request)
+        except OSError:
+            pass
+        finally:
+            self.close()
+            self.server._forget(self)
+
+    def close(self):
+        self.open = False
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+    def send(self, message: Dict[str, Any]):
+        """Write a message to the client; a closed connection drops it."""
+        if not self.open:
+            return
+        data = _encode(message)
+        try:
+            with self._write_lock:
+                self.conn.sendall(data)
+        except OSError:
+            self.close()
+
+    def _handle(self, request: Dict[str, Any]):
+        try:
+            result = self._call(request.get('method'), request.get('params') or {})
+        except Exception as e:
+            if not isinstance(e, QueueSaturatedError):
+                logger.error(f"Gateway request {request.get('method')} failed: {str(e)}")
+            self.send({'id': request.get('id'), 'error': _error_payload(e)})
+            return
+        
+        if not isinstance(result, CommandHandle):
+            self.send({'id': request.get('id'), 'result': result})
+            return
+        # Reply before subscribing, so the client knows the item before its outcome arrives
+        self.send({'id': request.get('id'), 'result': {'kind': result.kind, 'item_id': result.item_id}})
+        result.add_done_callback(self._push_done)
+
+    def _call(self, method: str, params: Dict[str, Any]):
+        """Run a request; queueing methods return the item's CommandHandle."""
+        queue = self.server.command_queue
+        if method == 'add_command':
+            return queue.add_command(_decode_item(params['item']))
+        if method == 'add_sequence':
+            return queue.add_sequence(params['item'])
+        if method == 'subscribe':
+            return queue.get_handle(params['item_id'], params.get('kind', 'command'))
+        if method == 'check_admission':
+            queue.check_admission(params.get('device_id'), params.get('deadline'))
+            return True
+        if method == 'wait_for_command':
+            return queue.wait_for_command(params['command_id'], float(params.get('timeout', 30)))
+        if method == 'get_stats':
+            return queue.get_stats()
+        if method == 'refresh_devices':
+            device_router.refresh()
+            return True
+        raise GatewayError(f"Unknown gateway method '{method}'")
+
+    def _push_done(self, handle: CommandHandle):
+        self.send({'event': 'done', 'kind': handle.kind, 'item_id': handle.item_id, 'outcome': handle.to_dict()})
+
+
+class RemoteHandle:
+    """Client-side CommandHandle of an item queued on the gateway."""
+
+    def __init__(self, kind: str, item_id: Any):
+        self.kind = kind
+        self.item_id = item_id
+        self.completed_at = None
+        self._outcome = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def done(self) -> bool:
+        """Whether the gateway reported the item as finished."""
+        return self._event.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until the item has finished or timeout seconds passed."""
+        return self._event.wait(timeout)
+
+    def add_done_callback(self, callback):
+        """Call callback(handle) once the item has finished (immediately if it has)."""
+        with self._callbacks_lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Get the outcome in API form (see CommandHandle.to_dict)."""
+        if self._outcome is not None:
+            return self._outcome
+        return {'done': False, 'status': 'queued', 'success': False, 'message': '', 'result': None}
+
+    def _resolve(self, outcome: Dict[str, Any]):
+        self._outcome = outcome
+        self.completed_at = time.monotonic()
+        with self._callbacks_lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Gateway handle callback failed: {str(e)}")
+
+
+class _PendingCall:
+    """Reply slot of a request in flight."""
+
+    def __init__(self, track: bool = False):
+        self.event = threading.Event()
+        self.reply = None
+        self.track = track  # The reply names a queued item whose handle is registered on arrival
+        self.handle = None
+
+
+class GatewayClient:
+    """Stand-in for CommandQueue in web workers, forwarding to the device gateway.
+
+    Keeps one connection per process. Requests from all threads are written
+    by a single writer thread, which sends whatever is pending in one batch;
+    a reader thread matches replies to requests and resolves RemoteHandles
+    from the gateway's completion events. After a reconnect, handles still
+    waiting are subscribed again.
+    """
+
+    def __init__(self, address: str, timeout: float = 10.0, handle_retention: float = 300.0):
+        """
+        Args:
+            address: Gateway address ('unix:/path', '/path' or 'host:port')
+            timeout: Seconds to wait for connection setup and replies
+            handle_retention: Seconds a finished RemoteHandle is kept for wait_for_command
+        """
+        self.address = address
+        self.timeout = timeout
+        self.handle_retention = handle_retention
+        self._lock = threading.Lock()  # Guards the connection and the pending calls
+        self._sock = None
+        self._ids = itertools.count(1)
+        self._calls = {}  # Key: request id, Value: _PendingCall
+        self._outbox = []
+        self._out_cond = threading.Condition()
+        self._handles = OrderedDict()  # Key: (kind, item ID), Value: RemoteHandle, oldest first
+        self._handles_lock = threading.Lock()
+        self._writer_thread = threading.Thread(target=self._write_loop, daemon=True, name="redrat-gateway-writer")
+        self._writer_thread.start()
+
+    def add_command(self, command: Dict[str, Any]) -> Optional[RemoteHandle]:
+        """Queue a command on the gateway (see CommandQueue.add_command).
+
+        Raises:
+            QueueSaturatedError: If the target device's lane is full
+        """
+        return self._add('add_command', command)
+
+    def add_sequence(self, sequence: Dict[str, Any]) -> Optional[RemoteHandle]:
+        """Queue a sequence on the gateway (see CommandQueue.add_sequence).
+
+        Raises:
+            QueueSaturatedError: If the target device's lane is full
+        """
+        return self._add('add_sequence', sequence)
+
+    def check_admission(self, device_id: int = None, deadline: float = None):
+        """Check the target device's lane on the gateway (see CommandQueue.check_admission).
+
+        An unreachable gateway admits the request; queueing it reports the failure.
+
+        Raises:
+            QueueSaturatedError: With the estimated seconds until there is room
+        """
+        try:
+            self._call('check_admission', {'device_id': device_id, 'deadline': deadline})
+        except GatewayError as e:
+            logger.error(f"Gateway admission check failed: {str(e)}")
+
+    def get_handle(self, item_id: Any, kind: str = 'command') -> Optional[RemoteHandle]:
+        """Get the handle of an item queued through this client, if still retained."""
+        with self._handles_lock:
+            return self._handles.get((kind, item_id))
+
+    def wait_for_command(self, command_id: Any, timeout: float,
+                         db_poll_interval: float = 0.5) -> Optional[Dict[str, Any]]:
+        """Wait until a command has finished (see CommandQueue.wait_for_command).
+
+        Commands queued through this client wait on their pushed outcome;
+        others are waited for by the gateway.
+        """
+        handle = self.get_handle(command_id)
+        if handle:
+            handle.wait(timeout)
+            return handle.to_dict()
+        try:
+            return self._call('wait_for_command', {'command_id': command_id, 'timeout': timeout},
+                              timeout=timeout + self.timeout)
+        except GatewayError as e:
+            logger.error(f"Gateway wait for command {command_id} failed: {str(e)}")
+            return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the gateway's queue statistics."""
+        try:
+            stats = self._call('get_stats', {})
+        except GatewayError as e:
+            return {'gateway': self.address, 'error': str(e)}
+        stats['gateway'] = self.address
+        return stats
+
+    def refresh_devices(self, devices: List[Dict[str, Any]] = None):
+        """Ask the gateway to reload the device routing table (device_router listener)."""
+        try:
+            self._call('refresh_devices', {})
+        except GatewayError as e:
+            logger.error(f"Gateway device refresh failed: {str(e)}")
+
+    def _add(self, method: str, item: Dict[str, Any]) -> Optional[RemoteHandle]:
+        try:
+            return self._call(method, {'item': item}, track=True)
+        except GatewayError as e:
+            logger.error(f"Error queuing on device gateway: {str(e)}")
+            return None
+
+    def _track(self, kind: str, item_id: Any) -> RemoteHandle:
+        """Register the handle of a queued item, dropping finished handles past retention."""
+        now = time.monotonic()
+        with self._handles_lock:
+            handle = self._handles.get((kind, item_id))
+            if handle is None or handle.done():
+                handle = self._handles[(kind, item_id)] = RemoteHandle(kind, item_id)
+                self._handles.move_to_end((kind, item_id))
+            for key in list(self._handles):
+                oldest = self._handles[key]
+                if not oldest.done() or now - oldest.completed_at < self.handle_retention:
+                    break
+                del self._handles[key]
+        return handle
+
+    def _call(self, method: str, params: Dict[str, Any], timeout: float = None, track: bool = False):
+        """Send a request and wait for its reply.
+
+        With track, the reply names a queued item: the reader registers its
+        RemoteHandle before reading on, so the item's done event, which the
+        gateway sends right after the reply, always finds the handle.
+
+        Returns:
+            The result, or with track the item's RemoteHandle (None if not queued)
+
+        Raises:
+            GatewayError: If the gateway is unreachable, times out or fails
+            QueueSaturatedError: If the gateway refused the work
+        """
+        self._ensure_connected()
+        call = _PendingCall(track)
+        call_id = next(self._ids)
+        with self._lock:
+            self._calls[call_id] = call
+        with self._out_cond:
+            self._outbox.append(_encode({'id': call_id, 'method': method, 'params': params}))
+            self._out_cond.notify()
+
+        if not call.event.wait(timeout or self.timeout):
+            with self._lock:
+                self._calls.pop(call_id, None)
+            raise GatewayError(f"Device gateway did not answer {method} within {timeout or self.timeout}s")
+
+        reply = call.reply
+        if 'error' not in reply:
+            return call.handle if track else reply.get('result')
+        error = reply['error'] or {}
+        if error.get('type') == 'QueueSaturatedError':
+            raise QueueSaturatedError(error.get('message', ''), error.get('retry_after', 1), error.get('device_id'))
+        raise GatewayError(error.get('message') or 'Device gateway request failed')
+
+    def _ensure_connected(self):
+        """Connect to the gateway if not connected, resubscribing unfinished handles."""
+        with self._lock:
+            if self._sock is not None:
+                return
+            family, addr = parse_address(self.address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(addr)
+            except OSError as e:
+                sock.close()
+                raise GatewayError(f"Cannot connect to device gateway at {self.address}: {str(e)}")
+            sock.settimeout(None)
+            self._sock = sock
+        threading.Thread(target=self._read_loop, args=(sock,), daemon=True, name="redrat-gateway-reader").start()
+        logger.info(f"Connected to device gateway at {self.address}")
+
+        with self._handles_lock:
+            waiting = [handle for handle in self._handles.values() if not handle.done()]
+        if waiting:
+            with self._out_cond:
+                for handle in waiting:
+                    self._outbox.append(_encode({'id': None, 'method': 'subscribe',
+                                                 'params': {'kind': handle.kind, 'item_id': handle.item_id}}))
+                self._out_cond.notify()
+
+    def _disconnect(self, sock: socket.socket, reason: str):
+        """Drop a broken connection and fail the calls waiting on it."""
+        with self._lock:
+            if self._sock is not sock:
+                return
+            self._sock = None
+            calls, self._calls = self._calls, {}
+        try:
+            sock.close()
+        except OSError:
+            pass
+        logger.warning(f"Device gateway connection lost: {reason}")
+        for call in calls.values():
+            call.reply = {'error': {'type': 'GatewayError', 'message': f"Connection lost: {reason}"}}
+            call.event.set()
+
+    def _write_loop(self):
+        """Send queued requests, batching everything pending into one write."""
+        while True:
+            with self._out_cond:
+                while not self._outbox:
+                    self._out_cond.wait()
+                batch, self._outbox = self._outbox, []
+            with self._lock:
+                sock = self._sock
+            if sock is None:
+                continue  # Callers time out or reconnect
+            try:
+                sock.sendall(b''.join(batch))
+            except OSError as e:
+                self._disconnect(sock, str(e))
+
+    def _read_loop(self, sock: socket.socket):
+        """Dispatch replies and completion events from the gateway."""
+        reason = 'closed by gateway'
+        try:
+            with sock.makefile('rb') as reader:
+                for line in reader:
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        continue
+                    if message.get('event') == 'done':
+                        handle = self.get_handle(message.get('item_id'), message.get('kind', 'command'))
+                        if handle and not handle.done():
+                            handle._resolve(message.get('outcome') or {})
+                        continue
+                    with self._lock:
+                        call = self._calls.pop(message.get('id'), None)
+                    if call:
+                        queued = message.get('result')
+                        if call.track and queued:
+                            call.handle = self._track(queued['kind'], queued['item_id'])
+                        call.reply = message
+                        call.event.set()
+        except OSError as e:
+            reason = str(e)
+        self._disconnect(sock, reason)
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""RedRat device routing table for the RedRat Proxy project.
+
+Keeps the active rows of redrat_devices in memory so the command queue can
+route a command to its requested device with a dictionary lookup instead of
+querying the database per command. The table is refreshed when devices are
+created, updated or deleted and by the queue's periodic reconcile; listeners
+(the command queue) are told about every refresh so device lanes follow it.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from app.utils.logger import logger
+except ImportError:
+    logger = logging.getLogger("redrat_router")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+
+class DeviceRouter:
+    """In-memory table of active RedRat devices keyed by redrat_devices.id."""
+
+    def __init__(self, miss_refresh_interval: float = 2.0):
+        """
+        Args:
+            miss_refresh_interval: Minimum seconds between refreshes triggered
+                by a request for a device that is not in the table
+        """
+        self.miss_refresh_interval = miss_refresh_interval
+        self._lock = threading.Lock()
+        self._devices = {}  # Key: device id, Value: device dict (RedRatDevice.to_dict)
+        self._refreshed_at = 0.0
+        self._listeners = []
+
+    def add_listener(self, listener: Callable[[List[Dict[str, Any]]], None]):
+        """Register a callable invoked with the active devices after every refresh."""
+        self._listeners.append(listener)
+
+    def refresh(self, devices: List[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Reload the table and notify listeners.
+
+        Args:
+            devices: Device dicts to use instead of reading redrat_devices
+
+        Returns:
+            Active devices now in the table
+        """
+        if devices is None:
+            devices = self._load_devices()
+        active = {int(d['id']): d for d in devices if d.get('is_active', False)}
+
+        with self._lock:
+            added = set(active) - set(self._devices)
+            removed = set(self._devices) - set(active)
+            self._devices = active
+            self._refreshed_at = time.monotonic()
+        if added or removed:
+            logger.info(f"Device routing table refreshed: {len(active)} active "
+                        f"(added {sorted(added)}, removed {sorted(removed)})")
+
+        active_devices = list(active.values())
+        for listener in self._listeners:
+            try:
+                listener(active_devices)
+            except Exception as e:
+                logger.error(f"Device router listener failed: {str(e)}")
+        return active_devices
+
+    def get(self, device_id: int) -> Optional[Dict[str, Any]]:
+        """Get an active device by ID."""
+        with self._lock:
+            return self._devices.get(int(device_id))
+
+    def active_devices(self) -> List[Dict[str, Any]]:
+        """Get all active devices."""
+        with self._lock:
+            return list(self._devices.values())
+
+    def route(self, device_id: int = None, load: Callable[[int], int] = None) -> Optional[Dict[str, Any]]:
+        """Choose the device for a command.
+
+        Args:
+            device_id: Requested redrat_devices.id; only that device is eligible
+            load: Callable returning the queued work of a device ID; without a
+                requested device the least-loaded active device is chosen
+
+        Returns:
+            Device dict, or None if the requested device is unknown or inactive
+            or no device is active
+        """
+        self._ensure_loaded()
+
+        if device_id is not None:
+            device = self.get(device_id)
+            if device is None and self._refresh_on_miss():
+                device = self.get(device_id)
+            if device is None:
+                logger.warning(f"RedRat device {device_id} is not active or does not exist")
+            return device
+
+        with self._lock:
+            devices = list(self._devices.values())
+        if not devices and self._refresh_on_miss():
+            devices = self.active_devices()
+        if not devices:
+            logger.warning("No active RedRat devices found")
+            return None
+
+        load = load or (lambda _device_id: 0)
+        return min(devices, key=lambda d: (load(int(d['id'])), int(d['id'])))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get table size and age."""
+        with self._lock:
+            return {
+                'active_devices': sorted(self._devices),
+                'age': round(time.monotonic() - self._refreshed_at, 3) if self._refreshed_at else None
+            }
+
+    def _ensure_loaded(self):
+        """Load the table on first use."""
+        if not self._refreshed_at:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error loading device routing table: {str(e)}")
+
+    def _refresh_on_miss(self) -> bool:
+        """Refresh after a lookup miss, at most once per miss_refresh_interval.
+
+        Returns:
+            True if the table was refreshed
+        """
+        if time.monotonic() - self._refreshed_at < self.miss_refresh_interval:
+            return False
+        try:
+            self.refresh()
+            return True
+        except Exception as e:
+            logger.error(f"Error refreshing device routing table: {str(e)}")
+            return False
+
+    def _load_devices(self) -> List[Dict[str, Any]]:
+        """Read redrat_devices (no status probing, unlike get_all_devices)."""
+        from app.models.redrat_device import RedRatDevice
+        return [device.to_dict() for device in RedRatDevice.get_all()]
+
+
+# Global routing table shared by the command queue and device service
+device_router = DeviceRouter()
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+"""MySQL-backed command queue storage for the RedRat Proxy project.
+
+With REDRAT_QUEUE_BACKEND=mysql, queued commands and sequences are stored in
+the command_queue table instead of process memory, so they survive restarts
+and several processes or hosts can enqueue into one backlog. Rows are
+claimed with SELECT ... FOR UPDATE SKIP LOCKED and held under a lease; rows
+whose lease expires (e.g. the claiming process died) are handed out again,
+up to max_attempts times. Delivery is at-least-once.
+
+Device lanes keep per-device state in memory (MK-IV port cooldowns,
+alternation of double signals), so only one process dispatches at a time:
+the holder of the dispatcher lease in command_queue_dispatcher. Other
+processes only enqueue and take over once the holder stops renewing it. To
+spread devices over several processes, point them at a device gateway
+(REDRAT_GATEWAY_ADDRESS) instead.
+"""
+
+import json
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from app.utils.logger import logger
+except ImportError:
+    logger = logging.getLogger("redrat_queue")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+
+class MySQLQueueBackend:
+    """Queue rows in the command_queue table, claimed under a lease."""
+
+    def __init__(self, db, lease_seconds: float = 60.0, max_attempts: int = 3, consumer_id: str = None):
+        """
+        Args:
+            db: Database with a get_connection() context manager
+            lease_seconds: How long a claimed row stays invisible to other dispatchers
+                without its lease being renewed
+            max_attempts: Claims after which an unfinished row is marked failed
+            consumer_id: Name recorded in claimed_by (defaults to host:pid:random)
+        """
+        self.db = db
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.consumer_id = consumer_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def put(self, item: Dict[str, Any], priority: int = 0) -> int:
+        """Store a queued command or sequence.
+
+        Args:
+            item: Queue item; its 'deadline' (epoch seconds) is stored for ordering
+            priority: Priority rank, lower is served first
+
+        Returns:
+            command_queue row ID
+        """
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            deadline = item.get('deadline')
+            cursor.execute("""
+                INSERT INTO command_queue (item_type, payload, redrat_device_id, priority, deadline)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (item.get('type', 'command'), json.dumps(item), item.get('redrat_device_id'),
+                  priority,
+                  datetime.fromtimestamp(deadline) if deadline is not None else None))
+            conn.commit()
+            return cursor.lastrowid
+
+    def claim(self, limit: int) -> List[Tuple[int, Dict[str, Any]]]:
+        """Atomically claim up to limit queued rows, or rows whose lease expired.
+
+        Rows are taken by priority class, then earliest deadline, then age.
+
+        Returns:
+            List of (row ID, item) in that order
+        """
+        if limit <= 0:
+            return []
+
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT id, payload, attempts
+                    FROM command_queue
+                    WHERE status = 'queued'
+                       OR (status = 'claimed' AND lease_expires_at < NOW(3))
+                    ORDER BY priority, deadline IS NULL, deadline, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                """, (int(limit),))
+                rows = cursor.fetchall()
+
+                claimed = []
+                exhausted = []
+                for row_id, payload, attempts in rows:
+                    if attempts >= self.max_attempts:
+                        exhausted.append(row_id)
+                    else:
+                        claimed.append((row_id, self._decode(payload)))
+
+                if claimed:
+                    placeholders = ', '.join(['%s'] * len(claimed))
+                    cursor.execute(f"""
+                        UPDATE command_queue
+                        SET status = 'claimed', claimed_by = %s, attempts = attempts + 1,
+                            lease_expires_at = NOW(3) + INTERVAL %s MICROSECOND
+                        WHERE id IN ({placeholders})
+                    """, (self.consumer_id, int(self.lease_seconds * 1000000), *[row_id for row_id, _ in claimed]))
+                if exhausted:
+                    placeholders = ', '.join(['%s'] * len(exhausted))
+                    cursor.execute(f"""
+                        UPDATE command_queue
+                        SET status = 'failed', completed_at = NOW(3),
+                            last_error = 'Lease expired too many times'
+                        WHERE id IN ({placeholders})
+                    """, tuple(exhausted))
+                    logger.warning(f"Queue rows {exhausted} failed after {self.max_attempts} attempts")
+
+                conn.commit()
+                return claimed
+            except Exception:
+                conn.rollback()
+                raise
+
+    def acquire_dispatcher(self) -> bool:
+        """Take or renew the dispatcher lease.
+
+        Returns:
+            True if this process is the dispatcher, False if another process
+            holds an unexpired lease
+        """
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            # Assignments apply left to right: the lease is extended only if
+            # claimed_by is (now) this process
+            cursor.execute("""
+                INSERT INTO command_queue_dispatcher (id, claimed_by, lease_expires_at)
+                VALUES (1, %s, NOW(3) + INTERVAL %s MICROSECOND)
+                ON DUPLICATE KEY UPDATE
+                    claimed_by = IF(claimed_by = VALUES(claimed_by) OR lease_expires_at < NOW(3),
+                                    VALUES(claimed_by), claimed_by),
+                    lease_expires_at = IF(claimed_by = VALUES(claimed_by),
+                                          VALUES(lease_expires_at), lease_expires_at)
+            """, (self.consumer_id, int(self.lease_seconds * 1000000)))
+            cursor.execute("SELECT claimed_by FROM command_queue_dispatcher WHERE id = 1")
+            row = cursor.fetchone()
+            conn.commit()
+            return bool(row) and row[0] == self.consumer_id
+
+    def release_dispatcher(self):
+        """Give up the dispatcher lease so another process can take over at once."""
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM command_queue_dispatcher WHERE id = 1 AND claimed_by = %s",
+                           (self.consumer_id,))
+            conn.commit()
+
+    def renew(self, row_ids: List[int]):
+        """Extend the lease of rows this dispatcher is still working on."""
+        if not row_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(row_ids))
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE command_queue
+                SET lease_expires_at = NOW(3) + INTERVAL %s MICROSECOND
+                WHERE claimed_by = %s AND status = 'claimed' AND id IN ({placeholders})
+            """, (int(self.lease_seconds * 1000000), self.consumer_id, *row_ids))
+            conn.commit()
+
+    def complete(self, row_id: int, error: str = None, status: str = None):
+        """Mark a claimed row as done, or failed if error is given.
+
+        Args:
+            row_id: command_queue row ID
+            error: Failure reason
+            status: Final status overriding done/failed (e.g. 'expired')
+        """
+        status = status or ('failed' if error else 'done')
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE command_queue
+                SET status = %s, completed_at = NOW(3), last_error = %s
+                WHERE id = %s AND claimed_by = %s
+            """, (status, error, row_id, self.consumer_id))
+            conn.commit()
+
+    def statuses(self, row_ids: List[int]) -> Dict[int, Tuple[str, Optional[str]]]:
+        """Get the status and last error of rows, e.g. to follow items another process runs.
+
+        Returns:
+            Dict of row ID to (status, last_error); purged rows are missing
+        """
+        if not row_ids:
+            return {}
+        placeholders = ', '.join(['%s'] * len(row_ids))
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT id, status, last_error FROM command_queue WHERE id IN ({placeholders})
+            """, tuple(row_ids))
+            return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+    def release(self, row_ids: List[int]):
+        """Return claimed rows that were not started to the queue (e.g. on shutdown)."""
+        if not row_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(row_ids))
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE command_queue
+                SET status = 'queued', claimed_by = NULL, lease_expires_at = NULL,
+                    attempts = GREATEST(attempts - 1, 0)
+                WHERE claimed_by = %s AND status = 'claimed' AND id IN ({placeholders})
+            """, (self.consumer_id, *row_ids))
+            conn.commit()
+
+    def purge_finished(self, older_than_seconds: int = 86400) -> int:
+        """Delete done and failed rows older than the given age.
+
+        Returns:
+            Number of rows deleted
+        """
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM command_queue
+                WHERE status IN ('done', 'failed', 'expired')
+                  AND completed_at < NOW(3) - INTERVAL %s SECOND
+            """, (int(older_than_seconds),))
+            conn.commit()
+            return cursor.rowcount
+
+    def backlog(self, redrat_device_id: int = None) -> int:
+        """Count rows waiting or executing, for one requested device or in total.
+        
+        Rows without a requested device are counted for every device, since
+        any of them may end up running them.
+        """
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if redrat_device_id is None:
+                cursor.execute("SELECT COUNT(*) FROM command_queue WHERE status IN ('queued', 'claimed')")
+            else:
+                cursor.execute("""
+                    SELECT COUNT(*) FROM command_queue
+                    WHERE status IN ('queued', 'claimed')
+                      AND (redrat_device_id = %s OR redrat_device_id IS NULL)
+                """, (redrat_device_id,))
+            return cursor.fetchone()[0]
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get row counts per status."""
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT status, COUNT(*) FROM command_queue GROUP BY status")
+            counts = {status: count for status, count in cursor.fetchall()}
+        return {
+            'backend': 'mysql',
+            'consumer_id': self.consumer_id,
+            'rows': counts
+        }
+
+    def _decode(self, payload) -> Dict[str, Any]:
+        """Turn a stored JSON payload back into a queue item."""
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode('utf-8')
+        item = json.loads(payload) if isinstance(payload, str) else dict(payload)
+        # JSON object keys are strings; port_power is keyed by port number
+        if item.get('port_power'):
+            item['port_power'] = {int(port): power for port, power in item['port_power'].items()}
+        return item
+
+
+def create_queue_backend(db) -> Optional[MySQLQueueBackend]:
+    """Create the durable backend selected by REDRAT_QUEUE_BACKEND (None for in-memory)."""
+    backend = os.getenv('REDRAT_QUEUE_BACKEND', 'memory').lower()
+    if backend != 'mysql':
+        return None
+    return MySQLQueueBackend(
+        db,
+        lease_seconds=float(os.getenv('REDRAT_QUEUE_LEASE', '60')),
+        max_attempts=int(os.getenv('REDRAT_QUEUE_MAX_ATTEMPTS', '3'))
+    )
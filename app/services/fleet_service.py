@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""Fleet runs for the RedRat Proxy project.
+
+A fleet run executes one sequence on many targets - (RedRat device, IR
+port) pairs, typically one set-top box per port - at once. Targets are
+grouped per device into queue items of at most device_limit ports; a
+device lane runs such an item as one compiled plan fanned out over its
+ports (interleaved on the device's session), and lanes of different
+devices run in parallel, so a fleet run takes about as long as one run.
+
+Runs are tracked in this process for progress reporting. Per-step
+progress is recorded when the sequence executes in this process; with a
+device gateway or a shared MySQL queue only the completion of each queue
+item is seen here.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from app.utils.logger import logger
+except ImportError:
+    logger = logging.getLogger("redrat_fleet")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+
+class FleetRun:
+    """One sequence executed on a set of (device, port) targets."""
+
+    def __init__(self, sequence_id: Any, steps_per_target: int, targets: List[Dict[str, int]], user_id: Any = None):
+        self.run_id = uuid.uuid4().hex
+        self.sequence_id = sequence_id
+        self.steps_per_target = steps_per_target
+        self.user_id = user_id
+        self.started_at = time.monotonic()
+        self.completed_at = None
+        self._lock = threading.Lock()
+        self._targets = OrderedDict()  # Key: (device_id, ir_port), Value: target progress
+        for target in targets:
+            self._targets[(target['redrat_device_id'], target['ir_port'])] = {
+                'redrat_device_id': target['redrat_device_id'],
+                'ir_port': target['ir_port'],
+                'status': 'queued',
+                'steps_sent': 0,
+                'steps_failed': 0,
+                'errors': []
+            }
+        self._chunks = []  # (device_id, ports, handle) per queued item
+        self._queued = False  # All chunks have been added
+
+    def add_chunk(self, device_id: int, ports: List[int], handle):
+        """Track the queue item running the given ports of a device (handle None = not queued)."""
+        with self._lock:
+            self._chunks.append((device_id, ports, handle))
+            if handle is None:
+                for port in ports:
+                    target = self._targets[(device_id, port)]
+                    target['status'] = 'failed'
+                    target['errors'].append('Failed to queue sequence')
+        if handle is not None:
+            handle.add_done_callback(lambda _: self._check_completed())
+
+    def finish_queueing(self):
+        """Mark the chunk list complete; the run finishes when its last item does."""
+        with self._lock:
+            self._queued = True
+        self._check_completed()
+
+    def _check_completed(self):
+        """Record the completion time once every queue item has finished."""
+        with self._lock:
+            if self.completed_at is None and self._done_locked():
+                self.completed_at = time.monotonic()
+
+    def _done_locked(self) -> bool:
+        return self._queued and all(handle is None or handle.done() for _, _, handle in self._chunks)
+
+    def progress_callback(self, device_id: int, ports: List[int]) -> Callable[[int, Optional[str]], None]:
+        """Callable recording a finished step (plan step index, error) of a queue item."""
+        def record(index: int, error: Optional[str]):
+            key = (device_id, ports[index // self.steps_per_target])
+            with self._lock:
+                target = self._targets.get(key)
+                if target is None:
+                    return
+                target['status'] = 'running'
+                if error:
+                    target['steps_failed'] += 1
+                    target['errors'].append(error)
+                else:
+                    target['steps_sent'] += 1
+        return record
+
+    def done(self) -> bool:
+        """Whether every queue item of the run has finished."""
+        with self._lock:
+            return self._done_locked()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Aggregated progress, with per-target results once items finish."""
+        with self._lock:
+            serial_ms = 0.0
+            for device_id, ports, handle in self._chunks:
+                if handle is None or not handle.done():
+                    continue
+                outcome = handle.to_dict()
+                result = outcome.get('result') or {}
+                serial_ms += (result.get('timing') or {}).get('serial_ms', 0.0)
+                finished = {t['ir_port']: t for t in result.get('targets') or []}
+                for port in ports:
+                    target = self._targets[(device_id, port)]
+                    if target['status'] in ('done', 'failed'):
+                        continue
+                    outcome_target = finished.get(port)
+                    if outcome_target:
+                        target['steps_sent'] = outcome_target['executed_commands']
+                        target['steps_failed'] = outcome_target['failed_commands']
+                        target['errors'] = [e['error'] for e in outcome_target['errors']]
+                        target['status'] = 'done' if outcome_target['success'] else 'failed'
+                    else:
+                        target['status'] = 'failed'
+                        target['errors'].append(outcome.get('message') or outcome.get('status') or 'Sequence failed')
+
+            targets = [dict(target, errors=list(target['errors'])) for target in self._targets.values()]
+            done = self._done_locked()
+            if done and self.completed_at is None:
+                self.completed_at = time.monotonic()
+            end = self.completed_at or time.monotonic()
+
+        return {
+            'run_id': self.run_id,
+            'sequence_id': self.sequence_id,
+            'done': done,
+            'targets_total': len(targets),
+            'targets_done': sum(1 for t in targets if t['status'] == 'done'),
+            'targets_failed': sum(1 for t in targets if t['status'] == 'failed'),
+            'steps_total': len(targets) * self.steps_per_target,
+            'steps_sent': sum(t['steps_sent'] for t in targets),
+            'steps_failed': sum(t['steps_failed'] for t in targets),
+            'elapsed_ms': round((end - self.started_at) * 1000, 3),
+            'serial_ms': round(serial_ms, 3),
+            'targets': targets
+        }
+
+
+class FleetRunRegistry:
+    """Fleet runs of this process, kept for retention seconds after they finish.
+
+    A run's completion time is recorded when its last queue item finishes,
+    whether or not anyone polls its progress.
+    """
+
+    def __init__(self, device_limit: int = 16, retention: float = 3600.0):
+        """
+        Args:
+            device_limit: Maximum targets of one device run concurrently
+                (one queue item); further targets queue behind them
+            retention: Seconds a finished run stays available
+        """
+        self.device_limit = max(1, device_limit)
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._runs = OrderedDict()  # Key: run_id, Value: FleetRun
+
+    def start(self, command_queue, sequence: Dict[str, Any], targets: List[Dict[str, int]],
+              queue_options: Dict[str, Any] = None, user_id: Any = None) -> FleetRun:
+        """Queue a sequence for every target.
+
+        Args:
+            command_queue: CommandQueue (or gateway client) to queue on
+            sequence: Dict with 'id', 'name' and 'commands'
+            targets: Dicts with 'redrat_device_id' and 'ir_port'
+            queue_options: 'priority', 'deadline' and 'tenant' of the items
+            user_id: Owner of the run
+
+        Returns:
+            FleetRun
+
+        Raises:
+            QueueSaturatedError: If a target device's lane is full; nothing is queued
+                (targets that no longer fit once queueing started are failed)
+        """
+        queue_options = queue_options or {}
+        run = FleetRun(sequence['id'], len(sequence['commands']), targets, user_id)
+
+        # One item per device per wave of distinct ports, at most device_limit each
+        chunks = []
+        for device_id in OrderedDict.fromkeys(t['redrat_device_id'] for t in targets):
+            waves = []
+            for port in (t['ir_port'] for t in targets if t['redrat_device_id'] == device_id):
+                wave = next((w for w in waves if port not in w and len(w) < self.device_limit), None)
+                if wave is None:
+                    wave = []
+                    waves.append(wave)
+                wave.append(port)
+            chunks.extend((device_id, wave) for wave in waves)
+
+        for device_id in OrderedDict.fromkeys(device_id for device_id, _ in chunks):
+            command_queue.check_admission(device_id, queue_options.get('deadline'))
+
+        self._add(run)  # Before queueing: lanes look the run up to report progress
+        for number, (device_id, ports) in enumerate(chunks):
+            try:
+                handle = command_queue.add_sequence({
+                    'id': sequence['id'],
+                    'name': sequence.get('name'),
+                    'commands': sequence['commands'],
+                    'redrat_device_id': device_id,
+                    'ports': ports,
+                    'fleet_run': run.run_id,
+                    **queue_options
+                })
+            except Exception as e:
+                if not number:
+                    with self._lock:
+                        self._runs.pop(run.run_id, None)
+                    raise  # Nothing queued yet: refuse the whole run
+                logger.error(f"Fleet run {run.run_id}: ports {ports} of device {device_id} not queued: {str(e)}")
+                handle = None
+            run.add_chunk(device_id, ports, handle)
+        run.finish_queueing()
+
+        logger.info(f"Fleet run {run.run_id}: sequence {sequence['id']} on {len(targets)} targets "
+                    f"in {len(chunks)} queue item(s)")
+        return run
+
+    def get(self, run_id: str) -> Optional[FleetRun]:
+        """Get a run by ID."""
+        with self._lock:
+            return self._runs.get(run_id)
+
+    def progress_callback(self, run_id: str, device_id: int,
+                          ports: List[int]) -> Optional[Callable[[int, Optional[str]], None]]:
+        """Step progress recorder of a queue item, if its run belongs to this process."""
+        run = self.get(run_id) if run_id else None
+        return run.progress_callback(device_id, ports) if run else None
+
+    def _add(self, run: FleetRun):
+        """Store a run, dropping finished runs past retention."""
+        now = time.monotonic()
+        with self._lock:
+            self._runs[run.run_id] = run
+            for run_id in list(self._runs):
+                oldest = self._runs[run_id]
+                if oldest.completed_at is None or now - oldest.completed_at < self.retention:
+                    break
+                del self._runs[run_id]
+
+
+# Global registry of fleet runs started in this process
+fleet_runs = FleetRunRegistry(
+    device_limit=int(os.getenv('REDRAT_FLEET_DEVICE_LIMIT', '16'))
+)
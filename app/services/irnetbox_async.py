@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+
+"""Asyncio IRNetBox client for the RedRat Proxy project.
+
+Offers the same operations as the blocking IRNetBox class (connect, async
+signal output, completion waiting, power/CPLD control, memory parameters
+and UDP discovery) on top of asyncio streams and datagram endpoints, so a
+single event loop can drive many IRNetBoxes without a thread per device.
+
+A connection is a demultiplexing session: a reader task routes request
+replies to waiters in FIFO order and MSG_ASYNC_COMPLETE frames to futures
+keyed by sequence number, so several async outputs on different ports of
+one MK-III/MK-IV can be outstanding over a single TCP connection.
+
+Message constants, IRSignal/OutputConfig and the protocol encoders are
+shared with irnetbox_lib_new.
+
+The command queue does not use this client: device lanes and sequence
+plans send over pooled blocking IRNetBox sessions (irnetbox_pool), one
+thread per device. It is meant for callers that run their own event loop.
+"""
+
+import asyncio
+import logging
+import struct
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from .irnetbox_lib_new import (
+    IRNetBox, IRNetBoxType, IRNetBoxError, IRSignal, OutputConfig, PowerLevel,
+    DeviceIdentity, SequenceAllocator, device_identity_cache,
+    encode_message, encode_signal, encode_output_mask, encode_async_output_message,
+    apply_toggle_state, cpld_power_instructions, normalize_post_delay,
+    parse_async_ack, parse_async_complete, parse_discovery_reply,
+    parse_serial_number, parse_memory_params, error_message,
+    device_type_from_firmware_id, device_type_from_label_reply, device_type_from_firmware_version
+)
+
+try:
+    from app.utils.logger import logger
+except ImportError:
+    logger = logging.getLogger("redrat_async")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+
+class _DatagramCollector(asyncio.DatagramProtocol):
+    """Datagram protocol that queues every received packet."""
+
+    def __init__(self):
+        self.packets = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.packets.put_nowait((data, addr))
+
+    def error_received(self, exc):
+        logger.debug(f"UDP discovery error: {exc}")
+
+
+async def _open_udp(broadcast: bool = False):
+    """Open a UDP endpoint that collects replies."""
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(
+        _DatagramCollector, local_addr=('0.0.0.0', 0), allow_broadcast=broadcast)
+
+
+async def discover_devices(timeout: float = 2.0) -> List[Dict[str, str]]:
+    """
+    Discover IRNetBox devices on the network via UDP broadcast.
+    Returns list of discovered devices with IP and MAC addresses.
+    """
+    devices = []
+    try:
+        transport, protocol = await _open_udp(broadcast=True)
+    except OSError as e:
+        raise IRNetBoxError(f"Device discovery failed: {e}")
+
+    try:
+        # Send discovery packet (0x00, 0x00, 0x00, 0xF6)
+        transport.sendto(struct.pack('>I', 0x000000F6), ('255.255.255.255', IRNetBox.UDP_DISCOVERY_PORT))
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                data, addr = await asyncio.wait_for(protocol.packets.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            device_info = parse_discovery_reply(data, addr[0])
+            if device_info:
+                devices.append(device_info)
+    finally:
+        transport.close()
+
+    return devices
+
+
+async def identify_device_type(ip_address: str, timeout: float = 2.0) -> IRNetBoxType:
+    """Identify the IRNetBox type using UDP 0xF6/0xE4 queries."""
+    transport = None
+    try:
+        transport, protocol = await _open_udp()
+        target = (ip_address, IRNetBox.UDP_DISCOVERY_PORT)
+
+        # First, get firmware type with 0xF6 query
+        transport.sendto(struct.pack('>I', 0x000000F6), target)
+        data, _ = await asyncio.wait_for(protocol.packets.get(), timeout)
+        if len(data) >= 6:
+            device_type = device_type_from_firmware_id(data[4:6].decode('ascii', errors='ignore'))
+            if device_type is None:
+                # Need further identification with 0xE4 query
+                transport.sendto(struct.pack('>I', 0x000000E4), target)
+                type_data, _ = await asyncio.wait_for(protocol.packets.get(), timeout)
+                device_type = device_type_from_label_reply(type_data)
+            return device_type
+
+    except Exception as e:
+        logger.warning(f"Could not identify device type for {ip_address}: {e}")
+    finally:
+        if transport:
+            transport.close()
+
+    return IRNetBoxType.UNKNOWN
+
+
+class AsyncIRNetBox:
+    """IRNetBox communication over asyncio streams.
+    
+    Usage, driving several ports concurrently over one connection:
+    
+        async with AsyncIRNetBox(ip) as ir:
+            await asyncio.gather(*(ir.send_and_wait(signal, [OutputConfig(port, PowerLevel.HIGH)])
+                                   for port in range(1, 17)))
+    """
+
+    # Minimum time between commands on the same MK-IV port (slow STBs)
+    PORT_COOLDOWN = IRNetBox.PORT_COOLDOWN
+
+    def __init__(self, ip_address: str = None, port: int = None, timeout: float = 5.0):
+        """
+        Args:
+            ip_address: Device IP address
+            port: Device TCP control port (defaults to 10001)
+            timeout: Seconds to wait for connect and for each reply
+        """
+        self.ip_address = ip_address
+        self.port = port or IRNetBox.TCP_CONTROL_PORT
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.device_type = IRNetBoxType.UNKNOWN
+        self.serial_number = None
+        self.firmware_version = None
+        self.identity_from_cache = False
+        self.toggle_states = {}  # Track toggle states per signal UID
+        self.port_last_used = {}  # Track when each port was last used for timing
+        self._sequence = SequenceAllocator()
+        self._reader_task = None
+        self._replies = deque()  # Futures for request replies, in send order
+        self._completions = {}  # Sequence number -> future resolved by MSG_ASYNC_COMPLETE
+        self._completed = deque(maxlen=256)  # Completions that arrived before anyone waited
+        self._port_busy = {}  # Port -> completion future of the output in flight on it
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    @property
+    def in_flight(self) -> int:
+        """Number of async outputs awaiting completion."""
+        return len(self._completions)
+
+    @property
+    def sends_completions(self) -> bool:
+        """Whether the device reports async output completion (MK-III)."""
+        return self.device_type == IRNetBoxType.MK_III
+
+    async def connect(self, ip_address: str = None, use_identity_cache: bool = True) -> bool:
+        """
+        Connect to IRNetBox via TCP and initialise it.
+
+        Args:
+            ip_address: Device IP address (defaults to the one given at construction)
+            use_identity_cache: Reuse a cached device identity to skip discovery
+                and the firmware/serial reads
+        """
+        if ip_address:
+            self.ip_address = ip_address
+
+        if not self.ip_address:
+            raise IRNetBoxError("No IP address specified")
+
+        identity = device_identity_cache.get(self.ip_address) if use_identity_cache else None
+        self._completed.clear()
+
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip_address, self.port), self.timeout)
+            self._reader_task = asyncio.ensure_future(self._read_loop())
+
+            if identity:
+                self.device_type = identity.device_type
+                self.firmware_version = identity.firmware_version
+                self.serial_number = identity.serial_number
+                self.identity_from_cache = True
+                await self._initialize_device(read_info=False)
+            else:
+                self.device_type = await identify_device_type(self.ip_address)
+                await self._initialize_device()
+                self.identity_from_cache = False
+
+                device_identity_cache.put(DeviceIdentity(
+                    ip_address=self.ip_address,
+                    device_type=self.device_type,
+                    firmware_version=self.firmware_version,
+                    serial_number=self.serial_number
+                ))
+
+            return True
+
+        except Exception as e:
+            if identity:
+                device_identity_cache.invalidate(self.ip_address)
+            await self.disconnect()
+            raise IRNetBoxError(f"Connection failed: {e}")
+
+    async def disconnect(self):
+        """Disconnect from IRNetBox."""
+        writer = self.writer
+        if writer is None:
+            return
+        try:
+            if self.device_type in [IRNetBoxType.MK_I, IRNetBoxType.MK_II, IRNetBoxType.UNKNOWN] \
+                    and self._reader_task and not self._reader_task.done():
+                # Power off CPLD before closing
+                await asyncio.wait_for(self._send_message(IRNetBox.MSG_CPLD_POWER_OFF, b''), 1.0)
+        except Exception:
+            pass
+        self._close(IRNetBoxError("Disconnected"))
+        if self._reader_task:
+            self._reader_task.cancel()
+            self._reader_task = None
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    def _close(self, error: Exception):
+        """Close the stream and fail every pending reply and completion."""
+        writer, self.reader, self.writer = self.writer, None, None
+        if writer is not None:
+            writer.close()
+        while self._replies:
+            future = self._replies.popleft()
+            if not future.done():
+                future.set_exception(error)
+        for future in self._completions.values():
+            future.cancel()
+        self._completions.clear()
+        self._port_busy.clear()
+
+    async def __aenter__(self):
+        if not self.connected:
+            await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
+
+    async def _initialize_device(self, read_info: bool = True):
+        """Initialize device after connection (CPLD setup, firmware and serial reads)."""
+        if self.device_type in [IRNetBoxType.MK_I, IRNetBoxType.MK_II, IRNetBoxType.UNKNOWN]:
+            await self._send_message(IRNetBox.MSG_CPLD_POWER_ON, b'')
+            await self.send_cpld_instruction(IRNetBox.CPLD_RESET)
+            await self.send_cpld_instruction(IRNetBox.CPLD_LED_REFLECT)
+
+        if not read_info:
+            return
+
+        response = await self._send_message(IRNetBox.MSG_READ_FIRMWARE, b'')
+        if response:
+            self.firmware_version = response.decode('ascii', errors='ignore').strip('\x00')
+            if self.device_type == IRNetBoxType.UNKNOWN:
+                self.device_type = device_type_from_firmware_version(self.firmware_version)
+
+        try:
+            serial_number = parse_serial_number(await self._send_message(IRNetBox.MSG_READ_SERIAL, b''))
+            if serial_number is not None:
+                self.serial_number = serial_number
+        except IRNetBoxError:
+            pass
+
+    async def _read_frame(self):
+        """Read one reply frame: length (ushort, big-endian) + type + data."""
+        header = await self.reader.readexactly(3)
+        length, msg_type = struct.unpack('>HB', header)
+        data = await self.reader.readexactly(length) if length else b''
+        return msg_type, data
+
+    async def _read_loop(self):
+        """Route incoming frames: completions by sequence number, replies in FIFO order."""
+        try:
+            while True:
+                msg_type, data = await self._read_frame()
+                if msg_type == IRNetBox.MSG_ASYNC_COMPLETE:
+                    self._complete(parse_async_complete(data))
+                elif self._replies:
+                    future = self._replies.popleft()
+                    if not future.done():
+                        future.set_result((msg_type, data))
+                else:
+                    logger.warning(f"Unsolicited message 0x{msg_type:02X} from {self.ip_address}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._close(IRNetBoxError(f"Communication error: {e}"))
+
+    def _complete(self, sequence_number: Optional[int]):
+        """Resolve the completion future of an async output."""
+        future = self._completions.pop(sequence_number, None)
+        # Remember it for waiters that arrive after the frame
+        self._completed.append(sequence_number)
+        if future is not None and not future.done():
+            future.set_result(True)
+
+    async def _send_message(self, msg_type: int, data: bytes) -> bytes:
+        """Send a message to the IRNetBox and return the reply payload."""
+        return await self._exchange(encode_message(msg_type, data))
+
+    async def _exchange(self, message: bytes) -> bytes:
+        """Send an encoded message and return the reply payload."""
+        if not self.connected:
+            raise IRNetBoxError("Not connected")
+
+        future = asyncio.get_running_loop().create_future()
+        # Queue the waiter and write in one step so replies match send order
+        self._replies.append(future)
+        self.writer.write(message)
+
+        try:
+            await self.writer.drain()
+            reply_type, reply = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # A late reply would be matched to the next request, drop the connection
+            self._close(IRNetBoxError("Communication timeout"))
+            raise IRNetBoxError("Communication timeout")
+        except ConnectionError as e:
+            self._close(IRNetBoxError(f"Communication error: {e}"))
+            raise IRNetBoxError(f"Communication error: {e}")
+
+        if reply_type == IRNetBox.MSG_ERROR:
+            raise IRNetBoxError(error_message(reply))
+        return reply
+
+    async def send_cpld_instruction(self, instruction: int):
+        """Send CPLD instruction."""
+        await self._send_message(IRNetBox.MSG_CPLD_INSTRUCTION, struct.pack('B', instruction))
+
+    async def allocate_signal_memory(self):
+        """Allocate memory for modulated IR signals."""
+        await self._send_message(IRNetBox.MSG_ALLOCATE_MEMORY, b'')
+
+    async def set_output_power(self, port: int, power_level: PowerLevel = PowerLevel.MEDIUM):
+        """Set power level for a specific output port (1-16)."""
+        for instruction in cpld_power_instructions(port, power_level, self.device_type):
+            await self.send_cpld_instruction(instruction)
+
+    async def set_output_mask(self, output_configs: List[OutputConfig]):
+        """Set multiple outputs using a bit mask (individual CPLD commands on MK-I)."""
+        if self.device_type == IRNetBoxType.MK_I:
+            await self.send_cpld_instruction(IRNetBox.CPLD_RESET)
+            for config in output_configs:
+                if config.power_level != PowerLevel.OFF:
+                    await self.set_output_power(config.port, config.power_level)
+            return
+        await self._send_message(IRNetBox.MSG_SET_OUTPUT_MASK, encode_output_mask(output_configs))
+
+    async def reset_outputs(self):
+        """Reset all outputs (turn off) - only for CPLD devices."""
+        if self.device_type in [IRNetBoxType.MK_I, IRNetBoxType.MK_II, IRNetBoxType.UNKNOWN]:
+            await self.send_cpld_instruction(IRNetBox.CPLD_RESET)
+
+    def download_signal(self, signal: IRSignal, max_lengths: int = 16, max_data_size: int = 512) -> bytes:
+        """Encode a signal for download, applying and advancing its toggle state."""
+        return encode_signal(signal, apply_toggle_state(signal, self.toggle_states), max_lengths, max_data_size)
+
+    async def send_signal_async(self, signal: IRSignal, output_configs: List[OutputConfig],
+                                sequence_number: int = None, post_delay_ms: int = 500,
+                                enforce_timing: bool = True,
+                                completion_timeout: float = 10.0,
+                                signal_binary: bytes = None) -> int:
+        """
+        Send IR signal asynchronously (MK-III and MK-IV).
+
+        Returns once the device has acknowledged the output; use
+        wait_for_async_completion to wait for transmission to finish. Outputs
+        on other ports may be sent while this one is in flight; a port that is
+        still busy is waited for first.
+
+        Args:
+            signal: IR signal to send
+            output_configs: List of output configurations
+            sequence_number: Optional sequence number (allocated per connection if None)
+            post_delay_ms: Delay after signal in milliseconds (100-10000)
+            enforce_timing: Whether to enforce the MK-IV same-port cooldown
+            completion_timeout: Seconds to wait for a busy port to complete
+            signal_binary: Precompiled download_signal bytes (skips encoding and toggle handling)
+
+        Returns:
+            Sequence number for tracking this command
+        """
+        if self.device_type not in [IRNetBoxType.MK_III, IRNetBoxType.MK_IV]:
+            raise IRNetBoxError("Async output only supported on MK-III and MK-IV devices")
+
+        ports = [config.port for config in output_configs]
+        await self._wait_ports_free(ports, completion_timeout)
+
+        if enforce_timing and self.device_type == IRNetBoxType.MK_IV:
+            # Wait out the longest remaining cooldown without blocking the loop
+            now = time.time()
+            wait_time = max((self.PORT_COOLDOWN - (now - self.port_last_used[port])
+                             for port in ports if port in self.port_last_used), default=0)
+            if wait_time > 0:
+                logger.debug(f"Waiting {wait_time:.1f}s for port cooldown on {self.ip_address}")
+                await asyncio.sleep(wait_time)
+                await self._wait_ports_free(ports, completion_timeout)
+
+        if sequence_number is None:
+            sequence_number = self._sequence.allocate(self._completions)
+        elif sequence_number in self._completions:
+            raise IRNetBoxError(f"Sequence number {sequence_number} is already in flight")
+
+        if signal_binary is None:
+            signal_binary = self.download_signal(signal)
+        message = encode_async_output_message(sequence_number, normalize_post_delay(post_delay_ms),
+                                              output_configs, signal_binary)
+
+        if self.sends_completions:
+            # Register before sending so a fast completion cannot be missed
+            completion = asyncio.get_running_loop().create_future()
+            self._completions[sequence_number] = completion
+            for port in ports:
+                self._port_busy[port] = completion
+            if sequence_number in self._completed:
+                self._completed.remove(sequence_number)
+
+        try:
+            response = await self._exchange(message)
+            parse_async_ack(response)
+        except Exception:
+            self._release(sequence_number, ports)
+            raise
+
+        now = time.time()
+        for port in ports:
+            self.port_last_used[port] = now
+
+        return sequence_number
+
+    async def _wait_ports_free(self, ports: List[int], timeout: float):
+        """Wait for outputs in flight on any of the given ports to complete."""
+        deadline = time.monotonic() + timeout
+        while True:
+            busy = [self._port_busy[port] for port in ports
+                    if port in self._port_busy and not self._port_busy[port].done()]
+            if not busy:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise IRNetBoxError(f"Ports {ports} still busy on {self.ip_address}")
+            await asyncio.wait(busy, timeout=remaining)
+
+    def _release(self, sequence_number: int, ports: List[int]):
+        """Forget an output that was rejected or never sent."""
+        future = self._completions.pop(sequence_number, None)
+        if future is None:
+            return
+        future.cancel()
+        for port in ports:
+            if self._port_busy.get(port) is future:
+                del self._port_busy[port]
+
+    async def wait_for_async_completion(self, sequence_number: int, timeout: float = 10.0) -> bool:
+        """
+        Wait for async IR output completion (MK-III only).
+
+        Returns:
+            True if completed successfully, False if timeout
+        """
+        if not self.sends_completions:
+            return True  # Non-async devices complete immediately
+
+        if sequence_number in self._completed:
+            self._completed.remove(sequence_number)
+            return True
+
+        future = self._completions.get(sequence_number)
+        if future is None:
+            return False  # Not in flight on this connection
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            return False
+        if sequence_number in self._completed:
+            self._completed.remove(sequence_number)
+        return True
+
+    async def send_and_wait(self, signal: IRSignal, output_configs: List[OutputConfig],
+                            post_delay_ms: int = 500, enforce_timing: bool = True,
+                            timeout: float = 10.0) -> int:
+        """
+        Send an async output and wait for it to complete.
+
+        Raises:
+            IRNetBoxError: If the output is rejected or does not complete in time
+        """
+        sequence_number = await self.send_signal_async(signal, output_configs, post_delay_ms=post_delay_ms,
+                                                       enforce_timing=enforce_timing,
+                                                       completion_timeout=timeout)
+        if not await self.wait_for_async_completion(sequence_number, timeout):
+            raise IRNetBoxError(f"Async output {sequence_number} did not complete within {timeout}s")
+        return sequence_number
+
+    async def get_memory_parameters(self, use_cache: bool = True) -> Dict[str, int]:
+        """Get signal capture and memory parameters (cached with the device identity)."""
+        if use_cache:
+            identity = device_identity_cache.get(self.ip_address)
+            if identity and identity.memory_params:
+                return dict(identity.memory_params)
+
+        memory_params = parse_memory_params(await self._send_message(IRNetBox.MSG_READ_PARAMS, b''))
+        if memory_params:
+            device_identity_cache.update_memory_params(self.ip_address, memory_params)
+        return memory_params
+
+    async def set_memory_parameters(self, **params):
+        """
+        Set signal capture and memory parameters.
+
+        Args:
+            params: Any of max_lengths, signal_data_size, carrier_periods,
+                length_fuzz, pause_timeout, min_pause (others keep current values)
+        """
+        current = await self.get_memory_parameters() or {
+            'max_lengths': 256,
+            'signal_data_size': 512,
+            'carrier_periods': 8,
+            'length_fuzz': 112,
+            'pause_timeout': 300000,
+            'min_pause': 115
+        }
+        names = ['max_lengths', 'signal_data_size', 'carrier_periods',
+                 'length_fuzz', 'pause_timeout', 'min_pause']
+        unknown = set(params) - set(names)
+        if unknown:
+            raise ValueError(f"Unknown memory parameters: {', '.join(sorted(unknown))}")
+
+        values = [params.get(name) if params.get(name) is not None else current.get(name) for name in names]
+        await self._send_message(IRNetBox.MSG_SET_PARAMS, struct.pack('>6I', *values))
+        device_identity_cache.update_memory_params(self.ip_address, None)
+
+    def get_device_info(self) -> Dict[str, str]:
+        """Get device information."""
+        return {
+            'ip_address': self.ip_address or 'Unknown',
+            'device_type': self.device_type.value,
+            'serial_number': self.serial_number or 'Unknown',
+            'firmware_version': self.firmware_version or 'Unknown'
+        }
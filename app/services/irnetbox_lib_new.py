@@ -6,13 +6,16 @@ and sending IR commands.
 Based on "The irNetBox Network Control Protocol" documentation.
 """
 
+import select
 import socket
 import struct
+import threading
 import time
+from collections import deque
 import xml.etree.ElementTree as ET
 import base64
 from typing import Dict, List, Tuple, Optional, Union
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 
 
@@ -82,6 +85,284 @@ class IRNetBoxError(Exception):
     pass
 
 
+@dataclass
+class DeviceIdentity:
+    """Identity information discovered for an IRNetBox."""
+    ip_address: str
+    device_type: IRNetBoxType
+    firmware_version: Optional[str] = None
+    serial_number: Optional[str] = None
+    memory_params: Optional[Dict[str, int]] = None
+    discovered_at: float = field(default_factory=time.time)
+
+
+class DeviceIdentityCache:
+    """
+    Process-wide cache of device identities keyed by IP address.
+    Lets reconnects skip UDP type discovery and the firmware/serial reads.
+    """
+    
+    def __init__(self, ttl: float = 3600.0):
+        """
+        Args:
+            ttl: Seconds before a cached identity must be rediscovered
+        """
+        self.ttl = ttl
+        self._identities = {}  # IP address -> DeviceIdentity
+        self._listeners = []  # Called with each freshly discovered DeviceIdentity
+        self._lock = threading.Lock()
+    
+    def get(self, ip_address: str) -> Optional[DeviceIdentity]:
+        """Get the cached identity for a device, or None if missing or expired."""
+        with self._lock:
+            identity = self._identities.get(ip_address)
+            if identity and time.time() - identity.discovered_at > self.ttl:
+                del self._identities[ip_address]
+                identity = None
+            return identity
+    
+    def put(self, identity: DeviceIdentity, notify: bool = True):
+        """Store a freshly discovered identity and notify listeners."""
+        with self._lock:
+            self._identities[identity.ip_address] = identity
+            listeners = list(self._listeners) if notify else []
+        for listener in listeners:
+            try:
+                listener(identity)
+            except Exception as e:
+                print(f"Warning: Device identity listener failed: {e}")
+    
+    def update_memory_params(self, ip_address: str, memory_params: Optional[Dict[str, int]]):
+        """Attach (or clear) memory parameters on a cached identity."""
+        with self._lock:
+            identity = self._identities.get(ip_address)
+            if identity:
+                identity.memory_params = dict(memory_params) if memory_params else None
+    
+    def invalidate(self, ip_address: str = None):
+        """Forget one device's identity, or all identities if ip_address is None."""
+        with self._lock:
+            if ip_address is None:
+                self._identities.clear()
+            else:
+                self._identities.pop(ip_address, None)
+    
+    def add_listener(self, callback):
+        """Register a callback invoked with each newly discovered DeviceIdentity."""
+        with self._lock:
+            if callback not in self._listeners:
+                self._listeners.append(callback)
+
+
+# Shared by every IRNetBox instance in the process
+device_identity_cache = DeviceIdentityCache()
+
+
+class SequenceAllocator:
+    """
+    Monotonic per-connection allocator for async output sequence numbers.
+    Wraps at 65536 and skips numbers that are still in flight.
+    """
+    
+    def __init__(self, start: int = 1):
+        self._next = start % 65536
+        self._lock = threading.Lock()
+    
+    def allocate(self, in_flight=()) -> int:
+        """
+        Get the next sequence number.
+        
+        Args:
+            in_flight: Container of sequence numbers that must not be reused yet
+        """
+        with self._lock:
+            for _ in range(65536):
+                sequence_number = self._next
+                self._next = (self._next + 1) % 65536
+                if sequence_number not in in_flight:
+                    return sequence_number
+        raise IRNetBoxError("No free async sequence numbers")
+
+
+class FrameReader:
+    """
+    Buffered decoder for IRNetBox reply frames on a TCP socket.
+    
+    Frames are length (ushort, big-endian) + type + payload. Data is received
+    with recv_into into a reusable buffer, so partial reads and several
+    frames arriving in one segment are handled without losing stream
+    alignment. Unsolicited MSG_ASYNC_COMPLETE frames are routed to a
+    completion queue instead of being returned as request replies.
+    """
+    
+    HEADER = struct.Struct('>HB')
+    
+    def __init__(self, sock: socket.socket, buffer_size: int = 4096, max_completions: int = 256):
+        """
+        Args:
+            sock: Connected TCP socket
+            buffer_size: Initial receive buffer size (grows for larger frames)
+            max_completions: Completed sequence numbers remembered for later waits
+        """
+        self.sock = sock
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # First unread byte
+        self._end = 0  # End of received data
+        self._replies = deque()  # Non-completion frames read while waiting for a completion
+        self.completions = deque(maxlen=max_completions)  # Completed async sequence numbers
+    
+    @property
+    def buffered(self) -> int:
+        """Number of received bytes not yet decoded."""
+        return self._end - self._start
+    
+    def read_frame(self, timeout: float = None) -> Tuple[int, bytes]:
+        """
+        Read the next complete frame from the stream.
+        
+        Args:
+            timeout: Seconds to wait for the whole frame (None uses the socket timeout)
+            
+        Returns:
+            Tuple of (message type, payload)
+            
+        Raises:
+            socket.timeout: If the frame is not complete in time (buffered bytes are kept)
+            IRNetBoxError: If the connection is closed
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self._fill(self.HEADER.size, deadline)
+        length, msg_type = self.HEADER.unpack_from(self._buffer, self._start)
+        self._fill(self.HEADER.size + length, deadline)
+        
+        payload_start = self._start + self.HEADER.size
+        payload = bytes(self._view[payload_start:payload_start + length])
+        self._start = payload_start + length
+        if self._start == self._end:
+            self._start = self._end = 0
+        return msg_type, payload
+    
+    def read_reply(self, timeout: float = None) -> Tuple[int, bytes]:
+        """
+        Read the reply to a request, routing async completions to the completion queue.
+        
+        Returns:
+            Tuple of (message type, payload)
+        """
+        if self._replies:
+            return self._replies.popleft()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            msg_type, payload = self.read_frame(remaining)
+            if msg_type == IRNetBox.MSG_ASYNC_COMPLETE:
+                self._route_completion(payload)
+                continue
+            return msg_type, payload
+    
+    def wait_for_completion(self, sequence_number: int, timeout: float) -> bool:
+        """
+        Wait for the MSG_ASYNC_COMPLETE frame of an async output.
+        
+        Returns:
+            True if the completion was received, False on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if sequence_number in self.completions:
+                self.completions.remove(sequence_number)
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                msg_type, payload = self.read_frame(remaining)
+            except socket.timeout:
+                return False
+            if msg_type == IRNetBox.MSG_ASYNC_COMPLETE:
+                self._route_completion(payload)
+            else:
+                # Not ours to consume, hand it to the next read_reply
+                self._replies.append((msg_type, payload))
+    
+    def poll(self) -> bool:
+        """
+        Decode any frames already readable without blocking.
+        
+        Returns:
+            False if the connection was closed or a frame other than an
+            async completion arrived unsolicited (the stream is out of step)
+        """
+        try:
+            while True:
+                if self.buffered < self.HEADER.size or not self._frame_buffered():
+                    readable, _, _ = select.select([self.sock], [], [], 0)
+                    if not readable:
+                        return not self._replies
+                    if not self._recv():
+                        return False
+                    continue
+                msg_type, payload = self.read_frame(0)
+                if msg_type == IRNetBox.MSG_ASYNC_COMPLETE:
+                    self._route_completion(payload)
+                else:
+                    self._replies.append((msg_type, payload))
+        except (OSError, IRNetBoxError):
+            return False
+    
+    def _frame_buffered(self) -> bool:
+        """Check whether a complete frame is in the buffer."""
+        length, _ = self.HEADER.unpack_from(self._buffer, self._start)
+        return self.buffered >= self.HEADER.size + length
+    
+    def _route_completion(self, payload: bytes):
+        sequence_number = parse_async_complete(payload)
+        if sequence_number is not None:
+            self.completions.append(sequence_number)
+    
+    def _fill(self, size: int, deadline: Optional[float]):
+        """Receive until at least size bytes are buffered."""
+        if self.buffered >= size:
+            return
+        default_timeout = self.sock.gettimeout()
+        try:
+            while self.buffered < size:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout("timed out")
+                    self.sock.settimeout(remaining)
+                if not self._recv(size):
+                    raise IRNetBoxError("Connection closed by device")
+        finally:
+            if deadline is not None:
+                self.sock.settimeout(default_timeout)
+    
+    def _recv(self, size: int = 0) -> int:
+        """Receive into the free space of the buffer, compacting or growing it first."""
+        needed = max(size, self.buffered + 1)
+        if self._start + needed > len(self._buffer):
+            if needed <= len(self._buffer):
+                # Move unread bytes to the front
+                unread = self.buffered
+                self._buffer[:unread] = self._buffer[self._start:self._end]
+                self._start, self._end = 0, unread
+            else:
+                self._grow(max(needed, len(self._buffer) * 2))
+        received = self.sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+    
+    def _grow(self, size: int):
+        unread = bytes(self._view[self._start:self._end])
+        self._view.release()
+        self._buffer = bytearray(size)
+        self._buffer[:len(unread)] = unread
+        self._view = memoryview(self._buffer)
+        self._start, self._end = 0, len(unread)
+
+
 class IRNetBox:
     """IRNetBox communication class."""
     
@@ -107,6 +388,12 @@ class IRNetBox:
     UDP_DISCOVERY_PORT = 30718  # 0x77FE
     TCP_CONTROL_PORT = 10001
     
+    # Seconds to wait for a complete reply frame
+    REPLY_TIMEOUT = 5.0
+    
+    # Minimum time between commands on the same MK-IV port (slow STBs)
+    PORT_COOLDOWN = 10.0
+    
     # CPLD Instructions
     CPLD_RESET = 0x00
     CPLD_ENABLE_LOW_1 = 0x02
@@ -129,13 +416,17 @@ class IRNetBox:
         0x2D: "Signal Download: No IrDA signal data has been downloaded",
     }
     
-    def __init__(self, ip_address: str = None):
+    def __init__(self, ip_address: str = None, port: int = None):
         """Initialize IRNetBox connection."""
         self.ip_address = ip_address
+        self.port = port or self.TCP_CONTROL_PORT
         self.socket = None
+        self._reader = None  # FrameReader for self.socket
+        self._sequence = SequenceAllocator()  # Async output sequence numbers
         self.device_type = IRNetBoxType.UNKNOWN
         self.serial_number = None
         self.firmware_version = None
+        self.identity_from_cache = False
         self.toggle_states = {}  # Track toggle states per signal UID
         self.port_last_used = {}  # Track when each port was last used for timing
         self.signal_database = {}  # Signal name -> IRSignal lookup
@@ -161,18 +452,8 @@ class IRNetBox:
             while time.time() - start_time < timeout:
                 try:
                     data, addr = udp_socket.recvfrom(1024)
-                    if len(data) >= 30:
-                        # Parse response: 4 bytes type + 16 bytes firmware + 4 bytes info + 6 bytes MAC
-                        firmware_id = data[4:6].decode('ascii', errors='ignore')
-                        mac_bytes = data[24:30]
-                        mac_address = ':'.join(f'{b:02x}' for b in mac_bytes)
-                        
-                        device_info = {
-                            'ip_address': addr[0],
-                            'firmware_id': firmware_id,
-                            'mac_address': mac_address,
-                            'raw_data': data
-                        }
+                    device_info = parse_discovery_reply(data, addr[0])
+                    if device_info:
                         devices.append(device_info)
                         
                 except socket.timeout:
@@ -202,27 +483,17 @@ class IRNetBox:
                 firmware_id = data[4:6].decode('ascii', errors='ignore')
                 
                 # Determine type based on firmware ID
-                if firmware_id in ['X1', 'X2']:
-                    return IRNetBoxType.MK_I
-                elif firmware_id == 'X9':
-                    return IRNetBoxType.MK_III
-                elif firmware_id == 'X5':
+                device_type = device_type_from_firmware_id(firmware_id)
+                if device_type is None:
                     # Need further identification with 0xE4 query
                     type_packet = struct.pack('>I', 0x000000E4)
                     udp_socket.sendto(type_packet, (ip_address, self.UDP_DISCOVERY_PORT))
                     
                     type_data, _ = udp_socket.recvfrom(1024)
-                    if len(type_data) > 32:
-                        label_len = type_data[32]
-                        if label_len > 0:
-                            label = type_data[33:33+label_len].decode('ascii', errors='ignore')
-                            if 'REDRAT4-III' in label:
-                                return IRNetBoxType.MK_III
-                            elif 'REDRAT4-II' in label:
-                                return IRNetBoxType.MK_II
-                            elif 'REDRAT4' in label:
-                                return IRNetBoxType.MK_I
-                                
+                    device_type = device_type_from_label_reply(type_data)
+                if device_type != IRNetBoxType.UNKNOWN:
+                    return device_type
+                    
             udp_socket.close()
             
         except Exception as e:
@@ -240,60 +511,81 @@ class IRNetBox:
         Returns:
             IRNetBoxType: Detected device type
         """
-        if not firmware_version:
-            return IRNetBoxType.UNKNOWN
-            
-        firmware_upper = firmware_version.upper()
-        
-        # Check for explicit version markers in firmware
-        if 'MKIV' in firmware_upper or 'MK-IV' in firmware_upper:
-            return IRNetBoxType.MK_IV
-        elif 'MKIII' in firmware_upper or 'MK-III' in firmware_upper:
-            return IRNetBoxType.MK_III
-        elif 'MKII' in firmware_upper or 'MK-II' in firmware_upper:
-            return IRNetBoxType.MK_II
-        elif 'MKI' in firmware_upper or 'MK-I' in firmware_upper:
-            return IRNetBoxType.MK_I
-            
-        # Fallback: try to infer from firmware patterns
-        if 'IRNETBOX' in firmware_upper:
-            # If we see "irNetBox" but no specific version, assume newer model
-            if any(word in firmware_upper for word in ['2017', '2018', '2019', '2020', '2021', '2022', '2023', '2024', '2025']):
-                return IRNetBoxType.MK_IV  # Newer firmware likely MK-IV
-            else:
-                return IRNetBoxType.MK_III  # Older but still modern
-        
-        return IRNetBoxType.UNKNOWN
+        return device_type_from_firmware_version(firmware_version)
     
-    def connect(self, ip_address: str = None) -> bool:
+    def connect(self, ip_address: str = None, use_identity_cache: bool = True) -> bool:
         """
         Connect to IRNetBox via TCP.
+        
+        Args:
+            ip_address: Device IP address (defaults to the one given at construction)
+            use_identity_cache: Reuse a cached device identity to skip UDP type
+                discovery and the firmware/serial reads. Set to False to force
+                rediscovery (the cache is refreshed with the result).
         """
         if ip_address:
             self.ip_address = ip_address
             
         if not self.ip_address:
             raise IRNetBoxError("No IP address specified")
+        
+        identity = device_identity_cache.get(self.ip_address) if use_identity_cache else None
             
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.settimeout(5.0)
-            self.socket.connect((self.ip_address, self.TCP_CONTROL_PORT))
-            
-            # Identify device type
-            self.device_type = self.identify_device_type(self.ip_address)
-            
-            # Initialize device
-            self._initialize_device()
+            self.socket.connect((self.ip_address, self.port))
+            
+            if identity:
+                # Known device - skip discovery and info reads
+                self.device_type = identity.device_type
+                self.firmware_version = identity.firmware_version
+                self.serial_number = identity.serial_number
+                self.identity_from_cache = True
+                self._initialize_device(read_info=False)
+            else:
+                # Identify device type
+                self.device_type = self.identify_device_type(self.ip_address)
+                
+                # Initialize device
+                self._initialize_device()
+                self.identity_from_cache = False
+                
+                device_identity_cache.put(DeviceIdentity(
+                    ip_address=self.ip_address,
+                    device_type=self.device_type,
+                    firmware_version=self.firmware_version,
+                    serial_number=self.serial_number
+                ))
             
             return True
             
         except Exception as e:
+            if identity:
+                # Cached identity may be stale, rediscover on next connect
+                device_identity_cache.invalidate(self.ip_address)
             if self.socket:
                 self.socket.close()
                 self.socket = None
             raise IRNetBoxError(f"Connection failed: {e}")
     
+    def verify_firmware(self) -> bool:
+        """
+        Read the firmware version and compare it with the cached identity.
+        A mismatch (e.g. after a firmware update) invalidates the cache.
+        
+        Returns:
+            True if the firmware matches the known identity
+        """
+        response = self._send_message(self.MSG_READ_FIRMWARE, b'')
+        firmware_version = response.decode('ascii', errors='ignore').strip('\x00') if response else None
+        
+        if self.firmware_version and firmware_version != self.firmware_version:
+            print(f"Firmware changed on {self.ip_address}: '{self.firmware_version}' -> '{firmware_version}'")
+            device_identity_cache.invalidate(self.ip_address)
+            return False
+        return True
+    
     def disconnect(self):
         """Disconnect from IRNetBox."""
         if self.socket:
@@ -311,8 +603,14 @@ class IRNetBox:
                 self.socket.close()
                 self.socket = None
     
-    def _initialize_device(self):
-        """Initialize device after connection."""
+    def _initialize_device(self, read_info: bool = True):
+        """
+        Initialize device after connection.
+        
+        Args:
+            read_info: Read firmware version and serial number from the device.
+                Skipped when the identity is already known.
+        """
         # CPLD instructions are only needed for MK-I and MK-II devices
         # MK-III and MK-IV devices may not require CPLD instructions
         needs_cpld = self.device_type in [IRNetBoxType.MK_I, IRNetBoxType.MK_II, IRNetBoxType.UNKNOWN]
@@ -327,6 +625,9 @@ class IRNetBox:
             # Enable LED reflection
             self._send_cpld_instruction(self.CPLD_LED_REFLECT)
         
+        if not read_info:
+            return
+        
         # Read firmware version
         response = self._send_message(self.MSG_READ_FIRMWARE, b'')
         if response:
@@ -339,58 +640,49 @@ class IRNetBox:
         # Read serial number
         try:
             response = self._send_message(self.MSG_READ_SERIAL, b'')
-            if len(response) >= 18:
-                # Parse USB descriptor format
-                serial_chars = []
-                for i in range(4, 18, 2):
-                    if i + 1 < len(response):
-                        char = chr(response[i])
-                        if char.isprintable():
-                            serial_chars.append(char)
-                self.serial_number = ''.join(serial_chars)
+            serial_number = parse_serial_number(response)
+            if serial_number is not None:
+                self.serial_number = serial_number
         except:
             pass
     
     def _send_message(self, msg_type: int, data: bytes) -> bytes:
         """Send a message to the IRNetBox and return response."""
+        return self._exchange(encode_message(msg_type, data))
+    
+    def _exchange(self, message: bytes) -> bytes:
+        """Send an encoded message and return the reply payload."""
         if not self.socket:
             raise IRNetBoxError("Not connected")
-            
-        # Build message: '#' + length (ushort, big-endian) + type + data
-        message = struct.pack('>cHB', b'#', len(data), msg_type) + data
         
         try:
-            self.socket.send(message)
+            self.socket.sendall(message)
             
             # Read response: length (ushort, big-endian) + type + data
-            response_header = self.socket.recv(3)
-            if len(response_header) < 3:
-                raise IRNetBoxError("Incomplete response header")
-                
-            response_length, response_type = struct.unpack('>HB', response_header)
+            response_type, response_data = self.frame_reader.read_reply(self.REPLY_TIMEOUT)
             
             # Check for error response
             if response_type == self.MSG_ERROR:
-                if response_length > 0:
-                    error_data = self.socket.recv(response_length)
-                    error_code = error_data[0] if error_data else 0
-                    error_msg = self.ERROR_CODES.get(error_code, f"Unknown error code: 0x{error_code:02X}")
-                    raise IRNetBoxError(f"Device returned error: {error_msg}")
-                else:
-                    raise IRNetBoxError("Device returned error")
-            
-            # Read response data
-            response_data = b''
-            if response_length > 0:
-                response_data = self.socket.recv(response_length)
+                raise IRNetBoxError(error_message(response_data))
                 
             return response_data
             
+        except IRNetBoxError:
+            raise
         except socket.timeout:
             raise IRNetBoxError("Communication timeout")
         except Exception as e:
             raise IRNetBoxError(f"Communication error: {e}")
     
+    @property
+    def frame_reader(self) -> 'FrameReader':
+        """Frame decoder for the current socket."""
+        if not self.socket:
+            raise IRNetBoxError("Not connected")
+        if self._reader is None or self._reader.sock is not self.socket:
+            self._reader = FrameReader(self.socket)
+        return self._reader
+    
     def _send_cpld_instruction(self, instruction: int):
         """Send CPLD instruction."""
         self._send_message(self.MSG_CPLD_INSTRUCTION, struct.pack('B', instruction))
@@ -407,40 +699,8 @@ class IRNetBox:
             port: Output port number (1-16)
             power_level: Power level (OFF, LOW, MEDIUM, HIGH). Defaults to MEDIUM.
         """
-        if not 1 <= port <= 16:
-            raise ValueError("Port must be between 1 and 16")
-        
-        if power_level == PowerLevel.OFF:
-            # Reset CPLD disables all outputs
-            self._send_cpld_instruction(self.CPLD_RESET)
-        elif power_level == PowerLevel.LOW:
-            if port == 1:
-                self._send_cpld_instruction(self.CPLD_ENABLE_LOW_1)
-            else:
-                self._send_cpld_instruction(0x02 + port - 1)  # Enable low power outputs 2-16
-        elif power_level == PowerLevel.HIGH:
-            if port == 1:
-                self._send_cpld_instruction(self.CPLD_ENABLE_HIGH_1)
-            else:
-                # For MK-II and later: high power = low + medium power combined
-                # MK-IV is MK-III compatible
-                if self.device_type in [IRNetBoxType.MK_II, IRNetBoxType.MK_III, IRNetBoxType.MK_IV]:
-                    self._send_cpld_instruction(0x02 + port - 1)  # Low power
-                    self._send_cpld_instruction(0x20 + port - 1)  # Medium power
-                else:
-                    # For MK-I, treat as low power
-                    self._send_cpld_instruction(0x02 + port - 1)
-        elif power_level == PowerLevel.MEDIUM:
-            # Medium power available on MK-II and later (MK-III, MK-IV)
-            # MK-IV is MK-III compatible
-            if self.device_type in [IRNetBoxType.MK_II, IRNetBoxType.MK_III, IRNetBoxType.MK_IV]:
-                if port == 1:
-                    self._send_cpld_instruction(0x20)  # Enable medium power on port 1
-                else:
-                    self._send_cpld_instruction(0x20 + port - 1)  # Medium power ports 2-16
-            else:
-                # Fallback to low power for MK-I
-                self.set_output_power(port, PowerLevel.LOW)
+        for instruction in cpld_power_instructions(port, power_level, self.device_type):
+            self._send_cpld_instruction(instruction)
     
     def set_output_mask(self, output_configs: List[OutputConfig]):
         """
@@ -458,29 +718,12 @@ class IRNetBox:
                     self.set_output_power(config.port, config.power_level)
             return
         
-        # Build 4-byte bit mask for MK-II/III
-        # Each port uses 2 bits: 00=OFF, 01=LOW, 10=MEDIUM, 11=HIGH
-        mask_bytes = [0, 0, 0, 0]
-        
-        for config in output_configs:
-            port = config.port
-            power_bits = config.power_level.value
-            
-            # Calculate byte and bit position
-            byte_index = (port - 1) // 4
-            bit_offset = ((port - 1) % 4) * 2
-            
-            # Clear existing bits and set new ones
-            mask_bytes[byte_index] &= ~(3 << bit_offset)  # Clear 2 bits
-            mask_bytes[byte_index] |= (power_bits << bit_offset)  # Set new bits
-        
-        # Send bit mask command
-        mask_data = struct.pack('4B', mask_bytes[3], mask_bytes[2], mask_bytes[1], mask_bytes[0])
-        self._send_message(self.MSG_SET_OUTPUT_MASK, mask_data)
+        # Send 4-byte bit mask command for MK-II/III
+        self._send_message(self.MSG_SET_OUTPUT_MASK, encode_output_mask(output_configs))
     
     def send_signal_async(self, signal: IRSignal, output_configs: List[OutputConfig], 
                          sequence_number: int = None, post_delay_ms: int = 500, 
-                         enforce_timing: bool = True) -> int:
+                         enforce_timing: bool = True, signal_binary: bytes = None) -> int:
         """
         Send IR signal asynchronously (MK-III and MK-IV).
         Returns sequence number for tracking completion.
@@ -493,6 +736,7 @@ class IRNetBox:
                          Default 500ms for slow STBs. Set to 0 to use device default (100ms).
                          This prevents rapid signals from confusing the receiving device.
             enforce_timing: Whether to enforce 10-second timing between same-port commands
+            signal_binary: Precompiled download_signal bytes (skips encoding and toggle handling)
             
         Returns:
             Sequence number for tracking this command
@@ -503,7 +747,7 @@ class IRNetBox:
         # Check timing constraints for async-aware devices (MK-IV)
         if enforce_timing and self.device_type == IRNetBoxType.MK_IV:
             current_time = time.time()
-            min_delay = 10.0  # 10 seconds minimum between same-port commands (realistic for slow STBs)
+            min_delay = self.PORT_COOLDOWN
             
             for config in output_configs:
                 port = config.port
@@ -516,40 +760,16 @@ class IRNetBox:
                         current_time = time.time()  # Update current time after wait
         
         if sequence_number is None:
-            sequence_number = int(time.time() * 1000) % 65536  # Use timestamp mod 65536
-        
-        # Validate and set post-delay (prevents rapid signals from confusing receiver)
-        if not 0 <= post_delay_ms <= 10000:
-            post_delay_ms = 500  # Default 500ms for slow STBs
-        
-        if post_delay_ms == 0:
-            post_delay_ms = 100  # Use device default if 0 specified
+            sequence_number = self._sequence.allocate()
         
         # Build async message data
-        async_data = struct.pack('<H', sequence_number)  # Little-endian sequence number
-        async_data += struct.pack('<H', post_delay_ms)   # Little-endian delay
-        
-        # Add power levels for all 16 ports (0 = not used)
-        power_levels = [0] * 16
-        for config in output_configs:
-            if 1 <= config.port <= 16:
-                # Convert power level to percentage (0-100)
-                power_map = {
-                    PowerLevel.OFF: 0,
-                    PowerLevel.LOW: 25,
-                    PowerLevel.MEDIUM: 50,
-                    PowerLevel.HIGH: 100
-                }
-                power_levels[config.port - 1] = power_map.get(config.power_level, 0)
-        
-        async_data += struct.pack('16B', *power_levels)
-        
-        # Add IR signal data
-        signal_binary = self.download_signal(signal)
-        async_data += signal_binary
+        post_delay_ms = normalize_post_delay(post_delay_ms)
+        if signal_binary is None:
+            signal_binary = self.download_signal(signal)
         
         # Send async output command
-        response = self._send_message(self.MSG_ASYNC_OUTPUT, async_data)
+        response = self._exchange(encode_async_output_message(sequence_number, post_delay_ms,
+                                                              output_configs, signal_binary))
         
         # Update port usage timestamps
         current_time = time.time()
@@ -557,20 +777,7 @@ class IRNetBox:
             self.port_last_used[config.port] = current_time
         
         # Parse ACK/NACK response
-        if len(response) >= 4:
-            resp_seq, error_code, ack_nack = struct.unpack('>HBB', response)
-            if ack_nack == 0:  # NACK
-                error_messages = {
-                    0x31: "IRNetBox is busy on one or more requested ports",
-                    0x32: "IRNetBox processor message queue is full", 
-                    0x33: "IR signal modulation frequency is too low (< 5KHz)",
-                    0x34: "IR signal modulation frequency is too high (> 490KHz)",
-                    0x35: "IR signal data section size is too large (max 2048 bytes)",
-                    0x36: "Invalid signal data - too many EOS or EOR markers",
-                    0x37: "Too many length values in the IR signal data"
-                }
-                error_msg = error_messages.get(error_code, f"Unknown error code: {error_code}")
-                raise IRNetBoxError(f"Async command rejected: {error_msg}")
+        parse_async_ack(response)
         
         return sequence_number
     
@@ -588,32 +795,10 @@ class IRNetBox:
         if self.device_type != IRNetBoxType.MK_III:
             return True  # Non-async devices complete immediately
         
-        start_time = time.time()
-        
-        while time.time() - start_time < timeout:
-            try:
-                # Check for completion message
-                self.socket.settimeout(0.1)  # Short timeout for non-blocking check
-                
-                # Read message header
-                header = self.socket.recv(3)
-                if len(header) == 3:
-                    length, msg_type = struct.unpack('>HB', header)
-                    
-                    if msg_type == self.MSG_ASYNC_COMPLETE and length >= 4:
-                        # Read completion data
-                        data = self.socket.recv(length)
-                        if len(data) >= 2:
-                            completed_seq = struct.unpack('<H', data[:2])[0]  # Little-endian
-                            if completed_seq == sequence_number:
-                                return True
-                                
-            except socket.timeout:
-                continue
-            except Exception:
-                break
-        
-        return False  # Timeout
+        try:
+            return self.frame_reader.wait_for_completion(sequence_number, timeout)
+        except Exception:
+            return False
     
     def enable_all_outputs(self):
         """Enable all IR outputs at low power."""
@@ -662,6 +847,9 @@ class IRNetBox:
             # For all devices, allocate fresh memory
             self.allocate_signal_memory()
             
+            # Device state changed - rediscover identity on next connect
+            device_identity_cache.invalidate(self.ip_address)
+            
             print("Device reset completed")
             
         except Exception as e:
@@ -828,42 +1016,7 @@ class IRNetBox:
         """
         # Apply toggle data if present
         modified_sig_data = self._apply_toggle_data(signal)
-        
-        # Convert modulation frequency to timer count (6MHz timer)
-        # Use floating-point division for more accurate timer calculation
-        timer_value = int(65536 - (6000000.0 / signal.modulation_freq))
-        
-        # Convert lengths from ms to 2MHz timer counts
-        length_values = []
-        for length_ms in signal.lengths:
-            length_count = int((length_ms / 1000.0) * 2000000)
-            length_values.append(length_count)
-        
-        # Pad length array to max_lengths
-        while len(length_values) < max_lengths:
-            length_values.append(0)
-        
-        # Convert intra-signal pause to 2MHz timer count
-        pause_count = int((signal.intra_sig_pause / 1000.0) * 2000000)
-        
-        # Build signal data structure (all values big-endian except where noted)
-        signal_data = struct.pack('>I', pause_count)  # Intra-signal pause
-        signal_data += struct.pack('>H', timer_value)  # Modulation frequency timer count
-        signal_data += struct.pack('>H', 0)  # No. of periods (0 for download)
-        signal_data += struct.pack('B', max_lengths)  # Maximum number of lengths
-        signal_data += struct.pack('B', len(signal.lengths))  # Actual number of lengths
-        signal_data += struct.pack('>H', max_data_size)  # Maximum signal data size
-        signal_data += struct.pack('>H', len(modified_sig_data))  # Actual signal data size
-        signal_data += struct.pack('B', signal.no_repeats)  # Number of repeats
-        
-        # Add length data array (big-endian ushorts)
-        for length_val in length_values:
-            signal_data += struct.pack('>H', min(length_val, 65535))
-        
-        # Add signal data (potentially modified by toggle data)
-        signal_data += modified_sig_data
-        
-        return signal_data
+        return encode_signal(signal, modified_sig_data, max_lengths, max_data_size)
     
     def _apply_toggle_data(self, signal: IRSignal) -> bytes:
         """
@@ -879,32 +1032,7 @@ class IRNetBox:
         Returns:
             Modified signal data bytes with current toggle state applied
         """
-        if not signal.toggle_data:
-            return signal.sig_data
-        
-        # Convert signal data to mutable bytearray
-        modified_data = bytearray(signal.sig_data)
-        signal_uid = signal.uid
-        
-        # Initialize toggle state for this signal if not present
-        if signal_uid not in self.toggle_states:
-            # Start with len1 values (False = use len1, True = use len2)
-            self.toggle_states[signal_uid] = {bit_no: False for bit_no in signal.toggle_data.keys()}
-        
-        # Apply current toggle state
-        for bit_no, (len1, len2) in signal.toggle_data.items():
-            if bit_no < len(modified_data):
-                current_state = self.toggle_states[signal_uid][bit_no]
-                if current_state:
-                    modified_data[bit_no] = len2  # Use second value
-                else:
-                    modified_data[bit_no] = len1  # Use first value
-        
-        # Toggle state for next transmission
-        for bit_no in signal.toggle_data.keys():
-            self.toggle_states[signal_uid][bit_no] = not self.toggle_states[signal_uid][bit_no]
-        
-        return bytes(modified_data)
+        return apply_toggle_state(signal, self.toggle_states)
     
     def reset_toggle_states(self, signal_uid: str = None):
         """
@@ -922,7 +1050,8 @@ class IRNetBox:
                 self.toggle_states[signal_uid][bit_no] = False
     
     def send_signal(self, signal: IRSignal, outputs: List[int] = None, power_level: PowerLevel = PowerLevel.MEDIUM,
-                   use_async: bool = None):
+                   use_async: bool = None, output_configs: List[OutputConfig] = None,
+                   signal_binary: bytes = None):
         """
         Send an IR signal through specified outputs.
         
@@ -931,6 +1060,8 @@ class IRNetBox:
             outputs: List of output numbers (1-16), or None for output 1 only
             power_level: Power level for all specified outputs. Defaults to MEDIUM.
             use_async: Use async mode if available (MK-III), None for auto-detect
+            output_configs: Per-port power levels (overrides outputs and power_level)
+            signal_binary: Precompiled download_signal bytes
         """
         if not outputs:
             outputs = [1]
@@ -941,12 +1072,14 @@ class IRNetBox:
             use_async = (self.device_type in [IRNetBoxType.MK_III, IRNetBoxType.MK_IV])
         
         # Convert to output configurations
-        output_configs = [OutputConfig(port=port, power_level=power_level) for port in outputs]
+        if output_configs is None:
+            output_configs = [OutputConfig(port=port, power_level=power_level) for port in outputs]
         
         try:
             if use_async and self.device_type in [IRNetBoxType.MK_III, IRNetBoxType.MK_IV]:
                 # Use async mode with automatic timing enforcement and longer post-delay for slow STBs
-                seq_num = self.send_signal_async(signal, output_configs, enforce_timing=True, post_delay_ms=500)
+                seq_num = self.send_signal_async(signal, output_configs, enforce_timing=True, post_delay_ms=500,
+                                                 signal_binary=signal_binary)
                 print(f"Signal '{signal.name}' queued for async transmission (seq: {seq_num})")
                 
                 # Wait for completion
@@ -956,7 +1089,7 @@ class IRNetBox:
                     print(f"Warning: Async signal completion timeout (seq: {seq_num})")
             else:
                 # Use synchronous mode
-                self._send_signal_sync(signal, output_configs)
+                self._send_signal_sync(signal, output_configs, signal_binary)
                 print(f"Signal '{signal.name}' sent successfully")
                 
         except Exception as e:
@@ -983,7 +1116,8 @@ class IRNetBox:
             try:
                 if self.device_type == IRNetBoxType.MK_IV:
                     # Use async mode with timing enforcement and longer post-delay for slow STBs
-                    seq_num = self.send_signal_async(signal, output_configs, enforce_timing=True, post_delay_ms=500)
+                    seq_num = self.send_signal_async(signal, output_configs, enforce_timing=True, post_delay_ms=500,
+                                                 signal_binary=signal_binary)
                     self.wait_for_async_completion(seq_num, timeout=3.0)
                     return True
                 else:
@@ -1062,7 +1196,8 @@ class IRNetBox:
             
             try:
                 if self.device_type == IRNetBoxType.MK_IV:
-                    seq_num = self.send_signal_async(signal, output_configs, enforce_timing=True, post_delay_ms=500)
+                    seq_num = self.send_signal_async(signal, output_configs, enforce_timing=True, post_delay_ms=500,
+                                                 signal_binary=signal_binary)
                     self.wait_for_async_completion(seq_num, timeout=3.0)
                     result['success'] = True
                     break
@@ -1122,7 +1257,8 @@ class IRNetBox:
         result['total_time'] = time.time() - start_time
         return result
     
-    def _send_signal_sync(self, signal: IRSignal, output_configs: List[OutputConfig]):
+    def _send_signal_sync(self, signal: IRSignal, output_configs: List[OutputConfig],
+                          signal_binary: bytes = None):
         """Send signal synchronously (all device types)."""
         # Allocate memory if needed
         self.allocate_signal_memory()
@@ -1139,7 +1275,7 @@ class IRNetBox:
                 self.set_output_power(config.port, config.power_level)
         
         # Download signal data
-        signal_data = self.download_signal(signal)
+        signal_data = signal_binary if signal_binary is not None else self.download_signal(signal)
         self._send_message(self.MSG_DOWNLOAD_SIGNAL, signal_data)
         
         # Output signal
@@ -1154,24 +1290,19 @@ class IRNetBox:
             'firmware_version': self.firmware_version or 'Unknown'
         }
     
-    def get_memory_parameters(self) -> Dict[str, int]:
-        """Get signal capture and memory parameters."""
+    def get_memory_parameters(self, use_cache: bool = True) -> Dict[str, int]:
+        """Get signal capture and memory parameters (cached with the device identity)."""
+        if use_cache:
+            identity = device_identity_cache.get(self.ip_address)
+            if identity and identity.memory_params:
+                return dict(identity.memory_params)
+        
         try:
             response = self._send_message(self.MSG_READ_PARAMS, b'')
-            if len(response) >= 24:  # Expected parameter structure size
-                import struct
-                # Unpack the parameter structure (big-endian format)
-                params = struct.unpack('>6I', response[:24])
-                return {
-                    'max_lengths': params[0],
-                    'signal_data_size': params[1],
-                    'carrier_periods': params[2],
-                    'length_fuzz': params[3],
-                    'pause_timeout': params[4],
-                    'min_pause': params[5]
-                }
-            else:
-                return {}
+            memory_params = parse_memory_params(response)
+            if memory_params:
+                device_identity_cache.update_memory_params(self.ip_address, memory_params)
+            return memory_params
         except Exception as e:
             print(f"Warning: Could not read memory parameters: {e}")
             return {}
@@ -1218,10 +1349,381 @@ class IRNetBox:
             param_data = struct.pack('>6I', *params)
             self._send_message(self.MSG_SET_PARAMS, param_data)
             
+            # Cached parameters are stale now, re-read on next request
+            device_identity_cache.update_memory_params(self.ip_address, None)
+            
         except Exception as e:
             raise IRNetBoxError(f"Failed to set memory parameters: {e}")
 
 
+# Async output NACK error codes (MSG_ASYNC_OUTPUT)
+ASYNC_ERROR_MESSAGES = {
+    0x31: "IRNetBox is busy on one or more requested ports",
+    0x32: "IRNetBox processor message queue is full", 
+    0x33: "IR signal modulation frequency is too low (< 5KHz)",
+    0x34: "IR signal modulation frequency is too high (> 490KHz)",
+    0x35: "IR signal data section size is too large (max 2048 bytes)",
+    0x36: "Invalid signal data - too many EOS or EOR markers",
+    0x37: "Too many length values in the IR signal data"
+}
+
+# Power level to output percentage for async output
+POWER_PERCENTAGES = {
+    PowerLevel.OFF: 0,
+    PowerLevel.LOW: 25,
+    PowerLevel.MEDIUM: 50,
+    PowerLevel.HIGH: 100
+}
+
+
+# Pure protocol encoding/decoding shared by the blocking and asyncio clients.
+# Encoders write into one preallocated buffer with precompiled structs.
+
+MESSAGE_HEADER = struct.Struct('>cHB')  # '#' + length + type
+# Intra-signal pause, modulation timer, periods, max lengths, no. of lengths,
+# max data size, data size, repeats
+SIGNAL_HEADER = struct.Struct('>IHHBBHHB')
+# Sequence number, post delay (little-endian); followed by one power byte per port
+ASYNC_OUTPUT_HEADER = struct.Struct('<HH')
+ASYNC_OUTPUT_PREFIX_SIZE = ASYNC_OUTPUT_HEADER.size + 16
+
+_length_tables = {}  # Number of lengths -> struct.Struct for the length table
+
+
+def _length_table(count: int) -> struct.Struct:
+    """Get the precompiled struct for a big-endian ushort length table."""
+    table = _length_tables.get(count)
+    if table is None:
+        table = _length_tables[count] = struct.Struct(f'>{count}H')
+    return table
+
+
+def encode_message(msg_type: int, data: bytes) -> bytearray:
+    """Build a message: '#' + length (ushort, big-endian) + type + data."""
+    message = bytearray(MESSAGE_HEADER.size + len(data))
+    MESSAGE_HEADER.pack_into(message, 0, b'#', len(data), msg_type)
+    message[MESSAGE_HEADER.size:] = data
+    return message
+
+
+def device_type_from_firmware_id(firmware_id: str) -> Optional[IRNetBoxType]:
+    """
+    Map the firmware ID from a UDP 0xF6 reply to a device type.
+    
+    Returns:
+        Device type, or None if a 0xE4 label query is needed (X5 firmware)
+    """
+    if firmware_id in ['X1', 'X2']:
+        return IRNetBoxType.MK_I
+    elif firmware_id == 'X9':
+        return IRNetBoxType.MK_III
+    elif firmware_id == 'X5':
+        return None
+    return IRNetBoxType.UNKNOWN
+
+
+def device_type_from_label_reply(type_data: bytes) -> IRNetBoxType:
+    """Map a UDP 0xE4 reply (device label) to a device type."""
+    if len(type_data) > 32:
+        label_len = type_data[32]
+        if label_len > 0:
+            label = type_data[33:33+label_len].decode('ascii', errors='ignore')
+            if 'REDRAT4-III' in label:
+                return IRNetBoxType.MK_III
+            elif 'REDRAT4-II' in label:
+                return IRNetBoxType.MK_II
+            elif 'REDRAT4' in label:
+                return IRNetBoxType.MK_I
+    return IRNetBoxType.UNKNOWN
+
+
+def device_type_from_firmware_version(firmware_version: str) -> IRNetBoxType:
+    """Detect device type from a firmware version string."""
+    if not firmware_version:
+        return IRNetBoxType.UNKNOWN
+
+    firmware_upper = firmware_version.upper()
+
+    # Check for explicit version markers in firmware
+    if 'MKIV' in firmware_upper or 'MK-IV' in firmware_upper:
+        return IRNetBoxType.MK_IV
+    elif 'MKIII' in firmware_upper or 'MK-III' in firmware_upper:
+        return IRNetBoxType.MK_III
+    elif 'MKII' in firmware_upper or 'MK-II' in firmware_upper:
+        return IRNetBoxType.MK_II
+    elif 'MKI' in firmware_upper or 'MK-I' in firmware_upper:
+        return IRNetBoxType.MK_I
+
+    # Fallback: try to infer from firmware patterns
+    if 'IRNETBOX' in firmware_upper:
+        # If we see "irNetBox" but no specific version, assume newer model
+        if any(word in firmware_upper for word in ['2017', '2018', '2019', '2020', '2021', '2022', '2023', '2024', '2025']):
+            return IRNetBoxType.MK_IV  # Newer firmware likely MK-IV
+        else:
+            return IRNetBoxType.MK_III  # Older but still modern
+
+    return IRNetBoxType.UNKNOWN
+
+
+def parse_discovery_reply(data: bytes, ip_address: str) -> Optional[Dict[str, str]]:
+    """Parse a UDP discovery reply into a device info dict (None if too short)."""
+    if len(data) < 30:
+        return None
+    # Parse response: 4 bytes type + 16 bytes firmware + 4 bytes info + 6 bytes MAC
+    firmware_id = data[4:6].decode('ascii', errors='ignore')
+    mac_bytes = data[24:30]
+    mac_address = ':'.join(f'{b:02x}' for b in mac_bytes)
+    return {
+        'ip_address': ip_address,
+        'firmware_id': firmware_id,
+        'mac_address': mac_address,
+        'raw_data': data
+    }
+
+
+def parse_serial_number(response: bytes) -> Optional[str]:
+    """Parse a MSG_READ_SERIAL reply (USB descriptor format)."""
+    if len(response) < 18:
+        return None
+    serial_chars = []
+    for i in range(4, 18, 2):
+        if i + 1 < len(response):
+            char = chr(response[i])
+            if char.isprintable():
+                serial_chars.append(char)
+    return ''.join(serial_chars)
+
+
+def parse_memory_params(response: bytes) -> Dict[str, int]:
+    """Parse a MSG_READ_PARAMS reply (empty dict if too short)."""
+    if len(response) < 24:  # Expected parameter structure size
+        return {}
+    # Unpack the parameter structure (big-endian format)
+    params = struct.unpack('>6I', response[:24])
+    return {
+        'max_lengths': params[0],
+        'signal_data_size': params[1],
+        'carrier_periods': params[2],
+        'length_fuzz': params[3],
+        'pause_timeout': params[4],
+        'min_pause': params[5]
+    }
+
+
+def cpld_power_instructions(port: int, power_level: PowerLevel,
+                            device_type: IRNetBoxType) -> List[int]:
+    """
+    Get the CPLD instructions that set the power level of one output port (1-16).
+    """
+    if not 1 <= port <= 16:
+        raise ValueError("Port must be between 1 and 16")
+    
+    # MK-IV is MK-III compatible
+    has_medium = device_type in [IRNetBoxType.MK_II, IRNetBoxType.MK_III, IRNetBoxType.MK_IV]
+    
+    if power_level == PowerLevel.OFF:
+        # Reset CPLD disables all outputs
+        return [IRNetBox.CPLD_RESET]
+    elif power_level == PowerLevel.LOW:
+        if port == 1:
+            return [IRNetBox.CPLD_ENABLE_LOW_1]
+        return [0x02 + port - 1]  # Enable low power outputs 2-16
+    elif power_level == PowerLevel.HIGH:
+        if port == 1:
+            return [IRNetBox.CPLD_ENABLE_HIGH_1]
+        if has_medium:
+            # For MK-II and later: high power = low + medium power combined
+            return [0x02 + port - 1, 0x20 + port - 1]
+        # For MK-I, treat as low power
+        return [0x02 + port - 1]
+    elif power_level == PowerLevel.MEDIUM:
+        if has_medium:
+            return [0x20 + port - 1]  # Medium power ports 1-16
+        # Fallback to low power for MK-I
+        return cpld_power_instructions(port, PowerLevel.LOW, device_type)
+    return []
+
+
+def encode_output_mask(output_configs: List[OutputConfig]) -> bytes:
+    """
+    Build the 4-byte MSG_SET_OUTPUT_MASK payload.
+    Each port uses 2 bits: 00=OFF, 01=LOW, 10=MEDIUM, 11=HIGH
+    """
+    mask_bytes = [0, 0, 0, 0]
+    
+    for config in output_configs:
+        port = config.port
+        power_bits = config.power_level.value
+        
+        # Calculate byte and bit position
+        byte_index = (port - 1) // 4
+        bit_offset = ((port - 1) % 4) * 2
+        
+        # Clear existing bits and set new ones
+        mask_bytes[byte_index] &= ~(3 << bit_offset)  # Clear 2 bits
+        mask_bytes[byte_index] |= (power_bits << bit_offset)  # Set new bits
+    
+    return struct.pack('4B', mask_bytes[3], mask_bytes[2], mask_bytes[1], mask_bytes[0])
+
+
+def apply_toggle_state(signal: IRSignal, toggle_states: Dict[str, Dict[int, bool]]) -> bytes:
+    """
+    Apply toggle data to signal data and flip the stored toggle state.
+    
+    Toggle data contains bits that alternate each time the signal is output.
+    Each ToggleBit specifies a bit number (offset in signal data) and two
+    values (len1, len2) that alternate on each transmission.
+    
+    Args:
+        signal: IR signal with potential toggle data
+        toggle_states: Per-signal-UID toggle state, updated in place
+        
+    Returns:
+        Modified signal data bytes with current toggle state applied
+    """
+    if not signal.toggle_data:
+        return signal.sig_data
+    
+    # Convert signal data to mutable bytearray
+    modified_data = bytearray(signal.sig_data)
+    signal_uid = signal.uid
+    
+    # Initialize toggle state for this signal if not present
+    if signal_uid not in toggle_states:
+        # Start with len1 values (False = use len1, True = use len2)
+        toggle_states[signal_uid] = {bit_no: False for bit_no in signal.toggle_data.keys()}
+    
+    # Apply current toggle state
+    for bit_no, (len1, len2) in signal.toggle_data.items():
+        if bit_no < len(modified_data):
+            current_state = toggle_states[signal_uid][bit_no]
+            if current_state:
+                modified_data[bit_no] = len2  # Use second value
+            else:
+                modified_data[bit_no] = len1  # Use first value
+    
+    # Toggle state for next transmission
+    for bit_no in signal.toggle_data.keys():
+        toggle_states[signal_uid][bit_no] = not toggle_states[signal_uid][bit_no]
+    
+    return bytes(modified_data)
+
+
+def encode_signal(signal: IRSignal, sig_data: bytes = None, max_lengths: int = 16,
+                  max_data_size: int = 512) -> bytes:
+    """
+    Convert IR signal to the binary download format.
+    
+    Args:
+        signal: IR signal to encode
+        sig_data: Signal data to use instead of signal.sig_data (e.g. with toggle bits applied)
+        max_lengths: Length array size
+        max_data_size: Maximum signal data size
+    """
+    if sig_data is None:
+        sig_data = signal.sig_data
+    
+    # Convert modulation frequency to timer count (6MHz timer)
+    # Use floating-point division for more accurate timer calculation
+    timer_value = int(65536 - (6000000.0 / signal.modulation_freq))
+    
+    # Convert lengths from ms to 2MHz timer counts, padded to max_lengths
+    length_values = [min(int((length_ms / 1000.0) * 2000000), 65535) for length_ms in signal.lengths]
+    if len(length_values) < max_lengths:
+        length_values.extend([0] * (max_lengths - len(length_values)))
+    
+    # Convert intra-signal pause to 2MHz timer count
+    pause_count = int((signal.intra_sig_pause / 1000.0) * 2000000)
+    
+    # Header, length table and signal data in one buffer (big-endian)
+    length_table = _length_table(len(length_values))
+    table_offset = SIGNAL_HEADER.size
+    data_offset = table_offset + length_table.size
+    signal_data = bytearray(data_offset + len(sig_data))
+    SIGNAL_HEADER.pack_into(signal_data, 0, pause_count, timer_value, 0, max_lengths,
+                            len(signal.lengths), max_data_size, len(sig_data), signal.no_repeats)
+    length_table.pack_into(signal_data, table_offset, *length_values)
+    
+    # Add signal data (potentially modified by toggle data)
+    signal_data[data_offset:] = sig_data
+    
+    return bytes(signal_data)
+
+
+def normalize_post_delay(post_delay_ms: int) -> int:
+    """Clamp an async post-delay to the device's accepted range."""
+    # Validate and set post-delay (prevents rapid signals from confusing receiver)
+    if not 0 <= post_delay_ms <= 10000:
+        post_delay_ms = 500  # Default 500ms for slow STBs
+    
+    if post_delay_ms == 0:
+        post_delay_ms = 100  # Use device default if 0 specified
+    return post_delay_ms
+
+
+def _pack_async_output(buffer: bytearray, offset: int, sequence_number: int, post_delay_ms: int,
+                       output_configs: List[OutputConfig], signal_binary: bytes):
+    """Write the MSG_ASYNC_OUTPUT payload into buffer at offset."""
+    ASYNC_OUTPUT_HEADER.pack_into(buffer, offset, sequence_number, post_delay_ms)
+    # Power percentage (0-100) per port; the buffer is zeroed, 0 = port not used
+    for config in output_configs:
+        if 1 <= config.port <= 16:
+            buffer[offset + ASYNC_OUTPUT_HEADER.size + config.port - 1] = \
+                POWER_PERCENTAGES.get(config.power_level, 0)
+    buffer[offset + ASYNC_OUTPUT_PREFIX_SIZE:] = signal_binary
+
+
+def encode_async_output(sequence_number: int, post_delay_ms: int,
+                        output_configs: List[OutputConfig], signal_binary: bytes) -> bytearray:
+    """Build the MSG_ASYNC_OUTPUT payload."""
+    payload = bytearray(ASYNC_OUTPUT_PREFIX_SIZE + len(signal_binary))
+    _pack_async_output(payload, 0, sequence_number, post_delay_ms, output_configs, signal_binary)
+    return payload
+
+
+def encode_async_output_message(sequence_number: int, post_delay_ms: int,
+                                output_configs: List[OutputConfig], signal_binary: bytes) -> bytearray:
+    """Build a complete framed MSG_ASYNC_OUTPUT message in a single buffer."""
+    length = ASYNC_OUTPUT_PREFIX_SIZE + len(signal_binary)
+    message = bytearray(MESSAGE_HEADER.size + length)
+    MESSAGE_HEADER.pack_into(message, 0, b'#', length, IRNetBox.MSG_ASYNC_OUTPUT)
+    _pack_async_output(message, MESSAGE_HEADER.size, sequence_number, post_delay_ms,
+                       output_configs, signal_binary)
+    return message
+
+
+def parse_async_ack(response: bytes) -> Optional[AsyncResponse]:
+    """
+    Parse the ACK/NACK reply to MSG_ASYNC_OUTPUT.
+    
+    Raises:
+        IRNetBoxError: If the device rejected the command
+    """
+    if len(response) < 4:
+        return None
+    resp_seq, error_code, ack_nack = struct.unpack('>HBB', response[:4])
+    if ack_nack == 0:  # NACK
+        error_msg = ASYNC_ERROR_MESSAGES.get(error_code, f"Unknown error code: {error_code}")
+        raise IRNetBoxError(f"Async command rejected: {error_msg}")
+    return AsyncResponse(sequence_number=resp_seq, success=True, error_code=error_code)
+
+
+def parse_async_complete(data: bytes) -> Optional[int]:
+    """Get the sequence number from a MSG_ASYNC_COMPLETE payload."""
+    if len(data) < 2:
+        return None
+    return struct.unpack('<H', data[:2])[0]  # Little-endian
+
+
+def error_message(error_data: bytes) -> str:
+    """Describe a MSG_ERROR payload."""
+    if not error_data:
+        return "Device returned error"
+    error_code = error_data[0]
+    error_msg = IRNetBox.ERROR_CODES.get(error_code, f"Unknown error code: 0x{error_code:02X}")
+    return f"Device returned error: {error_msg}"
+
+
 class IRSignalParser:
     """Parser for RedRat XML signal database files."""
     
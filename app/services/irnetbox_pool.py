@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+"""IRNetBox connection pool for the RedRat Proxy project.
+
+Opening an IRNetBox session is expensive: a TCP handshake, a UDP device
+type query and the firmware/serial/CPLD initialisation sequence all happen
+before the first IR signal can be sent. This module keeps initialised
+sessions open per device (ip, port) so a warm command only pays for the
+actual MSG_ASYNC_OUTPUT round trip.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Tuple
+
+from .irnetbox_lib_new import IRNetBox, IRNetBoxError, IRNetBoxType
+
+try:
+    from app.utils.logger import logger
+except ImportError:
+    logger = logging.getLogger("redrat_pool")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+
+class PooledSession:
+    """An initialised IRNetBox connection owned by the pool."""
+
+    def __init__(self, key: Tuple[str, int], ir: IRNetBox, generation: int = 0):
+        self.key = key
+        self.ir = ir
+        self.generation = generation
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.last_checked = self.created_at
+        self.uses = 0
+
+
+class IRNetBoxPool:
+    """Pool of persistent IRNetBox sessions keyed by device (ip, port)."""
+
+    def __init__(self, max_sessions_per_device: int = 1, idle_timeout: float = 300.0,
+                 health_check_interval: float = 30.0, acquire_timeout: float = 30.0,
+                 failure_ttl: float = 5.0):
+        """Initialize the pool.
+
+        Args:
+            max_sessions_per_device: Maximum open sessions per (ip, port)
+            idle_timeout: Seconds after which an unused session is closed
+            health_check_interval: Seconds of idleness after which a session
+                is probed with a firmware check before being handed out
+            acquire_timeout: Seconds to wait for a free session
+            failure_ttl: Seconds a failed connection attempt is remembered so
+                commands fail fast instead of reconnecting to a dead device
+        """
+        self.max_sessions_per_device = max(1, max_sessions_per_device)
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.failure_ttl = failure_ttl
+
+        self._cond = threading.Condition()
+        self._idle = {}  # Key: (ip, port), Value: list of idle PooledSession
+        self._open = {}  # Key: (ip, port), Value: number of open sessions (idle + in use)
+        self._generation = {}  # Key: (ip, port), Value: bumped by close_device to retire borrowed sessions
+        self._health = {}  # Key: (ip, port), Value: last connection outcome
+        self._device_types = {}  # Key: (ip, port), Value: IRNetBoxType found by the last session opened
+        self._reaper_thread = None
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'closed_idle': 0,
+            'health_check_failures': 0
+        }
+
+    @contextmanager
+    def session(self, host: str, port: int = IRNetBox.TCP_CONTROL_PORT):
+        """Borrow an initialised IRNetBox for the duration of a with-block.
+
+        The session is returned to the pool on normal exit. If the block
+        raises, the session is closed so the next borrower reconnects.
+        """
+        pooled = self.acquire(host, port)
+        try:
+            yield pooled.ir
+        except BaseException:
+            self.discard(pooled)
+            raise
+        else:
+            self.release(pooled)
+
+    def acquire(self, host: str, port: int = IRNetBox.TCP_CONTROL_PORT) -> PooledSession:
+        """Get a healthy session for a device, connecting if necessary.
+
+        Raises:
+            IRNetBoxError: If no session becomes available or connecting fails
+        """
+        key = (host, int(port))
+        self._ensure_reaper()
+        deadline = time.time() + self.acquire_timeout
+
+        while True:
+            with self._cond:
+                while True:
+                    idle = self._idle.get(key)
+                    if idle:
+                        pooled = idle.pop()
+                        break
+                    if self._open.get(key, 0) < self.max_sessions_per_device:
+                        # Reserve a slot and connect outside the lock
+                        self._open[key] = self._open.get(key, 0) + 1
+                        pooled = None
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise IRNetBoxError(f"Timed out waiting for a free session to {host}:{port}")
+                    self._cond.wait(remaining)
+
+            if pooled is None:
+                return self._connect(key)
+
+            if self._is_healthy(pooled):
+                pooled.uses += 1
+                with self._cond:
+                    self._stats['reused'] += 1
+                return pooled
+
+            with self._cond:
+                self._stats['health_check_failures'] += 1
+            logger.info(f"Pooled IRNetBox session to {host}:{port} failed health check, reconnecting")
+            self.discard(pooled)
+
+    def release(self, pooled: PooledSession):
+        """Return a borrowed session to the pool."""
+        pooled.last_used = time.time()
+        with self._cond:
+            retired = pooled.generation != self._generation.get(pooled.key, 0)
+            if not retired:
+                self._idle.setdefault(pooled.key, []).append(pooled)
+                self._cond.notify()
+        if retired:
+            self.discard(pooled)
+
+    def discard(self, pooled: PooledSession):
+        """Close a borrowed session instead of returning it to the pool."""
+        self._close(pooled.ir)
+        with self._cond:
+            self._open[pooled.key] = max(0, self._open.get(pooled.key, 1) - 1)
+            self._stats['discarded'] += 1
+            self._cond.notify()
+
+    def close_device(self, host: str, port: int = IRNetBox.TCP_CONTROL_PORT) -> int:
+        """Close all idle sessions for a device (e.g. after reset or reconfiguration).
+
+        Sessions currently borrowed are closed when they are released.
+
+        Returns:
+            Number of sessions closed
+        """
+        key = (host, int(port))
+        with self._cond:
+            idle = self._idle.pop(key, [])
+            self._generation[key] = self._generation.get(key, 0) + 1
+            self._open[key] = max(0, self._open.get(key, 0) - len(idle))
+            self._cond.notify_all()
+        for pooled in idle:
+            self._close(pooled.ir)
+        if idle:
+            logger.info(f"Closed {len(idle)} pooled session(s) to {host}:{port}")
+        return len(idle)
+
+    def close_idle(self, max_idle: float = None) -> int:
+        """Close sessions that have been idle longer than max_idle seconds.
+
+        Returns:
+            Number of sessions closed
+        """
+        max_idle = self.idle_timeout if max_idle is None else max_idle
+        cutoff = time.time() - max_idle
+        expired = []
+        with self._cond:
+            for key, idle in self._idle.items():
+                keep = [p for p in idle if p.last_used >= cutoff]
+                stale = [p for p in idle if p.last_used < cutoff]
+                if stale:
+                    self._idle[key] = keep
+                    self._open[key] = max(0, self._open.get(key, 0) - len(stale))
+                    expired.extend(stale)
+            self._stats['closed_idle'] += len(expired)
+            self._cond.notify_all()
+        for pooled in expired:
+            logger.debug(f"Closing idle IRNetBox session to {pooled.key[0]}:{pooled.key[1]}")
+            self._close(pooled.ir)
+        return len(expired)
+
+    def close_all(self):
+        """Close every idle session in the pool."""
+        with self._cond:
+            keys = list(self._idle.keys())
+        for host, port in keys:
+            self.close_device(host, port)
+
+    def record_health(self, host: str, port: int, ok: bool, error: str = None):
+        """Remember the outcome of a connection attempt to a device."""
+        with self._cond:
+            self._health[(host, int(port))] = {
+                'ok': ok,
+                'error': error,
+                'checked_at': time.time()
+            }
+
+    def get_health(self, host: str, port: int = IRNetBox.TCP_CONTROL_PORT,
+                   max_age: float = None) -> Optional[Dict[str, Any]]:
+        """Get the last known connection outcome for a device.
+
+        Args:
+            host: Device IP address
+            port: Device TCP port
+            max_age: Ignore outcomes older than this many seconds
+
+        Returns:
+            Dict with 'ok', 'error' and 'checked_at', or None if unknown/stale
+        """
+        with self._cond:
+            health = self._health.get((host, int(port)))
+            if health is None:
+                return None
+            if max_age is not None and time.time() - health['checked_at'] > max_age:
+                return None
+            return dict(health)
+
+    def recent_failure(self, host: str, port: int = IRNetBox.TCP_CONTROL_PORT) -> Optional[str]:
+        """Get the error of a connection failure within failure_ttl, if any."""
+        health = self.get_health(host, port, max_age=self.failure_ttl)
+        if health and not health['ok']:
+            return health['error'] or 'Device unreachable'
+        return None
+
+    def device_type(self, host: str, port: int = IRNetBox.TCP_CONTROL_PORT) -> Optional[IRNetBoxType]:
+        """Get the type of a device as seen by its last opened session, or None if never connected."""
+        with self._cond:
+            return self._device_types.get((host, int(port)))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get pool counters and per-device session counts."""
+        with self._cond:
+            devices = {
+                f"{host}:{port}": {
+                    'open': count,
+                    'idle': len(self._idle.get((host, port), []))
+                }
+                for (host, port), count in self._open.items() if count
+            }
+            stats = dict(self._stats)
+        stats['devices'] = devices
+        return stats
+
+    def _connect(self, key: Tuple[str, int]) -> PooledSession:
+        """Open and initialise a new session for a reserved slot."""
+        host, port = key
+        ir = IRNetBox(host, port)
+        try:
+            logger.debug(f"Opening pooled IRNetBox session to {host}:{port}")
+            ir.connect()
+        except Exception as e:
+            with self._cond:
+                self._open[key] = max(0, self._open.get(key, 1) - 1)
+                self._cond.notify()
+            self.record_health(host, port, False, str(e))
+            raise
+        self.record_health(host, port, True)
+        with self._cond:
+            self._device_types[key] = ir.device_type
+            pooled = PooledSession(key, ir, self._generation.get(key, 0))
+            pooled.uses = 1
+            self._stats['created'] += 1
+        return pooled
+
+    def _is_healthy(self, pooled: PooledSession) -> bool:
+        """Check that an idle session is still usable."""
+        ir = pooled.ir
+        if not ir.socket:
+            return False
+
+        try:
+            # Consume completion frames left on the idle socket; anything
+            # else means the connection is closed or out of step
+            if not ir.frame_reader.poll():
+                return False
+
+            # Probe the device if the session has been quiet for a while.
+            # A changed firmware version means the cached identity is stale.
+            now = time.time()
+            if now - pooled.last_used > self.health_check_interval:
+                if not ir.verify_firmware():
+                    return False
+                pooled.last_checked = now
+            return True
+
+        except Exception as e:
+            logger.debug(f"Pooled session health check failed: {e}")
+            return False
+
+    def _close(self, ir: IRNetBox):
+        """Disconnect an IRNetBox, ignoring errors."""
+        try:
+            ir.disconnect()
+        except Exception as e:
+            logger.debug(f"Error closing IRNetBox session: {e}")
+
+    def _ensure_reaper(self):
+        """Start the idle-session reaper thread on first use."""
+        if self._reaper_thread and self._reaper_thread.is_alive():
+            return
+        with self._cond:
+            if self._reaper_thread and self._reaper_thread.is_alive():
+                return
+            self._reaper_thread = threading.Thread(target=self._reap_idle, daemon=True)
+            self._reaper_thread.start()
+
+    def _reap_idle(self):
+        """Periodically close idle sessions."""
+        interval = max(1.0, self.idle_timeout / 2)
+        while True:
+            time.sleep(interval)
+            try:
+                self.close_idle()
+            except Exception as e:
+                logger.error(f"Error reaping idle IRNetBox sessions: {str(e)}")
+
+
+# Global pool instance shared by all RedRat services in this process
+irnetbox_pool = IRNetBoxPool(
+    max_sessions_per_device=int(os.getenv('REDRAT_POOL_MAX_SESSIONS', '1')),
+    idle_timeout=float(os.getenv('REDRAT_POOL_IDLE_TIMEOUT', '300')),
+    health_check_interval=float(os.getenv('REDRAT_POOL_HEALTH_INTERVAL', '30')),
+    failure_ttl=float(os.getenv('REDRAT_POOL_FAILURE_TTL', '5'))
+)
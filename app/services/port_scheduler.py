@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""IR port readiness tracking for the RedRat Proxy project.
+
+MK-IV devices need a cooldown between signals on the same IR port so slow
+set-top boxes are not confused by rapid presses. Instead of sleeping in the
+sending thread, the command queue asks this scheduler when the ports of a
+command are ready and dispatches whichever command is ready first; commands
+for other ports and devices keep flowing while a port cools down.
+"""
+
+import threading
+import time
+from typing import Any, Dict, Iterable, Tuple
+
+from .irnetbox_lib_new import IRNetBox, IRNetBoxType, device_identity_cache
+from .irnetbox_pool import irnetbox_pool
+
+
+class PortScheduler:
+    """Ready-at times per (device, IR port)."""
+
+    def __init__(self, cooldown: float = IRNetBox.PORT_COOLDOWN):
+        """
+        Args:
+            cooldown: Seconds between signals on the same port of an MK-IV
+        """
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._ready_at = {}  # Key: ((ip, port), ir_port), Value: time.monotonic() the port is free
+
+    def cooldown_for(self, device_key: Tuple[str, int]) -> float:
+        """Get the same-port cooldown for a device; only MK-IV devices need one.
+
+        The type is the one found by the device's last pooled session, which
+        is kept for as long as the process runs; the identity cache (whose
+        entries expire) is only consulted before any session was opened.
+        """
+        device_type = irnetbox_pool.device_type(*device_key)
+        if device_type is None:
+            identity = device_identity_cache.get(device_key[0])
+            device_type = identity.device_type if identity else None
+        if device_type == IRNetBoxType.MK_IV:
+            return self.cooldown
+        return 0.0
+
+    def ready_at(self, device_key: Tuple[str, int], ports: Iterable[int]) -> float:
+        """Get the monotonic time at which all of the given ports are free."""
+        with self._lock:
+            return max((self._ready_at.get((device_key, port), 0.0) for port in ports), default=0.0)
+
+    def mark_used(self, device_key: Tuple[str, int], ports: Iterable[int], when: float = None):
+        """Record a transmission on ports, starting their cooldown."""
+        when = time.monotonic() if when is None else when
+        cooldown = self.cooldown_for(device_key)
+        with self._lock:
+            for port in ports:
+                if cooldown:
+                    self._ready_at[(device_key, port)] = when + cooldown
+                else:
+                    self._ready_at.pop((device_key, port), None)
+
+    def forget(self, device_key: Tuple[str, int]):
+        """Drop the cooldowns of a device (e.g. after reset or removal)."""
+        with self._lock:
+            for key in [k for k in self._ready_at if k[0] == device_key]:
+                del self._ready_at[key]
+
+    def cooling_ports(self) -> Dict[str, Dict[int, float]]:
+        """Get the remaining cooldown seconds per device and port."""
+        now = time.monotonic()
+        cooling = {}
+        with self._lock:
+            for ((host, port), ir_port), ready_at in self._ready_at.items():
+                if ready_at > now:
+                    cooling.setdefault(f"{host}:{port}", {})[ir_port] = round(ready_at - now, 3)
+        return cooling
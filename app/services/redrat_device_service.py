@@ -9,11 +9,34 @@ device status checks, power control, and device configuration.
 import time
 from datetime import datetime
 from typing import Dict, Any, Optional, List
-from app.models.redrat_device import RedRatDevice
-from app.services.redrat_service import RedRatService
+from app.models.redrat_device import RedRatDevice, device_model_to_int
+from app.services.redrat_service import create_redrat_service
+from app.services.irnetbox_pool import irnetbox_pool
+from app.services.irnetbox_lib_new import IRNetBoxType, device_identity_cache
+from app.services.device_router import device_router
 from app.utils.logger import logger
 
 
+def _persist_device_identity(identity):
+    """Store a freshly discovered device identity in the redrat_devices table."""
+    device_model = None
+    if identity.device_type != IRNetBoxType.UNKNOWN:
+        device_model = device_model_to_int(identity.device_type.value)
+    RedRatDevice.update_identity(identity.ip_address, device_model,
+                                 identity.firmware_version, identity.serial_number)
+
+
+device_identity_cache.add_listener(_persist_device_identity)
+
+
+def _refresh_device_routing():
+    """Reload the command routing table after a device was added, changed or removed."""
+    try:
+        device_router.refresh()
+    except Exception as e:
+        logger.error(f"Error refreshing device routing table: {str(e)}")
+
+
 class RedRatDeviceService:
     """Service for managing RedRat devices."""
     
@@ -36,7 +59,7 @@ class RedRatDeviceService:
                                    (datetime.now() - device.last_status_check).total_seconds() > 300):  # 5 minutes
                 try:
                     # Quick connection test
-                    redrat_service = RedRatService(device.ip_address, device.port)
+                    redrat_service = create_redrat_service(device.ip_address, device.port)
                     connection_result = redrat_service.test_connection()
                     
                     if connection_result['success']:
@@ -44,7 +67,6 @@ class RedRatDeviceService:
                         device_ports = connection_result.get('device_info', {}).get('ports')
                         
                         # Convert string device model to integer for database storage
-                        from app.app import device_model_to_int
                         device_model = device_model_to_int(device_model_string)
                         
                         device.update_status('online', device_model, device_ports)
@@ -103,6 +125,7 @@ class RedRatDeviceService:
                 result['message'] = 'Device created successfully'
                 result['device_id'] = device.id
                 logger.info(f"Created RedRat device: {name} ({ip_address}:{port})")
+                _refresh_device_routing()
             else:
                 result['message'] = 'Failed to save device to database'
                 
@@ -128,6 +151,8 @@ class RedRatDeviceService:
                 result['message'] = 'Device not found'
                 return result
             
+            old_address = (device.ip_address, device.port)
+            
             # Update fields if provided
             if name is not None:
                 device.name = name
@@ -143,9 +168,14 @@ class RedRatDeviceService:
                 device.port_descriptions = port_descriptions
             
             if device.save():
+                # Drop pooled sessions that point at the old address or an inactive device
+                if old_address != (device.ip_address, device.port) or not device.is_active:
+                    irnetbox_pool.close_device(*old_address)
+                
                 result['success'] = True
                 result['message'] = 'Device updated successfully'
                 logger.info(f"Updated RedRat device: {device.name} ({device.ip_address}:{device.port})")
+                _refresh_device_routing()
             else:
                 result['message'] = 'Failed to save device changes'
                 
@@ -170,9 +200,11 @@ class RedRatDeviceService:
                 return result
             
             if device.delete():
+                irnetbox_pool.close_device(device.ip_address, device.port)
                 result['success'] = True
                 result['message'] = 'Device deleted successfully'
                 logger.info(f"Deleted RedRat device: {device.name}")
+                _refresh_device_routing()
             else:
                 result['message'] = 'Failed to delete device'
                 
@@ -198,9 +230,9 @@ class RedRatDeviceService:
                 result['message'] = 'Device not found'
                 return result
             
-            # Test connection using RedRat service
-            redrat_service = RedRatService(device.ip_address, device.port)
-            connection_result = redrat_service.test_connection()
+            # Test connection using RedRat service, rediscovering device identity
+            redrat_service = create_redrat_service(device.ip_address, device.port)
+            connection_result = redrat_service.test_connection(refresh_identity=True)
             
             # Update device status in database
             if connection_result['success']:
@@ -208,7 +240,6 @@ class RedRatDeviceService:
                 device_ports = connection_result['device_info'].get('ports')
                 
                 # Convert string device model to integer for database storage
-                from app.app import device_model_to_int
                 device_model = device_model_to_int(device_model_string)
                 
                 device.update_status('online', device_model, device_ports)
@@ -321,6 +352,10 @@ class RedRatDeviceService:
             ir.reset_device()
             time.sleep(0.5)  # Wait for reset to complete
             
+            # Pooled sessions hold pre-reset state, reconnect on next use
+            irnetbox_pool.close_device(device.ip_address, device.port)
+            device_identity_cache.invalidate(device.ip_address)
+            
             result['success'] = True
             result['message'] = f'Device {device.name} reset successfully'
             logger.info(f"Reset RedRat device: {device.name}")
@@ -388,7 +423,7 @@ class RedRatDeviceService:
             if device.is_active:
                 try:
                     # Test connection using RedRat service
-                    redrat_service = RedRatService(device.ip_address, device.port)
+                    redrat_service = create_redrat_service(device.ip_address, device.port)
                     connection_result = redrat_service.test_connection()
                     
                     if connection_result['success']:
@@ -402,7 +437,6 @@ class RedRatDeviceService:
                             device_status['device_ports'] = connection_result['device_info'].get('ports')
                             
                             # Convert string device model to integer for database storage
-                            from app.app import device_model_to_int
                             device_model_int = device_model_to_int(device_model_string)
                         else:
                             device_model_int = None
@@ -12,14 +12,20 @@ Based on: redratlib.py by David Rothlisberger
 
 import json
 import logging
+import os
 import time
 import threading
 from contextlib import contextmanager
-from typing import Dict, Any, Optional, List
+from typing import Callable, Dict, Any, Optional, List, Tuple
 import binascii
 
 # Import the new irnetbox_lib_new functionality
-from .irnetbox_lib_new import IRNetBox
+from .irnetbox_lib_new import IRNetBox, IRNetBoxError, IRSignal, OutputConfig, PowerLevel
+from .irnetbox_pool import irnetbox_pool
+from .signal_cache import CompiledSignal, compiled_signal_cache, compile_signal
+from .template_index import TemplateEntry, template_index
+from .sequence_plan import PlanStep, SequencePlan, SequenceTimer, fan_out, plan_fingerprint, sequence_plan_cache
+from .device_router import device_router
 
 try:
     from app.mysql_db import db
@@ -40,9 +46,32 @@ except ImportError:
             yield None
     db = MockDB()
 
+# Lateness (ms) after which a sequence's schedule is moved instead of caught up
+SEQUENCE_RESYNC_MS = float(os.getenv('REDRAT_SEQUENCE_RESYNC_MS', '50'))
+SEND_LATENCY_ALPHA = 0.2  # Weight of the newest sample in the send latency average
+
+
+def _power_to_level(power: int) -> PowerLevel:
+    """Map an IR power percentage (0-100) to the nearest IRNetBox power level."""
+    if power >= 75:
+        return PowerLevel.HIGH
+    elif power >= 50:
+        return PowerLevel.MEDIUM
+    elif power >= 25:
+        return PowerLevel.LOW
+    return PowerLevel.OFF
+
 
 class RedRatService:
-    """Enhanced RedRat service with web application integration."""
+    """Enhanced RedRat service with web application integration.
+    
+    One instance per device is shared through redrat_service_registry, so
+    double-signal alternation, port locks and timing statistics persist
+    between commands.
+    """
+    
+    BUSY_RETRY_TIMEOUT = 3.0  # Seconds an async send retries while its port is busy
+    BUSY_RETRY_INTERVAL = 0.05
     
     def __init__(self, host: str, port: int = 10001, timeout: int = 10):
         """Initialize the RedRat service.
@@ -55,9 +84,52 @@ class RedRatService:
         self.host = host
         self.port = port
         self.timeout = timeout
-        self._lock = threading.Lock()
+        self._lock = threading.Lock()  # Serializes connectivity checks
+        self._port_locks = {}  # Key: IR port, Value: lock held while a signal is sent on it
+        self._state_lock = threading.Lock()  # Guards alternation state, port locks and stats
         # Track alternation state for double signals (signal1 <-> signal2)
         self._alternation_state = {}  # Key: (remote_id, base_command), Value: 'signal1' or 'signal2'
+        self._stats = {
+            'sends': 0,
+            'failures': 0,
+            'send_time_total': 0.0,
+            'send_time_max': 0.0,
+            'send_latency': 0.0,  # EWMA of the one-way request latency in seconds
+            'last_sent_at': None
+        }
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get send counters and timing for this device."""
+        with self._state_lock:
+            stats = dict(self._stats)
+            stats['alternating_commands'] = len(self._alternation_state)
+        succeeded = stats['sends'] - stats['failures']
+        stats['send_time_avg'] = stats['send_time_total'] / succeeded if succeeded else 0.0
+        return stats
+    
+    @contextmanager
+    def _ports_locked(self, ports: List[int]):
+        """Hold the locks of the given IR ports (taken in port order to avoid deadlocks)."""
+        with self._state_lock:
+            locks = [self._port_locks.setdefault(port, threading.Lock()) for port in sorted(set(ports))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+    
+    def _record_send(self, elapsed: float, success: bool):
+        """Update the timing statistics after a transmission attempt."""
+        with self._state_lock:
+            self._stats['sends'] += 1
+            if not success:
+                self._stats['failures'] += 1
+                return
+            self._stats['send_time_total'] += elapsed
+            self._stats['send_time_max'] = max(self._stats['send_time_max'], elapsed)
+            self._stats['last_sent_at'] = time.time()
         
     def validate_device_and_port(self, ir_port: int = 1) -> Dict[str, Any]:
         """Validate that the RedRat device is accessible and the IR port is valid.
@@ -87,7 +159,7 @@ class RedRatService:
             logger.debug(f"Testing connectivity to RedRat device at {self.host}:{self.port}")
             
             with self._lock:
-                ir = IRNetBox(self.host)
+                ir = IRNetBox(self.host, self.port)
                 try:
                     if ir.connect():
                         result['device_accessible'] = True
@@ -99,23 +171,75 @@ class RedRatService:
                     ir.disconnect()
             
             result['success'] = True
+            irnetbox_pool.record_health(self.host, self.port, True)
             
         except Exception as e:
             result['error'] = f"Device validation failed: {str(e)}"
             logger.error(f"RedRat device validation error: {str(e)}")
+            irnetbox_pool.record_health(self.host, self.port, False, str(e))
             
         return result
         
+    def _check_port_and_health(self, ir_port: int) -> Dict[str, Any]:
+        """Cheap pre-send check that does not open a connection.
+        
+        Validates the port range and consults the pool's recent-health cache,
+        so a device that just failed to connect is reported immediately.
+        Actual connectivity is verified by the session used for transmission.
+        
+        Args:
+            ir_port: IR output port to validate (1-16)
+            
+        Returns:
+            Dict with validation results (same shape as validate_device_and_port)
+        """
+        result = {
+            'success': False,
+            'device_accessible': False,
+            'port_valid': False,
+            'error': None
+        }
+        
+        if not (1 <= ir_port <= 16):
+            result['error'] = f"Invalid IR port {ir_port}. Must be between 1 and 16"
+            return result
+        result['port_valid'] = True
+        
+        recent_error = irnetbox_pool.recent_failure(self.host, self.port)
+        if recent_error:
+            result['error'] = f"Device validation failed: {recent_error}"
+            return result
+        
+        result['device_accessible'] = True
+        result['success'] = True
+        return result
+        
     def send_command(self, command_id: int, remote_id: int, command_name: str, 
-                    ir_port: int = 1, power: int = 50) -> Dict[str, Any]:
+                    ir_port: int = 1, power: int = 50, validate_device: bool = False,
+                    ir_ports: List[int] = None, port_power: Dict[int, int] = None,
+                    enforce_timing: bool = True, presses: int = 1,
+                    press_interval_ms: int = 400) -> Dict[str, Any]:
         """Send a command to the RedRat device.
         
+        Device validation is folded into the session used for transmission,
+        so a command costs at most one connection setup. Pass
+        validate_device=True to force a separate connectivity round trip first.
+        
         Args:
             command_id: Database ID of the command
             remote_id: Database ID of the remote
             command_name: Name of the command to send
             ir_port: IR output port (1-16)
             power: IR power level (1-100)
+            validate_device: Run a full validate_device_and_port check before sending
+            ir_ports: Send to all of these ports in one transmission (overrides ir_port)
+            port_power: Power level per port; ports not listed use power
+            enforce_timing: Wait out MK-IV port cooldowns in this call; callers
+                that schedule around cooldowns themselves pass False
+            presses: Send the signal this many times in one session (a
+                press train), each press with its own toggle state
+            press_interval_ms: Spacing of the presses of a train (the post-delay of
+                each press on MK-III/MK-IV)
             
         Returns:
             Dict with execution results
@@ -124,42 +248,65 @@ class RedRatService:
             'success': False,
             'message': '',
             'command_id': command_id,
+            'presses': presses,
             'executed_at': None,
             'error_details': None
         }
         
+        ports = list(ir_ports) if ir_ports else [ir_port]
+        
         try:
-            # Validate device connectivity and port before executing command
-            logger.debug(f"Validating RedRat device and IR port {ir_port}")
-            validation_result = self.validate_device_and_port(ir_port)
-            if not validation_result['success']:
-                result['message'] = validation_result['error']
-                result['error_details'] = f"Device validation failed for port {ir_port}"
-                return result
+            # Validate port and recent device health; connectivity itself is
+            # checked by the session that sends the signal
+            for port in ports:
+                if validate_device and port == ports[0]:
+                    logger.debug(f"Validating RedRat device and IR port {port}")
+                    validation_result = self.validate_device_and_port(port)
+                else:
+                    validation_result = self._check_port_and_health(port)
+                if not validation_result['success']:
+                    result['message'] = validation_result['error']
+                    result['error_details'] = f"Device validation failed for port {port}"
+                    return result
             
-            logger.debug(f"Device validation successful, proceeding with command execution")
+            logger.debug(f"Device pre-check successful, proceeding with command execution")
             
-            # Get command template data from database
-            template_data = self._get_command_template(remote_id, command_name)
-            if not template_data:
+            # Get command template from the in-memory index
+            template = self._lookup_command_template(remote_id, command_name, ports)
+            if not template:
                 logger.error(f"Command '{command_name}' not found for remote {remote_id}")
                 result['message'] = f"Command '{command_name}' not found for remote {remote_id}"
                 return result
             
-
-            
-            # Convert JSON template data to binary IR data and extract IR parameters
-            ir_conversion_result = self._convert_template_to_ir_data(template_data)
-            if not ir_conversion_result:
+            # Wire-format signal, compiled once per template version
+            compiled = self._get_compiled_signal(template, command_name)
+            if not compiled:
                 result['message'] = "Failed to convert template data to IR signal"
                 return result
+            
+            # A double signal alternates its halves per press, so every press
+            # of a train advances the alternation once
+            press_signals = None
+            if presses > 1 and template.name != command_name:
+                press_signals = [compiled]
+                for _ in range(presses - 1):
+                    half = self._lookup_command_template(remote_id, command_name, ports)
+                    press_signals.append(self._get_compiled_signal(half, command_name) or compiled)
 
-            # Send command to RedRat device with IR parameters
-            execution_result = self._execute_ir_command(ir_port, power, ir_conversion_result)
+            # Send command to RedRat device
+            execution_result = self._execute_ir_command(ports[0], power, {}, ir_ports=ports,
+                                                        port_power=port_power, compiled=compiled,
+                                                        enforce_timing=enforce_timing, presses=presses,
+                                                        press_interval_ms=press_interval_ms,
+                                                        press_signals=press_signals)
             
             if execution_result['success']:
                 result['success'] = True
                 result['message'] = f"Command '{command_name}' sent successfully"
+                if len(ports) > 1:
+                    result['message'] += f" to ports {', '.join(str(p) for p in ports)}"
+                if presses > 1:
+                    result['message'] += f" ({presses} presses)"
                 result['executed_at'] = time.time()
                 
                 # Update command status in database
@@ -185,12 +332,34 @@ class RedRatService:
             
         return result
     
-    def send_sequence(self, sequence_id: int, commands: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def send_sequence(self, sequence_id: int, commands: List[Dict[str, Any]],
+                      enforce_timing: bool = True, ports: List[int] = None,
+                      progress: Callable[[int, Optional[str]], None] = None) -> Dict[str, Any]:
         """Send a sequence of commands to the RedRat device.
         
+        The sequence is compiled into a plan (cached until its commands or
+        templates change) and executed over one held session. Steps start
+        delay_ms after the start of the previous step, measured against
+        absolute deadlines so send time does not accumulate; the achieved
+        timing is returned under 'timing'. Steps of a parallel_group run
+        concurrently per port and RedRat device (see sequence_plan).
+        
+        With ports, the whole sequence runs on each of these ports of this
+        device side by side (a fleet run), with results per port under
+        'targets'. 'ports_used' lists the ports each RedRat device sent on,
+        so a caller scheduling port cooldowns can start them.
+        
         Args:
             sequence_id: Database ID of the sequence
             commands: List of command dictionaries with delay information
+            enforce_timing: Wait out MK-IV port cooldowns before the first
+                signal on each port; later steps follow the sequence's delays.
+                The command queue passes False: it holds the sequence back
+                until its ports are ready
+            ports: Run the sequence on each of these IR ports instead of the
+                ports and devices of its steps
+            progress: Called with (plan step index, error or None) as each
+                step is sent or skipped
             
         Returns:
             Dict with execution results
@@ -202,46 +371,53 @@ class RedRatService:
             'executed_commands': 0,
             'failed_commands': 0,
             'executed_at': None,
-            'errors': []
+            'errors': [],
+            'ports_used': []
         }
         
         try:
-            logger.info(f"Starting sequence {sequence_id} with {len(commands)} commands")
+            plan = self.compile_sequence(sequence_id, commands)
+            if ports:
+                plan = fan_out(plan, ports)
+                logger.info(f"Starting sequence {sequence_id} on ports {ports} ({len(plan.steps)} commands)")
+            else:
+                logger.info(f"Starting sequence {sequence_id} with {len(plan.steps)} commands")
             
-            for i, cmd in enumerate(commands):
-                try:
-                    # Send individual command
-                    cmd_result = self.send_command(
-                        cmd.get('id', 0),
-                        cmd.get('remote_id'),
-                        cmd.get('command'),
-                        cmd.get('ir_port', 1),
-                        cmd.get('power', 50)
-                    )
-                    
-                    if cmd_result['success']:
-                        result['executed_commands'] += 1
-                        logger.info(f"Sequence {sequence_id}: Command {i+1}/{len(commands)} succeeded")
-                    else:
-                        result['failed_commands'] += 1
-                        result['errors'].append({
-                            'command': cmd.get('command'),
-                            'error': cmd_result['message']
-                        })
-                        logger.error(f"Sequence {sequence_id}: Command {i+1}/{len(commands)} failed: {cmd_result['message']}")
-                    
-                    # Apply delay if specified
-                    delay_ms = cmd.get('delay_ms', 0)
-                    if delay_ms > 0:
-                        time.sleep(delay_ms / 1000.0)
-                        
-                except Exception as e:
+            errors, result['timing'] = self._run_plan(plan, enforce_timing, progress)
+            for i, (step, error) in enumerate(zip(plan.steps, errors)):
+                if error is None:
+                    result['executed_commands'] += 1
+                    logger.info(f"Sequence {sequence_id}: Command {i+1}/{len(plan.steps)} succeeded")
+                else:
                     result['failed_commands'] += 1
                     result['errors'].append({
-                        'command': cmd.get('command', 'unknown'),
-                        'error': str(e)
+                        'command': step.command,
+                        'error': error
+                    })
+                    logger.error(f"Sequence {sequence_id}: Command {i+1}/{len(plan.steps)} failed: {error}")
+            
+            used = {}
+            for step, error in zip(plan.steps, errors):
+                service = self if step.device_id is None or error else self._device_service(step.device_id)
+                if error is None and service:
+                    used.setdefault((service.host, service.port), set()).update(step.ports)
+            result['ports_used'] = [{'host': host, 'port': port, 'ports': sorted(used_ports)}
+                                    for (host, port), used_ports in used.items()]
+            
+            if ports:
+                count = len(plan.steps) // len(ports)
+                result['targets'] = []
+                for target, port in enumerate(ports):
+                    failed = [{'command': step.command, 'error': error}
+                              for step, error in zip(plan.steps[target * count:(target + 1) * count],
+                                                     errors[target * count:(target + 1) * count]) if error]
+                    result['targets'].append({
+                        'ir_port': port,
+                        'success': bool(count) and not failed,
+                        'executed_commands': count - len(failed),
+                        'failed_commands': len(failed),
+                        'errors': failed
                     })
-                    logger.error(f"Sequence {sequence_id}: Command {i+1}/{len(commands)} exception: {str(e)}")
             
             # Determine overall success
             if result['executed_commands'] > 0 and result['failed_commands'] == 0:
@@ -263,9 +439,321 @@ class RedRatService:
             
         return result
     
-    def test_connection(self) -> Dict[str, Any]:
+    def compile_sequence(self, sequence_id: int, commands: List[Dict[str, Any]]) -> SequencePlan:
+        """Get the execution plan of a sequence, compiling it on a cache miss.
+        
+        Templates of all steps are resolved from the template index in one
+        pass and their signals compiled; steps that cannot be sent carry an
+        error instead of a signal.
+        
+        Args:
+            sequence_id: Database ID of the sequence
+            commands: List of command dictionaries with delay information
+            
+        Returns:
+            SequencePlan (shared by all devices; it holds no device state)
+        """
+        fingerprint = plan_fingerprint(commands)
+        generation = template_index.generation  # Read first: a change while compiling makes the plan stale
+        plan = sequence_plan_cache.get(sequence_id, fingerprint, generation)
+        if plan:
+            return plan
+        
+        steps = []
+        for cmd in commands:
+            command_name = cmd.get('command')
+            remote_id = cmd.get('remote_id')
+            port = int(cmd.get('ir_port') or 1)
+            group, device_id = cmd.get('parallel_group'), cmd.get('redrat_device_id')
+            step = PlanStep(command_name, remote_id, [port], cmd.get('power') or 50, int(cmd.get('delay_ms') or 0),
+                            group=int(group) if group is not None else None,
+                            device_id=int(device_id) if device_id is not None else None)
+            steps.append(step)
+            
+            if not 1 <= port <= 16:
+                step.error = f"Invalid IR port {port}. Must be between 1 and 16"
+                continue
+            exact, double_signal = template_index.lookup(remote_id, command_name)
+            if double_signal:
+                step.double_signal = tuple(self._get_compiled_signal(t, command_name) if t else None
+                                           for t in double_signal)
+                if not any(step.double_signal):
+                    step.error = "Failed to convert template data to IR signal"
+            elif exact:
+                step.compiled = self._get_compiled_signal(exact, command_name)
+                if not step.compiled:
+                    step.error = "Failed to convert template data to IR signal"
+            else:
+                step.error = f"Command '{command_name}' not found for remote {remote_id}"
+        
+        plan = SequencePlan(sequence_id, fingerprint, generation, steps)
+        sequence_plan_cache.put(plan)
+        logger.debug(f"Compiled plan for sequence {sequence_id} ({len(steps)} steps)")
+        return plan
+    
+    def _run_plan(self, plan: SequencePlan, enforce_timing: bool = True,
+                  progress: Callable[[int, Optional[str]], None] = None) -> Tuple[List[Optional[str]], Dict[str, Any]]:
+        """Run the stages of a plan, each stage's branches concurrently.
+        
+        Branches on this device are interleaved over its session; branches
+        on other RedRat devices run in a thread per device. A stage ends when
+        every branch is done, including its last delay. progress is called
+        with (step index, error) for every step as it is sent or skipped.
+        
+        Returns:
+            Tuple of (error per step, None for steps that were sent;
+            achieved timing: per-step and per-branch SequenceTimer records,
+            jitter summary and wall-clock vs serial time)
+        """
+        steps = plan.steps
+        errors = [step.error for step in steps]
+        records = [None] * len(steps)
+        branch_reports = []
+        started = time.monotonic()
+        
+        for stage_no, stage in enumerate(plan.stages):
+            # Branches grouped by the service of their device
+            services = {}
+            for branch in stage:
+                device_id = steps[branch[0]].device_id
+                service = self if device_id is None else self._device_service(device_id)
+                if service is None:
+                    for index in branch:
+                        errors[index] = errors[index] or f"RedRat device {device_id} is not active or does not exist"
+                        records[index] = {'command': steps[index].command, 'error': errors[index]}
+                        if progress:
+                            progress(index, errors[index])
+                    continue
+                services.setdefault(service, []).append(branch)
+            
+            def run(service, branches):
+                try:
+                    reports = service._run_branches(plan, branches, errors, records, enforce_timing, progress)
+                except Exception as e:
+                    logger.error(f"Sequence {plan.sequence_id}: branches on {service.host} failed: {str(e)}")
+                    for index in [index for branch in branches for index in branch if records[index] is None]:
+                        errors[index] = errors[index] or str(e)
+                        records[index] = {'command': steps[index].command, 'error': errors[index]}
+                        if progress:
+                            progress(index, errors[index])
+                    return
+                for report in reports:
+                    report['stage'] = stage_no
+                branch_reports.extend(reports)
+            
+            workers = [threading.Thread(target=run, args=(service, branches), daemon=True,
+                                        name=f"redrat-branch-{service.host}")
+                       for service, branches in services.items() if service is not self]
+            for worker in workers:
+                worker.start()
+            if self in services:
+                run(self, services[self])
+            for worker in workers:
+                worker.join()  # Barrier: the next stage starts when every branch is done
+        
+        sent = [record for record in records if record and 'jitter_ms' in record]
+        jitters = [abs(record['jitter_ms']) for record in sent]
+        stage_spans = {}
+        for report in branch_reports:
+            stage_spans[report['stage']] = max(stage_spans.get(report['stage'], 0.0), report['planned_ms'])
+        timing = {
+            'planned_ms': round(sum(stage_spans.values()), 3),
+            'elapsed_ms': round((time.monotonic() - started) * 1000, 3),
+            'serial_ms': round(sum(report['span_ms'] for report in branch_reports), 3),
+            'jitter_avg_ms': round(sum(jitters) / len(jitters), 3) if jitters else 0.0,
+            'jitter_max_ms': max(jitters) if jitters else 0.0,
+            'resyncs': sum(report['resyncs'] for report in branch_reports),
+            'steps': [record or {'command': step.command} for step, record in zip(steps, records)],
+            'branches': sorted(branch_reports, key=lambda report: (report['stage'], report['steps'][0]))
+        }
+        logger.debug(f"Sequence {plan.sequence_id} timing: {timing['elapsed_ms']}ms "
+                     f"(serial {timing['serial_ms']}ms), jitter avg {timing['jitter_avg_ms']}ms, "
+                     f"max {timing['jitter_max_ms']}ms, {timing['resyncs']} resync(s)")
+        return errors, timing
+    
+    def _device_service(self, device_id: int) -> Optional['RedRatService']:
+        """Shared service of an active RedRat device, or None."""
+        device = device_router.get(device_id)
+        if not device:
+            return None
+        return redrat_service_registry.get(device['ip_address'], device['port'])
+    
+    def _run_branches(self, plan: SequencePlan, branches: List[List[int]], errors: List[Optional[str]],
+                      records: List[Optional[Dict[str, Any]]], enforce_timing: bool,
+                      progress: Callable[[int, Optional[str]], None] = None) -> List[Dict[str, Any]]:
+        """Send branches of plan steps over one held session of this device on a drift-free schedule.
+        
+        Each branch has its own SequenceTimer: its steps are due at absolute
+        monotonic deadlines spaced by their delays and are issued early by
+        the measured send latency. The step with the earliest deadline of
+        any branch is sent next. A failed transmission closes the session;
+        the remaining steps are sent over a new one. If no session can be
+        opened, the remaining steps fail with that error.
+        
+        Args:
+            plan: Plan the branches belong to
+            branches: Lists of step indices, each sent in order
+            errors: Error per plan step, filled in for failed steps
+            records: Timing record per plan step, filled in
+            enforce_timing: Wait out MK-IV port cooldowns before the first
+                signal on each port
+            progress: Called with (step index, error or None) per step
+        
+        Returns:
+            Timing report per branch
+        """
+        steps = plan.steps
+        timers = [SequenceTimer(lead=self._stats['send_latency'], resync_ms=SEQUENCE_RESYNC_MS) for _ in branches]
+        positions = [0] * len(branches)
+        
+        def skip(b, index, error):
+            errors[index] = error
+            timers[b].skipped(steps[index], error)
+            records[index] = dict(timers[b].steps[-1], branch=branches[b][0] + 1)
+            if progress:
+                progress(index, error)
+        
+        def begin():
+            start = time.monotonic()  # Connection setup is not part of the schedule
+            for timer in timers:
+                timer.begin(start)
+        
+        if all(errors[index] for branch in branches for index in branch):
+            begin()
+            for b, branch in enumerate(branches):
+                for index in branch:
+                    skip(b, index, errors[index])
+            positions = [len(branch) for branch in branches]
+        
+        used_ports = set()
+        ports = sorted({port for branch in branches for index in branch for port in steps[index].ports})
+        with self._ports_locked(ports):
+            while any(position < len(branch) for position, branch in zip(positions, branches)):
+                sending = None
+                try:
+                    with irnetbox_pool.session(self.host, self.port) as ir:
+                        if timers[0].started_at is None:
+                            begin()
+                        while True:
+                            live = [b for b, branch in enumerate(branches) if positions[b] < len(branch)]
+                            if not live:
+                                break
+                            b = min(live, key=lambda b: timers[b].deadline)
+                            index = branches[b][positions[b]]
+                            positions[b] += 1
+                            step = steps[index]
+                            if errors[index]:
+                                skip(b, index, errors[index])
+                                continue
+                            timers[b].wait()
+                            sending = b, index
+                            started_at, rtt = self._send_plan_step(ir, step, positions[b] == len(branches[b]),
+                                                                   enforce_timing and not (used_ports & set(step.ports)))
+                            sending = None
+                            used_ports.update(step.ports)
+                            self._record_send(rtt, True)
+                            timers[b].sent(step, started_at, rtt)
+                            records[index] = dict(timers[b].steps[-1], branch=branches[b][0] + 1)
+                            if progress:
+                                progress(index, None)
+                        for timer in timers:
+                            timer.finish()
+                except Exception as e:
+                    if timers[0].started_at is None:
+                        begin()
+                    if sending is None:
+                        # No session: nothing else can be sent
+                        for b, branch in enumerate(branches):
+                            for index in branch[positions[b]:]:
+                                skip(b, index, errors[index] or str(e))
+                            positions[b] = len(branch)
+                        logger.error(f"Sequence {plan.sequence_id}: no session to {self.host}: {str(e)}")
+                        break
+                    skip(*sending, str(e))
+                    self._record_send(0.0, False)
+        
+        reports = []
+        for b, branch in enumerate(branches):
+            report = timers[b].report()
+            del report['steps']
+            report.update({
+                'branch': branch[0] + 1,
+                'device': f"{self.host}:{self.port}",
+                'ports': sorted({port for index in branch for port in steps[index].ports}),
+                'steps': [index + 1 for index in branch]
+            })
+            reports.append(report)
+        return reports
+    
+    def _send_plan_step(self, ir: IRNetBox, step: PlanStep, last: bool, enforce_timing: bool) -> Tuple[float, float]:
+        """Transmit one plan step, retrying while its port is still busy with the previous signal.
+        
+        Returns:
+            Tuple of (estimated monotonic start of the signal, request round trip in seconds)
+            
+        Raises:
+            IRNetBoxError: If the device rejects the signal
+        """
+        compiled = step.compiled
+        if step.double_signal:
+            signal1, signal2 = step.double_signal
+            preferred = self._next_double_signal(step.remote_id, step.command, step.ports)
+            compiled = (signal1 if preferred == 'signal1' else signal2) or signal1 or signal2
+        
+        output_configs = [OutputConfig(port=p, power_level=_power_to_level(step.power)) for p in step.ports]
+        signal_binary = compiled_signal_cache.next_variant(compiled, (self.host, self.port, tuple(step.ports)))
+        if not (hasattr(ir, 'device_type') and ir.device_type.value in ['MK-III', 'MK-IV']):
+            # Older devices send synchronously; the signal starts when the request is issued
+            issued_at = time.monotonic()
+            ir.send_signal(compiled.signal, output_configs=output_configs, signal_binary=signal_binary)
+            return issued_at, time.monotonic() - issued_at
+        
+        # Spacing is kept by the schedule, so between steps the device only
+        # adds its minimum post-delay; the last step keeps the usual 500ms
+        post_delay_ms = 500 if last else 100
+        return self._send_async_when_free(ir, compiled.signal, output_configs, post_delay_ms,
+                                          enforce_timing, signal_binary)
+    
+    def _send_async_when_free(self, ir: IRNetBox, signal: IRSignal, output_configs: List[OutputConfig],
+                              post_delay_ms: int, enforce_timing: bool,
+                              signal_binary: bytes = None) -> Tuple[float, float]:
+        """Send an MSG_ASYNC_OUTPUT, retrying while a port is still busy with the previous signal.
+        
+        The device keeps a port busy for the signal plus its post-delay, so
+        a send issued right after the previous one goes out as soon as the
+        port is free.
+        
+        Returns:
+            Tuple of (estimated monotonic start of the signal, request round trip in seconds)
+            
+        Raises:
+            IRNetBoxError: If the device rejects the signal or stays busy
+                for BUSY_RETRY_TIMEOUT seconds
+        """
+        busy_until = time.monotonic() + self.BUSY_RETRY_TIMEOUT
+        while True:
+            issued_at = time.monotonic()
+            try:
+                ir.send_signal_async(signal, output_configs, post_delay_ms=post_delay_ms,
+                                     enforce_timing=enforce_timing, signal_binary=signal_binary)
+            except IRNetBoxError as e:
+                if 'busy' not in str(e).lower() or time.monotonic() >= busy_until:
+                    raise
+                time.sleep(self.BUSY_RETRY_INTERVAL)
+                continue
+            rtt = time.monotonic() - issued_at
+            with self._state_lock:
+                # One-way latency estimate used to issue later steps early
+                self._stats['send_latency'] += SEND_LATENCY_ALPHA * (rtt / 2 - self._stats['send_latency'])
+            return issued_at + rtt / 2, rtt
+    
+    def test_connection(self, refresh_identity: bool = False) -> Dict[str, Any]:
         """Test connection to RedRat device.
         
+        Args:
+            refresh_identity: Rediscover device type, firmware and serial
+                instead of using the cached device identity
+        
         Returns:
             Dict with connection test results
         """
@@ -279,9 +767,9 @@ class RedRatService:
         try:
             start_time = time.time()
             
-            ir = IRNetBox(self.host)
+            ir = IRNetBox(self.host, self.port)
             try:
-                if ir.connect():
+                if ir.connect(use_identity_cache=not refresh_identity):
                     device_info = ir.get_device_info()
                     # Get device model safely
                     device_model = device_info.get('device_type', 'Unknown')
@@ -291,7 +779,9 @@ class RedRatService:
                         'model': device_model,
                         'ports': 16,  # Standard for IRNetBox
                         'host': self.host,
-                        'port': self.port
+                        'port': self.port,
+                        'firmware_version': ir.firmware_version,
+                        'serial_number': ir.serial_number
                     }
                 else:
                     result['message'] = "Failed to connect to RedRat device"
@@ -316,7 +806,7 @@ class RedRatService:
         return result
     
     def _get_command_template(self, remote_id: int, command_name: str) -> Optional[Dict[str, Any]]:
-        """Get command template data from database with automatic alternation between signal1 and signal2.
+        """Get command template data with automatic alternation between signal1 and signal2.
         
         Args:
             remote_id: Database ID of the remote
@@ -325,77 +815,119 @@ class RedRatService:
         Returns:
             Template data as dictionary or None if not found
         """
+        template = self._lookup_command_template(remote_id, command_name)
+        if not template:
+            return None
+        return template.data
+    
+    def _lookup_command_template(self, remote_id: int, command_name: str,
+                                 ports: List[int] = None) -> Optional[TemplateEntry]:
+        """Find the command template to send, alternating between signal1 and signal2.
+        
+        Args:
+            remote_id: Database ID of the remote
+            command_name: Name of the command
+            ports: IR ports the signal goes to; alternation is kept per port set
+            
+        Returns:
+            Indexed template or None if not found
+        """
+        logger.debug(f"Looking for template: command='{command_name}', remote_id={remote_id}")
+        exact, double_signal = template_index.lookup(remote_id, command_name)
+        
+        # PRIORITY: Alternating double signals (signal1/signal2) take
+        # precedence over a single command of the same name
+        if double_signal:
+            # Use alternation state to switch between signal1 and signal2
+            preferred = self._next_double_signal(remote_id, command_name, ports)
+            signal1, signal2 = double_signal
+            template = signal1 if preferred == 'signal1' else signal2
+            if template:
+                logger.debug(f"Using alternating signal '{template.name}' for command '{command_name}' on remote {remote_id}")
+                return template
+            
+            # If preferred signal not found, use the one that exists
+            template = signal1 or signal2
+            logger.debug(f"Preferred signal not found, using double signal '{template.name}' for command '{command_name}' on remote {remote_id}")
+            return template
+        
+        if exact:
+            logger.debug(f"Found exact template for command '{command_name}' on remote {remote_id}")
+            return exact
+        
+        logger.warning(f"No template found for command '{command_name}' on remote {remote_id}")
+        return None
+    
+    def _next_double_signal(self, remote_id: int, command_name: str, ports: List[int] = None) -> str:
+        """Advance the alternation of a double signal on an IR output of this device.
+        
+        Every box tracks the toggle of its own port, so the state is kept per
+        port set; interleaved sends to several boxes do not disturb each other.
+        
+        Returns:
+            'signal1' or 'signal2'
+        """
+        alternation_key = (remote_id, command_name, tuple(ports or ()))
+        with self._state_lock:
+            current_state = self._alternation_state.get(alternation_key, 'signal2')  # Start with signal2 so first call uses signal1
+            preferred = 'signal2' if current_state == 'signal1' else 'signal1'
+            self._alternation_state[alternation_key] = preferred
+        return preferred
+    
+    def _get_compiled_signal(self, template: TemplateEntry, command_name: str) -> Optional[CompiledSignal]:
+        """Get the wire-format signal for a template, compiling it on a cache miss.
+        
+        Args:
+            template: Indexed command template
+            command_name: Name used for the signal
+            
+        Returns:
+            CompiledSignal or None if the template cannot be converted
+        """
+        compiled = compiled_signal_cache.get(template.id, template.content_hash)
+        if compiled:
+            return compiled
+        
+        template_data = template.data
+        if not template_data:
+            return None
+        ir_params = self._convert_template_to_ir_data(template_data)
+        if not ir_params:
+            return None
+        
+        signal = self._build_ir_signal(ir_params, command_name, f"template_{template.id}",
+                                       self._parse_toggle_data(template_data.get('toggle_data')))
+        compiled = compile_signal(template.id, template.content_hash, signal)
+        compiled_signal_cache.put(compiled)
+        logger.debug(f"Compiled signal for template {template.id} ({len(compiled.variants)} variant(s))")
+        return compiled
+    
+    def _parse_toggle_data(self, toggle_data) -> Optional[Dict[int, tuple]]:
+        """Convert template toggle data ([{bitNo, len1, len2}]) to IRSignal format."""
+        if not toggle_data:
+            return None
+        if isinstance(toggle_data, dict):
+            return {int(bit_no): tuple(values) for bit_no, values in toggle_data.items()}
         try:
-            with db.get_connection() as conn:
-                if not conn:
-                    logger.error("Database connection failed")
-                    return None
-                    
-                cursor = conn.cursor()
-                
-                logger.debug(f"Looking for template: command='{command_name}', remote_id={remote_id}")
-                
-                # PRIORITY: Check for alternating double signals first (signal1/signal2)
-                # This gives precedence to IRNetBox double signals over single commands
-                signal1_name = f"{command_name}_signal1"
-                signal2_name = f"{command_name}_signal2"
-                
-                # Check for double signals first
-                cursor.execute("""
-                    SELECT ct.name, ct.template_data 
-                    FROM command_templates ct
-                    WHERE ct.name IN (%s, %s) AND ct.file_id = %s
-                    ORDER BY ct.name
-                """, (signal1_name, signal2_name, remote_id))
-                
-                double_signals = cursor.fetchall()
-                if double_signals:
-                    # Use alternation state to switch between signal1 and signal2
-                    alternation_key = (remote_id, command_name)
-                    current_state = self._alternation_state.get(alternation_key, 'signal2')  # Start with signal2 so first call uses signal1
-                    
-                    if current_state == 'signal1':
-                        # Switch to signal2
-                        self._alternation_state[alternation_key] = 'signal2'
-                        preferred_signal = signal2_name
-                    else:
-                        # Switch to signal1
-                        self._alternation_state[alternation_key] = 'signal1'
-                        preferred_signal = signal1_name
-                    
-                    # Find the preferred signal in results
-                    for signal_name, signal_data in double_signals:
-                        if signal_name == preferred_signal:
-                            logger.debug(f"Using alternating signal '{preferred_signal}' for command '{command_name}' on remote {remote_id}")
-                            return self._parse_template_data(signal_data)
-                    
-                    # If preferred signal not found, use the first available double signal
-                    logger.debug(f"Preferred signal '{preferred_signal}' not found, using first available double signal '{double_signals[0][0]}' for command '{command_name}' on remote {remote_id}")
-                    return self._parse_template_data(double_signals[0][1])
-                
-                # Fallback: Direct lookup using file_id which matches remote_id
-                cursor.execute("""
-                    SELECT ct.template_data 
-                    FROM command_templates ct
-                    WHERE ct.name = %s AND ct.file_id = %s
-                    LIMIT 1
-                """, (command_name, remote_id))
-                
-                result = cursor.fetchone()
-                if result:
-                    logger.debug(f"Found exact template for command '{command_name}' on remote {remote_id}")
-                    return self._parse_template_data(result[0])
-                
-                logger.warning(f"No template found for command '{command_name}' on remote {remote_id}")
-                cursor.close()
-                return None
-                
-        except Exception as e:
-            logger.error(f"Error getting command template: {e}")
-            import traceback
-            traceback.print_exc()
+            return {int(bit['bitNo']): (int(bit['len1']), int(bit['len2'])) for bit in toggle_data}
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Ignoring invalid toggle data: {e}")
             return None
     
+    def _build_ir_signal(self, ir_params: Dict[str, Any], name: str, uid: str,
+                         toggle_data: Optional[Dict[int, tuple]] = None) -> IRSignal:
+        """Create an IRSignal from converted template parameters."""
+        return IRSignal(
+            name=name,
+            uid=uid,
+            modulation_freq=ir_params.get('modulation_freq') or 38000,  # Default to 38kHz if not specified
+            lengths=ir_params.get('lengths', []),  # Use lengths from XML data
+            sig_data=ir_params['ir_data'],
+            no_repeats=ir_params.get('no_repeats', 1),
+            intra_sig_pause=ir_params.get('intra_sig_pause', 100),
+            toggle_data=toggle_data
+        )
+    
     def _parse_template_data(self, template_data) -> Optional[Dict[str, Any]]:
         """Parse template data from database format to dictionary.
         
@@ -616,13 +1148,30 @@ class RedRatService:
             
         return None
     
-    def _execute_ir_command(self, ir_port: int, power: int, ir_params: Dict[str, Any]) -> Dict[str, Any]:
+    def _execute_ir_command(self, ir_port: int, power: int, ir_params: Dict[str, Any],
+                            ir_ports: List[int] = None, port_power: Dict[int, int] = None,
+                            compiled: CompiledSignal = None, enforce_timing: bool = True,
+                            presses: int = 1, press_interval_ms: int = 400,
+                            press_signals: List[CompiledSignal] = None) -> Dict[str, Any]:
         """Execute IR command on RedRat device with IR parameters.
         
+        On MK-III/MK-IV all ports are driven by a single MSG_ASYNC_OUTPUT,
+        whose power array carries one level per port.
+        
         Args:
             ir_port: IR output port
             power: IR power level
-            ir_params: Dict containing IR data and parameters
+            ir_params: Dict containing IR data and parameters (ignored if compiled is given)
+            ir_ports: Ports to send to in one transmission (defaults to [ir_port])
+            port_power: Power level per port; ports not listed use power
+            compiled: Precompiled signal; the next toggle variant is sent as-is
+            enforce_timing: Wait out MK-IV port cooldowns before sending
+            presses: Number of times to send the signal on this session
+            press_interval_ms: Spacing of the presses; on MK-III/MK-IV it is
+                the post-delay of each press, so the device keeps the port
+                busy and the next press goes out as soon as it is free
+            press_signals: Precompiled signal per press (e.g. alternating
+                halves of a double signal); defaults to compiled for every press
             
         Returns:
             Dict with execution results
@@ -634,87 +1183,79 @@ class RedRatService:
         }
         
         try:
-            ir_data = ir_params.get('ir_data')
-            if not ir_data:
-                result['error'] = "No IR data provided"
-                return result
-                
-            modulation_freq = ir_params.get('modulation_freq')
-            no_repeats = ir_params.get('no_repeats', 1)
-            intra_sig_pause = ir_params.get('intra_sig_pause', 100)
-            
-            logger.info(f"Executing IR command: port={ir_port}, power={power}, repeats={no_repeats}, pause={intra_sig_pause}ms")
-            if modulation_freq:
-                logger.info(f"Modulation frequency: {modulation_freq}Hz")
-            
-            with self._lock:  # Ensure thread safety
-                # Validate port number is within reasonable range
-                if not (1 <= ir_port <= 16):
-                    result['error'] = f"Invalid IR port {ir_port}. Must be between 1 and 16"
+            ports = list(ir_ports) if ir_ports else [ir_port]
+            port_power = port_power or {}
+            
+            if compiled:
+                signal = compiled.signal
+            else:
+                if not ir_params.get('ir_data'):
+                    result['error'] = "No IR data provided"
                     return result
+                # Create signal object using the actual command name from template
+                signal = self._build_ir_signal(ir_params, ir_params.get('command_name', f"Command_{ports[0]}"),
+                                               f"cmd_{ports[0]}_{int(time.time())}")
+            
+            logger.info(f"Executing IR command: ports={ports}, power={power}, repeats={signal.no_repeats}, pause={signal.intra_sig_pause}ms")
+            logger.info(f"Modulation frequency: {signal.modulation_freq}Hz")
+            
+            # Validate port numbers are within reasonable range
+            invalid_ports = [p for p in ports if not (1 <= p <= 16)]
+            if invalid_ports:
+                result['error'] = f"Invalid IR port {invalid_ports[0]}. Must be between 1 and 16"
+                return result
+            
+            started = time.monotonic()
+            with self._ports_locked(ports):  # One transmission per port at a time
                 
-                ir = IRNetBox(self.host)
-                try:
-                    # Connect to device
-                    logger.debug(f"Connecting to RedRat device at {self.host}")
-                    if not ir.connect():
-                        result['error'] = "Failed to connect to RedRat device"
-                        return result
-                    
-                    logger.debug(f"Device ready, sending IR signal to port {ir_port}")
+                # Borrow an initialised session from the pool; a failure inside
+                # the block closes the session so the next command reconnects
+                with irnetbox_pool.session(self.host, self.port) as ir:
+                    logger.debug(f"Device ready, sending IR signal to ports {ports}")
                     
-                    # Create IRSignal object from the data
-                    from .irnetbox_lib_new import IRSignal, OutputConfig, PowerLevel
+                    # Map power percentage to PowerLevel enum, per port
+                    output_configs = [OutputConfig(port=p, power_level=_power_to_level(port_power.get(p, power)))
+                                      for p in ports]
                     
-                    # Map power percentage to PowerLevel enum
-                    if power >= 75:
-                        power_level = PowerLevel.HIGH
-                    elif power >= 50:
-                        power_level = PowerLevel.MEDIUM
-                    elif power >= 25:
-                        power_level = PowerLevel.LOW
-                    else:
-                        power_level = PowerLevel.OFF
-                    
-                    # Extract lengths from IR data if available
-                    lengths = ir_params.get('lengths', [])
-                    
-                    # Create signal object using the actual command name from template
-                    command_name = ir_params.get('command_name', f"Command_{ir_port}")
-                    signal = IRSignal(
-                        name=command_name,
-                        uid=f"cmd_{ir_port}_{int(time.time())}",
-                        modulation_freq=modulation_freq or 38000,  # Default to 38kHz if not specified
-                        lengths=lengths,  # Use lengths from XML data
-                        sig_data=ir_data,
-                        no_repeats=no_repeats,
-                        intra_sig_pause=intra_sig_pause
-                    )
-                    
-                    # Send the signal using ASYNC protocol
-                    output_configs = [OutputConfig(port=ir_port, power_level=power_level)]
-                    
-                    # Force ASYNC mode for MK-III/MK-IV devices
-                    if hasattr(ir, 'device_type') and ir.device_type.value in ['MK-III', 'MK-IV']:
-                        # Use async protocol with sequence number and proper timing
-                        seq_num = ir.send_signal_async(signal, output_configs, post_delay_ms=500, enforce_timing=True)
-                        logger.info(f"Sent ASYNC signal with sequence {seq_num}")
-                    else:
-                        # Fallback to regular send for older devices
-                        ir.send_signal(signal, [ir_port], power_level)
-                    
-                finally:
-                    ir.disconnect()
-                    
-                    logger.debug(f"IR command completed successfully on port {ir_port}")
-                    result['success'] = True
-                    result['repeats_sent'] = no_repeats
-                    result['port_used'] = ir_port
+                    presses = max(1, presses)
+                    for press in range(presses):
+                        # Precompiled wire format, with this device's toggle state applied
+                        press_compiled = press_signals[press] if press_signals else compiled
+                        signal_binary = None
+                        if press_compiled:
+                            signal = press_compiled.signal
+                            signal_binary = compiled_signal_cache.next_variant(press_compiled,
+                                                                               (self.host, self.port, tuple(ports)))
+                        
+                        # Force ASYNC mode for MK-III/MK-IV devices
+                        if hasattr(ir, 'device_type') and ir.device_type.value in ['MK-III', 'MK-IV']:
+                            # Use async protocol; the post-delay spaces the presses of a
+                            # train on the device, and the port cooldown applies between
+                            # trains, not between their presses
+                            self._send_async_when_free(ir, signal, output_configs,
+                                                       500 if press == presses - 1 else press_interval_ms,
+                                                       enforce_timing and not press, signal_binary)
+                            logger.info(f"Sent ASYNC press {press + 1}/{presses} to ports {ports}")
+                        else:
+                            # Fallback to regular send for older devices, which have
+                            # no post-delay: space the presses on the host
+                            if press:
+                                time.sleep(press_interval_ms / 1000.0)
+                            ir.send_signal(signal, output_configs=output_configs, signal_binary=signal_binary)
+                
+                logger.debug(f"IR command completed successfully on ports {ports}")
+                self._record_send(time.monotonic() - started, True)
+                result['success'] = True
+                result['repeats_sent'] = signal.no_repeats
+                result['presses_sent'] = presses
+                result['port_used'] = ports[0]
+                result['ports_used'] = ports
                     
         except Exception as e:
             result['error'] = str(e)
             result['error_details'] = str(e)
             logger.error(f"Error executing IR command: {str(e)}")
+            self._record_send(0.0, False)
             
         return result
     
@@ -756,19 +1297,59 @@ class RedRatService:
             logger.error(f"Error updating command status: {str(e)}")
 
 
-# Factory function for creating RedRat service instances
+class RedRatServiceRegistry:
+    """Long-lived RedRatService instances, one per device (host, port)."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._services = {}  # Key: (host, port), Value: RedRatService
+    
+    def get(self, host: str, port: int = 10001, timeout: int = 10) -> RedRatService:
+        """Get the service of a device, creating it on first use."""
+        key = (host, int(port))
+        with self._lock:
+            service = self._services.get(key)
+            if service is None:
+                service = self._services[key] = RedRatService(host, int(port), timeout)
+            return service
+    
+    def remove(self, host: str, port: int = 10001):
+        """Forget the service of a device (e.g. its address changed)."""
+        with self._lock:
+            self._services.pop((host, int(port)), None)
+    
+    def retain_devices(self, devices: List[Dict[str, Any]]):
+        """Drop services of devices that are no longer active (device_router listener)."""
+        active = {(d['ip_address'], int(d['port'])) for d in devices}
+        with self._lock:
+            for key in [k for k in self._services if k not in active]:
+                del self._services[key]
+    
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get the statistics of every device service."""
+        with self._lock:
+            services = list(self._services.items())
+        return {f"{host}:{port}": service.get_stats() for (host, port), service in services}
+
+
+# Shared services of this process; devices removed from routing are dropped
+redrat_service_registry = RedRatServiceRegistry()
+device_router.add_listener(redrat_service_registry.retain_devices)
+
+
+# Factory function for RedRat service instances
 def create_redrat_service(host: str, port: int = 10001, timeout: int = 10) -> RedRatService:
-    """Create a RedRat service instance.
+    """Get the shared RedRat service instance of a device.
     
     Args:
         host: RedRat device IP address or hostname
         port: RedRat device port (default 10001)
-        timeout: Connection timeout in seconds
+        timeout: Connection timeout in seconds (used when the instance is created)
         
     Returns:
         RedRatService instance
     """
-    return RedRatService(host, port, timeout)
+    return redrat_service_registry.get(host, port, timeout)
 
 
 # Singleton instance for the application
@@ -230,6 +230,7 @@ def import_remotes_to_db(remotes, user_id=None):
                 raise Exception("No admin user found and no user ID provided")
     
     imported_count = 0
+    updated_template_ids = []
     
     # Process each remote
     for remote in remotes:
@@ -327,6 +328,7 @@ def import_remotes_to_db(remotes, user_id=None):
                         "UPDATE command_templates SET template_data = %s WHERE id = %s",
                         (json.dumps(template_data), result[0])
                     )
+                    updated_template_ids.append(result[0])
 
                 else:
                     # Create new template linked to remote_id (use remote_id as file_id for compatibility)
@@ -339,6 +341,16 @@ def import_remotes_to_db(remotes, user_id=None):
 
                 
                 conn.commit()
+    
+    # Re-imported templates must be recompiled before their next use
+    if updated_template_ids:
+        from app.services.signal_cache import compiled_signal_cache
+        for template_id in updated_template_ids:
+            compiled_signal_cache.invalidate(template_id)
+    
+    # Imported and updated templates are re-read on the next send
+    from app.services.template_index import template_index
+    template_index.clear()
                 
     return imported_count
 
@@ -1,6 +1,7 @@
 """
 Scheduling Service
 """
+import os
 import uuid
 import json
 from datetime import datetime, timedelta
@@ -10,6 +11,9 @@ from app.utils.logger import logger
 from app.models.schedule import ScheduledTask
 from app.services.sequence_service import SequenceService
 
+# Seconds after its due time a scheduled sequence may still start (0 = no limit)
+SCHEDULE_DEADLINE = float(os.getenv('REDRAT_SCHEDULE_DEADLINE', '300'))
+
 class SchedulingService:
     @staticmethod
     def schedule_task(task_type: str, target_id: str, schedule_type: str, 
@@ -121,8 +125,13 @@ class SchedulingService:
                     logger.info(f"Scheduled command {task.target_id} queued")
                     
                 elif task.type == 'sequence':
-                    # For a sequence, execute all its commands
-                    SequenceService.execute_sequence(task.target_id)
+                    # For a sequence, execute all its commands; a run that cannot
+                    # start close to its due time is expired by the queue
+                    deadline = None
+                    if SCHEDULE_DEADLINE > 0 and isinstance(task.next_run, datetime):
+                        deadline = task.next_run.timestamp() + SCHEDULE_DEADLINE
+                    SequenceService.execute_sequence(task.target_id, priority='scheduled', deadline=deadline,
+                                                     tenant=f"user:{task.created_by}" if task.created_by else None)
                     logger.info(f"Scheduled sequence {task.target_id} executed")
                 
                 # Update the next run time for recurring tasks
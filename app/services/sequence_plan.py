@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""Compiled sequence execution plans for the RedRat Proxy project.
+
+Running a sequence used to send every step as an independent command:
+device validation, template query, signal conversion and a status write
+per step. A SequencePlan resolves all of that once - templates come from
+the template index, signals are compiled to wire format (both sides of a
+double signal) and step delays are fixed - so executing a sequence is a
+series of MSG_ASYNC_OUTPUT round trips over one held session.
+
+Plans are cached per sequence and keyed by a fingerprint of the steps, so
+a sequence whose commands changed is recompiled even before its entry is
+invalidated; a plan built against an older template index generation is
+recompiled as well.
+
+Steps sharing a parallel_group with their neighbours form one stage: the
+steps of a stage are split into branches by RedRat device and IR ports,
+branches run concurrently and the next stage starts once all of them are
+done (a barrier). Consecutive steps without a group form a single-branch
+stage, i.e. run one after another.
+
+A plan fanned out over IR ports (fan_out) runs the sequence once per port
+on one device: each stage holds the stage's branches of every port, so all
+boxes go through the sequence side by side, sharing the compiled signals.
+
+SequenceTimer paces a plan: every step has an absolute deadline on the
+monotonic clock (the previous deadline plus the previous step's delay), so
+the time spent sending does not accumulate into the spacing of later
+steps, and the achieved timing of each step is recorded.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .signal_cache import CompiledSignal
+
+
+class PlanStep:
+    """One step of a sequence with its signal ready to send."""
+
+    __slots__ = ('command', 'remote_id', 'ports', 'power', 'delay_ms', 'group', 'device_id',
+                 'compiled', 'double_signal', 'error')
+
+    def __init__(self, command: str, remote_id: int, ports: List[int], power: int, delay_ms: int,
+                 group: int = None, device_id: int = None, compiled: Optional[CompiledSignal] = None,
+                 double_signal: Optional[Tuple[Optional[CompiledSignal], Optional[CompiledSignal]]] = None,
+                 error: str = None):
+        self.command = command
+        self.remote_id = remote_id
+        self.ports = ports
+        self.power = power
+        self.delay_ms = delay_ms
+        self.group = group  # parallel_group; None = runs after the previous step
+        self.device_id = device_id  # RedRat device; None = the device running the sequence
+        self.compiled = compiled  # Signal of a plain command
+        self.double_signal = double_signal  # (signal1, signal2) of a double signal, alternated per device
+        self.error = error  # Why the step cannot be sent (e.g. unknown command)
+
+
+class SequencePlan:
+    """Steps of a sequence compiled for execution."""
+
+    __slots__ = ('sequence_id', 'fingerprint', 'generation', 'steps', 'stages')
+
+    def __init__(self, sequence_id: Any, fingerprint: str, generation: int, steps: List[PlanStep],
+                 stages: List[List[List[int]]] = None):
+        self.sequence_id = sequence_id
+        self.fingerprint = fingerprint
+        self.generation = generation  # Template index generation the plan was compiled against
+        self.steps = steps
+        self.stages = stages if stages is not None else build_stages(steps)
+
+    @property
+    def ports(self) -> List[int]:
+        """All IR ports the plan sends on."""
+        return sorted({port for step in self.steps for port in step.ports})
+
+
+def build_stages(steps: List[PlanStep]) -> List[List[List[int]]]:
+    """Split plan steps into stages of concurrent branches.
+    
+    Returns:
+        Stages in order; each is a list of branches, each branch a list of
+        step indices sent one after another on one device
+    """
+    stages = []
+    current = None  # (group, Key: (device_id, ports), Value: branch) of the last stage
+    for index, step in enumerate(steps):
+        if step.group is None:
+            # Ungrouped steps run in order; a device change starts a new stage
+            if current and current[0] is None and (step.device_id, None) in current[1]:
+                current[1][(step.device_id, None)].append(index)
+                continue
+            current = (None, {(step.device_id, None): [index]})
+        elif current and current[0] == step.group:
+            current[1].setdefault((step.device_id, tuple(step.ports)), []).append(index)
+            continue
+        else:
+            current = (step.group, {(step.device_id, tuple(step.ports)): [index]})
+        stages.append(current[1])
+    return [list(branches.values()) for branches in stages]
+
+
+def fan_out(plan: SequencePlan, ports: List[int]) -> SequencePlan:
+    """Run a plan once per IR port of the device executing it.
+    
+    Steps are copied per port (port-major: the steps of ports[0] first)
+    with their ports and RedRat device replaced by the target; compiled
+    signals are shared. Stage k of the result holds stage k of every port.
+    
+    Args:
+        plan: Compiled plan of the sequence
+        ports: Target IR ports, each running the whole sequence
+    
+    Returns:
+        SequencePlan with len(ports) * len(plan.steps) steps
+    """
+    count = len(plan.steps)
+    steps = [PlanStep(step.command, step.remote_id, [port], step.power, step.delay_ms, group=step.group,
+                      compiled=step.compiled, double_signal=step.double_signal, error=step.error)
+             for port in ports for step in plan.steps]
+    stages = [[[target * count + index for index in branch] for target in range(len(ports)) for branch in stage]
+              for stage in plan.stages]
+    return SequencePlan(plan.sequence_id, plan.fingerprint, plan.generation, steps, stages)
+
+
+def plan_fingerprint(commands: List[Dict[str, Any]]) -> str:
+    """Hash the fields of sequence steps that affect execution."""
+    steps = [(cmd.get('remote_id'), cmd.get('command'), cmd.get('ir_port', 1), cmd.get('power', 50),
+              cmd.get('delay_ms', 0), cmd.get('parallel_group'), cmd.get('redrat_device_id')) for cmd in commands]
+    return hashlib.sha1(json.dumps(steps, default=str).encode('utf-8')).hexdigest()
+
+
+class SequenceTimer:
+    """Absolute-deadline pacing of plan steps with per-step jitter records.
+    
+    A step is issued ahead of its deadline by the device's measured one-way
+    latency, so its signal starts on the deadline. A step that starts more
+    than resync_ms late (e.g. after a reconnect) moves the schedule instead
+    of letting later steps catch up, which would shorten their spacing.
+    """
+    
+    def __init__(self, lead: float = 0.0, resync_ms: float = 50.0, spin_ms: float = 2.0):
+        """
+        Args:
+            lead: Seconds a step is issued before its deadline (one-way send latency)
+            resync_ms: Lateness after which the schedule is moved
+            spin_ms: Final part of a wait spent yielding instead of sleeping
+        """
+        self.lead = lead
+        self.resync = resync_ms / 1000.0
+        self.spin = spin_ms / 1000.0
+        self.started_at = None
+        self.deadline = None
+        self.resyncs = 0
+        self.planned = 0.0  # Sum of the delays of recorded steps
+        self.steps = []
+    
+    def begin(self, start: float = None):
+        """Start the schedule: the first step is due now (or at start, for timers run together)."""
+        self.started_at = self.deadline = start if start is not None else time.monotonic()
+    
+    def wait(self):
+        """Sleep until the current step should be issued."""
+        _sleep_until(self.deadline - self.lead, self.spin)
+    
+    def sent(self, step: PlanStep, started_at: float, rtt: float):
+        """Record a sent step and schedule the next one.
+        
+        Args:
+            step: The step that was sent
+            started_at: Monotonic time its signal is estimated to have started
+            rtt: Measured request/acknowledge round trip in seconds
+        """
+        jitter = started_at - self.deadline
+        self.steps.append({
+            'command': step.command,
+            'target_ms': round((self.deadline - self.started_at) * 1000, 3),
+            'actual_ms': round((started_at - self.started_at) * 1000, 3),
+            'jitter_ms': round(jitter * 1000, 3),
+            'rtt_ms': round(rtt * 1000, 3)
+        })
+        if jitter > self.resync:
+            self.resyncs += 1
+            self.deadline = started_at
+        self.deadline += step.delay_ms / 1000.0
+        self.planned += step.delay_ms / 1000.0
+    
+    def skipped(self, step: PlanStep, error: str):
+        """Record a step that was not sent; later steps keep their deadlines."""
+        self.steps.append({
+            'command': step.command,
+            'target_ms': round((self.deadline - self.started_at) * 1000, 3),
+            'error': error
+        })
+        self.deadline += step.delay_ms / 1000.0
+        self.planned += step.delay_ms / 1000.0
+    
+    def finish(self):
+        """Wait out the delay of the last step."""
+        _sleep_until(self.deadline, self.spin)
+    
+    def report(self) -> Dict[str, Any]:
+        """Achieved timing: per-step records and jitter summary in milliseconds."""
+        jitters = [abs(step['jitter_ms']) for step in self.steps if 'jitter_ms' in step]
+        return {
+            'planned_ms': round(self.planned * 1000, 3),
+            'elapsed_ms': round((time.monotonic() - self.started_at) * 1000, 3) if self.started_at else 0.0,
+            'span_ms': round((self.deadline - self.started_at) * 1000, 3) if self.started_at else 0.0,
+            'jitter_avg_ms': round(sum(jitters) / len(jitters), 3) if jitters else 0.0,
+            'jitter_max_ms': max(jitters) if jitters else 0.0,
+            'resyncs': self.resyncs,
+            'steps': self.steps
+        }
+
+
+def _sleep_until(deadline: float, spin: float):
+    """Sleep until a monotonic deadline, yielding for the last spin seconds for precision."""
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(remaining - spin if remaining > spin else 0)
+
+
+class SequencePlanCache:
+    """LRU cache of compiled plans keyed by sequence ID (int or str IDs match)."""
+
+    def __init__(self, max_entries: int = 128):
+        """
+        Args:
+            max_entries: Maximum number of sequences with a cached plan
+        """
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()  # Key: sequence ID, Value: SequencePlan
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0
+        }
+
+    def get(self, sequence_id: Any, fingerprint: str, generation: int) -> Optional[SequencePlan]:
+        """Get the plan of a sequence if it matches its steps and the template index."""
+        with self._lock:
+            plan = self._plans.get(str(sequence_id))
+            if plan is None or plan.fingerprint != fingerprint or plan.generation != generation:
+                self._stats['misses'] += 1
+                return None
+            self._plans.move_to_end(str(sequence_id))
+            self._stats['hits'] += 1
+            return plan
+
+    def put(self, plan: SequencePlan):
+        """Store a plan, replacing an older one of the same sequence."""
+        with self._lock:
+            self._plans[str(plan.sequence_id)] = plan
+            self._plans.move_to_end(str(plan.sequence_id))
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, sequence_id: Any):
+        """Drop the plan of a sequence whose commands changed or that was deleted."""
+        with self._lock:
+            if self._plans.pop(str(sequence_id), None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        """Drop all plans."""
+        with self._lock:
+            self._stats['invalidations'] += len(self._plans)
+            self._plans.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get cache counters and size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._plans)
+        return stats
+
+
+# Global cache shared by all RedRat services in this process
+sequence_plan_cache = SequencePlanCache(
+    max_entries=int(os.getenv('REDRAT_PLAN_CACHE_SIZE', '128'))
+)
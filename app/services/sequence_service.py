@@ -64,7 +64,7 @@ class SequenceService:
             # Get sequence commands - no join needed, data is in sequence_commands table
             cursor.execute("""
                 SELECT sc.id, sc.command, sc.device, sc.remote_id, sc.position, 
-                       sc.delay_ms, sc.ir_port, sc.power
+                       sc.delay_ms, sc.ir_port, sc.power, sc.parallel_group, sc.redrat_device_id
                 FROM sequence_commands sc
                 WHERE sc.sequence_id = %s
                 ORDER BY sc.position
@@ -81,7 +81,9 @@ class SequenceService:
                     'position': row['position'],
                     'delay_ms': row['delay_ms'],
                     'ir_port': row['ir_port'],
-                    'power': row['power']
+                    'power': row['power'],
+                    'parallel_group': row['parallel_group'],
+                    'redrat_device_id': row['redrat_device_id']
                 })
                 
         return sequence
@@ -147,6 +149,9 @@ class SequenceService:
                 VALUES (%s, %s, %s, %s, %s, %s)
             """, (command_uuid, sequence_id, command_id, position, delay_ms, now))
             conn.commit()
+        
+        from app.services.sequence_plan import sequence_plan_cache
+        sequence_plan_cache.invalidate(sequence_id)
             
         logger.info(f"Command {command_id} added to sequence {sequence_id} at position {position}")
         return {
@@ -189,13 +194,24 @@ class SequenceService:
             """, (sequence_id, position))
             
             conn.commit()
+        
+        from app.services.sequence_plan import sequence_plan_cache
+        sequence_plan_cache.invalidate(sequence_id)
             
         logger.info(f"Command {seq_command_id} removed from sequence {sequence_id}")
         return True
     
     @staticmethod
-    def execute_sequence(sequence_id: str) -> bool:
-        """Execute a command sequence by adding it to the command queue"""
+    def execute_sequence(sequence_id: str, priority: str = 'interactive', deadline: float = None,
+                         tenant: str = None) -> bool:
+        """Execute a command sequence by adding it to the command queue
+        
+        Args:
+            sequence_id: ID of the sequence
+            priority: Queue priority class (interactive, scheduled or bulk)
+            deadline: Epoch seconds after which the queued sequence is expired instead of run
+            tenant: Fair-queueing tenant the sequence is queued for (e.g. 'user:<id>')
+        """
         sequence = SequenceService.get_sequence(sequence_id)
         if not sequence:
             raise ValueError(f"Sequence {sequence_id} not found")
@@ -208,7 +224,10 @@ class SequenceService:
             sequence_data = {
                 'id': sequence_id,
                 'name': sequence['name'],
-                'commands': sequence['commands']
+                'commands': sequence['commands'],
+                'priority': priority,
+                'deadline': deadline,
+                'tenant': tenant
             }
             
             result = add_sequence(sequence_data)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""Compiled IR signal cache for the RedRat Proxy project.
+
+Turning a command template into IRNetBox wire format means decoding the
+hex/base64 signal data, converting lengths and pauses to 2MHz timer counts
+and packing the download structure. This module keeps the finished
+download_signal bytes per command template, one variant per toggle state,
+so sending a known command is a dictionary lookup plus the async output
+header.
+
+Entries are keyed by (template_id, content_hash), so an edited template is
+never served from a stale entry even before it is invalidated.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from .irnetbox_lib_new import IRSignal, apply_toggle_state, encode_signal
+
+
+class CompiledSignal:
+    """Wire-format download data for one command template."""
+
+    __slots__ = ('template_id', 'content_hash', 'signal', 'variants')
+
+    def __init__(self, template_id: int, content_hash: str, signal: IRSignal, variants: Tuple[bytes, ...]):
+        self.template_id = template_id
+        self.content_hash = content_hash
+        self.signal = signal
+        self.variants = variants  # One per toggle state (len1, len2), or a single entry
+
+    @property
+    def has_toggle(self) -> bool:
+        return len(self.variants) > 1
+
+
+def signal_content_hash(template_data: Any) -> str:
+    """Hash raw template data as stored in command_templates.template_data."""
+    if isinstance(template_data, (dict, list)):
+        template_data = json.dumps(template_data, sort_keys=True)
+    if isinstance(template_data, str):
+        template_data = template_data.encode('utf-8')
+    return hashlib.sha1(template_data or b'').hexdigest()
+
+
+def compile_signal(template_id: int, content_hash: str, signal: IRSignal) -> CompiledSignal:
+    """Encode a signal in download format for each of its toggle states."""
+    if not signal.toggle_data:
+        return CompiledSignal(template_id, content_hash, signal, (encode_signal(signal),))
+
+    toggle_states = {}
+    variants = tuple(encode_signal(signal, apply_toggle_state(signal, toggle_states)) for _ in range(2))
+    return CompiledSignal(template_id, content_hash, signal, variants)
+
+
+class CompiledSignalCache:
+    """LRU cache of compiled signals, plus per-device toggle state."""
+
+    def __init__(self, max_entries: int = 512):
+        """
+        Args:
+            max_entries: Maximum number of compiled templates kept
+        """
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Key: (template_id, content_hash), Value: CompiledSignal
+        self._toggle_index = {}  # Key: (device_key, template_id), Value: next variant index
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0
+        }
+
+    def get(self, template_id: int, content_hash: str) -> Optional[CompiledSignal]:
+        """Get a compiled signal, marking it most recently used."""
+        key = (template_id, content_hash)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return compiled
+
+    def put(self, compiled: CompiledSignal):
+        """Store a compiled signal, replacing older content of the same template."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == compiled.template_id]:
+                del self._entries[key]
+            self._entries[(compiled.template_id, compiled.content_hash)] = compiled
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def next_variant(self, compiled: CompiledSignal, device_key: Any) -> bytes:
+        """Get the download bytes for the next toggle state on a device and advance it."""
+        if not compiled.has_toggle:
+            return compiled.variants[0]
+        key = (device_key, compiled.template_id)
+        with self._lock:
+            index = self._toggle_index.get(key, 0)
+            self._toggle_index[key] = (index + 1) % len(compiled.variants)
+        return compiled.variants[index]
+
+    def invalidate(self, template_id: int):
+        """Drop the compiled signal and toggle state of a template (updated or deleted)."""
+        with self._lock:
+            keys = [k for k in self._entries if k[0] == template_id]
+            for key in keys:
+                del self._entries[key]
+            for key in [k for k in self._toggle_index if k[1] == template_id]:
+                del self._toggle_index[key]
+            self._stats['invalidations'] += len(keys)
+
+    def clear(self):
+        """Drop all compiled signals and toggle state."""
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+            self._toggle_index.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        """Get cache counters and size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
+
+
+# Global cache shared by all RedRat services in this process
+compiled_signal_cache = CompiledSignalCache(
+    max_entries=int(os.getenv('REDRAT_SIGNAL_CACHE_SIZE', '512'))
+)
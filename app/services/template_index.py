@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""Command template index for the RedRat Proxy project.
+
+Keeps command_templates in memory, keyed by (remote_id, command name), so
+the send path finds the template of a command - including the signal1 /
+signal2 pair of an IRNetBox double signal - with a dictionary lookup
+instead of two queries and a JSON parse per press.
+
+The index is loaded on first use and kept in sync by the code that imports,
+updates or deletes templates. Other processes sharing the database (the
+device gateway, other dispatchers) pick up their changes through a periodic
+reload after max_age seconds, and a lookup miss triggers a rate-limited
+reload so a newly created template is usable at once.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .signal_cache import signal_content_hash
+
+try:
+    from app.utils.logger import logger
+except ImportError:
+    logger = logging.getLogger("redrat_templates")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+
+DOUBLE_SIGNAL_SUFFIXES = ('_signal1', '_signal2')
+
+
+class TemplateEntry:
+    """One command template with its template_data parsed."""
+
+    __slots__ = ('id', 'remote_id', 'name', 'raw_data', 'data', 'content_hash')
+
+    def __init__(self, template_id: int, remote_id: int, name: str, raw_data: Any):
+        self.id = template_id
+        self.remote_id = remote_id
+        self.name = name
+        self.raw_data = raw_data
+        self.data = _parse(raw_data)
+        self.content_hash = signal_content_hash(raw_data)
+
+
+def _parse(raw_data: Any) -> Optional[Dict[str, Any]]:
+    """Parse a template_data column value (bytes, str or dict)."""
+    try:
+        if isinstance(raw_data, (bytes, bytearray)):
+            raw_data = raw_data.decode('utf-8')
+        if isinstance(raw_data, str):
+            return json.loads(raw_data)
+        return raw_data
+    except Exception as e:
+        logger.warning(f"Unparseable template data: {e}")
+        return None
+
+
+def _base_name(name: str) -> Optional[str]:
+    """Base command of a double-signal template name, or None."""
+    for suffix in DOUBLE_SIGNAL_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+class TemplateIndex:
+    """In-memory command_templates keyed by (remote_id, command name)."""
+
+    def __init__(self, max_age: float = 60.0, miss_refresh_interval: float = 5.0):
+        """
+        Args:
+            max_age: Seconds after which the next lookup reloads the table
+                (0 disables periodic reloads)
+            miss_refresh_interval: Minimum seconds between reloads triggered by
+                a lookup for a command that is not indexed
+        """
+        self.max_age = max_age
+        self.miss_refresh_interval = miss_refresh_interval
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._templates = {}  # Key: template id, Value: TemplateEntry
+        self._names = {}  # Key: (remote_id, name), Value: TemplateEntry
+        self._pairs = {}  # Key: (remote_id, base command), Value: (signal1 entry or None, signal2 entry or None)
+        self._loaded_at = 0.0
+        self.generation = 0  # Bumped on every change, so dependent caches can tell they are stale
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'reloads': 0
+        }
+
+    def lookup(self, remote_id: int, command_name: str) -> Tuple[Optional[TemplateEntry], Optional[Tuple]]:
+        """Find the templates of a command.
+
+        Args:
+            remote_id: Database ID of the remote (command_templates.file_id)
+            command_name: Command name as used in commands/sequences
+
+        Returns:
+            (exact template, double-signal pair); the pair is a (signal1,
+            signal2) tuple where one side may be None, or None for a plain
+            command. Both are None if the command is unknown.
+        """
+        self._ensure_fresh()
+        key = (int(remote_id), command_name)
+        with self._lock:
+            entry, pair = self._names.get(key), self._pairs.get(key)
+        if entry is None and pair is None and self._reload_on_miss():
+            with self._lock:
+                entry, pair = self._names.get(key), self._pairs.get(key)
+
+        with self._lock:
+            self._stats['hits' if entry or pair else 'misses'] += 1
+        return entry, pair
+
+    def load(self) -> int:
+        """Reload the whole table.
+
+        Returns:
+            Number of templates indexed
+        """
+        with self._load_lock:
+            rows = self._query("SELECT id, file_id, name, template_data FROM command_templates")
+            entries = [TemplateEntry(row[0], row[1], row[2], row[3]) for row in rows if row[1] is not None]
+            with self._lock:
+                previous = {e.id: (e.remote_id, e.name, e.content_hash) for e in self._templates.values()}
+                self._templates = {}
+                self._names = {}
+                self._pairs = {}
+                for entry in entries:
+                    self._add(entry)
+                if previous != {e.id: (e.remote_id, e.name, e.content_hash) for e in entries}:
+                    self.generation += 1
+                self._loaded_at = time.monotonic()
+                self._stats['reloads'] += 1
+            logger.debug(f"Template index loaded: {len(entries)} templates")
+            return len(entries)
+
+    def reload_template(self, template_id: int):
+        """Re-read one template after it was created or updated."""
+        if not self._loaded_at:
+            return  # Loaded in full on first use
+        rows = self._query("SELECT id, file_id, name, template_data FROM command_templates WHERE id = %s",
+                           (int(template_id),))
+        with self._lock:
+            self._remove(int(template_id))
+            for row in rows:
+                if row[1] is not None:
+                    self._add(TemplateEntry(row[0], row[1], row[2], row[3]))
+            self.generation += 1
+
+    def remove_template(self, template_id: int):
+        """Forget a deleted template."""
+        with self._lock:
+            self._remove(int(template_id))
+            self.generation += 1
+
+    def clear(self):
+        """Drop the index; the next lookup reloads it."""
+        with self._lock:
+            self._templates.clear()
+            self._names.clear()
+            self._pairs.clear()
+            self._loaded_at = 0.0
+            self.generation += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get lookup counters, size and age."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['templates'] = len(self._templates)
+            stats['double_signals'] = len(self._pairs)
+            stats['age'] = round(time.monotonic() - self._loaded_at, 3) if self._loaded_at else None
+        return stats
+
+    def _add(self, entry: TemplateEntry):
+        """Index an entry (caller holds _lock)."""
+        self._templates[entry.id] = entry
+        self._names[(entry.remote_id, entry.name)] = entry
+        base = _base_name(entry.name)
+        if base is not None:
+            key = (entry.remote_id, base)
+            signal1, signal2 = self._pairs.get(key, (None, None))
+            if entry.name.endswith('_signal1'):
+                signal1 = entry
+            else:
+                signal2 = entry
+            self._pairs[key] = (signal1, signal2)
+
+    def _remove(self, template_id: int):
+        """Remove an entry from every key (caller holds _lock)."""
+        entry = self._templates.pop(template_id, None)
+        if entry is None:
+            return
+        if self._names.get((entry.remote_id, entry.name)) is entry:
+            del self._names[(entry.remote_id, entry.name)]
+        base = _base_name(entry.name)
+        if base is not None:
+            key = (entry.remote_id, base)
+            pair = tuple(None if side is entry else side for side in self._pairs.get(key, (None, None)))
+            if any(pair):
+                self._pairs[key] = pair
+            else:
+                self._pairs.pop(key, None)
+
+    def _ensure_fresh(self):
+        """Load on first use and reload once max_age has passed."""
+        age = time.monotonic() - self._loaded_at
+        if self._loaded_at and (not self.max_age or age < self.max_age):
+            return
+        try:
+            self.load()
+        except Exception as e:
+            logger.error(f"Error loading template index: {str(e)}")
+
+    def _reload_on_miss(self) -> bool:
+        """Reload after a lookup miss, at most once per miss_refresh_interval.
+
+        Returns:
+            True if the index was reloaded
+        """
+        if time.monotonic() - self._loaded_at < self.miss_refresh_interval:
+            return False
+        try:
+            self.load()
+            return True
+        except Exception as e:
+            logger.error(f"Error reloading template index: {str(e)}")
+            return False
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        """Run a query against command_templates."""
+        from app.mysql_db import db
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+
+
+# Global index shared by all RedRat services in this process
+template_index = TemplateIndex(
+    max_age=float(os.getenv('REDRAT_TEMPLATE_INDEX_MAX_AGE', '60'))
+)
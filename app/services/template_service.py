@@ -96,6 +96,10 @@ class TemplateService:
                 WHERE id = %s
             """, (template_id,))
             conn.commit()
-            
+        
+        from app.services.signal_cache import compiled_signal_cache
+        from app.services.template_index import template_index
+        compiled_signal_cache.invalidate(int(template_id))
+        template_index.remove_template(int(template_id))
         logger.info(f"Template {template_id} deleted")
         return True
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+IRNetBox codec benchmark
+Compares the preallocated struct codec in app/services/irnetbox_lib_new.py
+with the original bytes-concatenation builder on typical signals, and checks
+that both produce identical wire bytes.
+
+Usage: python benchmark_irnetbox_codec.py [--number N]
+"""
+
+import argparse
+import os
+import random
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(__file__)), 'app', 'services'))
+
+from irnetbox_lib_new import (  # noqa: E402
+    IRNetBox, IRSignal, OutputConfig, PowerLevel, POWER_PERCENTAGES,
+    encode_signal, encode_async_output_message,
+)
+
+
+def legacy_encode_signal(signal, max_lengths=16, max_data_size=512):
+    """Download format as built before the preallocated codec."""
+    sig_data = signal.sig_data
+    timer_value = int(65536 - (6000000.0 / signal.modulation_freq))
+    length_values = []
+    for length_ms in signal.lengths:
+        length_values.append(int((length_ms / 1000.0) * 2000000))
+    while len(length_values) < max_lengths:
+        length_values.append(0)
+    pause_count = int((signal.intra_sig_pause / 1000.0) * 2000000)
+
+    signal_data = struct.pack('>I', pause_count)
+    signal_data += struct.pack('>H', timer_value)
+    signal_data += struct.pack('>H', 0)
+    signal_data += struct.pack('B', max_lengths)
+    signal_data += struct.pack('B', len(signal.lengths))
+    signal_data += struct.pack('>H', max_data_size)
+    signal_data += struct.pack('>H', len(sig_data))
+    signal_data += struct.pack('B', signal.no_repeats)
+    for length_val in length_values:
+        signal_data += struct.pack('>H', min(length_val, 65535))
+    return signal_data + sig_data
+
+
+def legacy_encode_async_output_message(sequence_number, post_delay_ms, output_configs, signal_binary):
+    """Framed MSG_ASYNC_OUTPUT as built before the preallocated codec."""
+    async_data = struct.pack('<H', sequence_number)
+    async_data += struct.pack('<H', post_delay_ms)
+    power_levels = [0] * 16
+    for config in output_configs:
+        if 1 <= config.port <= 16:
+            power_levels[config.port - 1] = POWER_PERCENTAGES.get(config.power_level, 0)
+    async_data += struct.pack('16B', *power_levels)
+    async_data += signal_binary
+    return struct.pack('>cHB', b'#', len(async_data), IRNetBox.MSG_ASYNC_OUTPUT) + async_data
+
+
+def make_signals(count=50, seed=1):
+    """Generate signals shaped like typical remote keys (6-16 lengths, 70-200 data bytes)."""
+    rng = random.Random(seed)
+    signals = []
+    for i in range(count):
+        n_lengths = rng.randint(6, 16)
+        signals.append(IRSignal(
+            name=f"KEY_{i}",
+            uid=str(i),
+            modulation_freq=rng.choice([36000, 38000, 40000, 56000]),
+            lengths=[round(rng.uniform(0.2, 9.0), 3) for _ in range(n_lengths)],
+            sig_data=bytes(rng.randrange(n_lengths) for _ in range(rng.randint(70, 200))),
+            no_repeats=rng.randint(0, 3),
+            intra_sig_pause=round(rng.uniform(20.0, 110.0), 3)
+        ))
+    return signals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the IRNetBox codec')
+    parser.add_argument('--number', type=int, default=2000, help='Passes over the signal set per timing')
+    args = parser.parse_args()
+
+    signals = make_signals()
+    outputs = [OutputConfig(port=p, power_level=PowerLevel.HIGH if p % 2 else PowerLevel.MEDIUM)
+               for p in range(1, 5)]
+
+    # Both codecs must produce the same bytes on the wire
+    for seq, signal in enumerate(signals, start=1):
+        binary = encode_signal(signal)
+        assert binary == legacy_encode_signal(signal), f"download mismatch for {signal.name}"
+        assert (bytes(encode_async_output_message(seq, 100, outputs, binary))
+                == legacy_encode_async_output_message(seq, 100, outputs, binary)), \
+            f"async output mismatch for {signal.name}"
+    print(f"Verified identical output for {len(signals)} signals")
+
+    binaries = [encode_signal(s) for s in signals]
+    cases = [
+        ('download_signal', lambda: [legacy_encode_signal(s) for s in signals],
+         lambda: [encode_signal(s) for s in signals]),
+        ('async_output', lambda: [legacy_encode_async_output_message(1, 100, outputs, b) for b in binaries],
+         lambda: [encode_async_output_message(1, 100, outputs, b) for b in binaries]),
+    ]
+
+    print(f"{'message':<16} {'legacy us':>10} {'codec us':>10} {'speedup':>8}")
+    for name, legacy, codec in cases:
+        legacy_time = min(timeit.repeat(legacy, number=args.number, repeat=3))
+        codec_time = min(timeit.repeat(codec, number=args.number, repeat=3))
+        per_call = args.number * len(signals) / 1e6
+        print(f"{name:<16} {legacy_time / per_call:>10.2f} {codec_time / per_call:>10.2f} "
+              f"{legacy_time / codec_time:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+RedRat device gateway
+Runs the command queue, device lanes and all IRNetBox connections in one
+process. Start the web app with REDRAT_GATEWAY_ADDRESS set to the same
+address so its workers hand their commands to this process.
+
+Usage: python gateway.py [--address unix:/tmp/redrat-gateway.sock | host:port]
+"""
+
+import argparse
+import os
+import signal
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables first
+load_dotenv()
+
+# This process executes the work instead of forwarding it to a gateway
+os.environ['REDRAT_GATEWAY_ROLE'] = 'server'
+
+# Add the current directory to Python path
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from app.services.command_queue import command_queue_instance  # noqa: E402
+from app.services.device_gateway import GatewayServer  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the RedRat device gateway')
+    parser.add_argument('--address', default=os.getenv('REDRAT_GATEWAY_ADDRESS', 'unix:/tmp/redrat-gateway.sock'),
+                        help='Listen address: unix:/path or host:port')
+    args = parser.parse_args()
+
+    server = GatewayServer(command_queue_instance, args.address)
+
+    def stop(signum, frame):
+        server.shutdown()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"🚀 Starting RedRat device gateway on {args.address}")
+    server.serve_forever()
+    command_queue_instance.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -57,7 +57,8 @@ CREATE TABLE commands (
     device VARCHAR(255),
     ir_port INT DEFAULT 1,
     power INT DEFAULT 50,
-    status ENUM('pending', 'executed', 'failed') NOT NULL DEFAULT 'pending',
+    port_power JSON NULL,
+    status ENUM('pending', 'executed', 'failed', 'expired') NOT NULL DEFAULT 'pending',
     created_by INT NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     executed_at TIMESTAMP NULL,
@@ -66,6 +67,32 @@ CREATE TABLE commands (
     FOREIGN KEY (created_by) REFERENCES users(id) ON DELETE CASCADE
 );
 
+-- Durable command queue (used when REDRAT_QUEUE_BACKEND=mysql)
+CREATE TABLE command_queue (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    item_type ENUM('command', 'sequence') NOT NULL DEFAULT 'command',
+    payload JSON NOT NULL,
+    redrat_device_id INT NULL,
+    priority TINYINT NOT NULL DEFAULT 0,
+    deadline DATETIME(3) NULL,
+    status ENUM('queued', 'claimed', 'done', 'failed', 'expired') NOT NULL DEFAULT 'queued',
+    attempts INT NOT NULL DEFAULT 0,
+    claimed_by VARCHAR(255) NULL,
+    lease_expires_at DATETIME(3) NULL,
+    last_error TEXT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    completed_at DATETIME(3) NULL,
+    INDEX idx_command_queue_claim (status, priority, deadline),
+    INDEX idx_command_queue_completed (status, completed_at)
+);
+
+-- Dispatcher lease - the one process claiming command_queue rows at a time
+CREATE TABLE command_queue_dispatcher (
+    id TINYINT PRIMARY KEY,
+    claimed_by VARCHAR(255) NOT NULL,
+    lease_expires_at DATETIME(3) NOT NULL
+);
+
 -- Sequences table - command sequences/macros
 CREATE TABLE sequences (
     id INT AUTO_INCREMENT PRIMARY KEY,
@@ -93,6 +120,8 @@ CREATE TABLE sequence_commands (
     power INT DEFAULT 50,
     position INT NOT NULL,
     delay_ms INT NOT NULL DEFAULT 0,
+    parallel_group INT NULL,
+    redrat_device_id INT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (sequence_id) REFERENCES sequences(id) ON DELETE CASCADE,
     FOREIGN KEY (remote_id) REFERENCES remotes(id) ON DELETE CASCADE
@@ -154,6 +183,8 @@ CREATE TABLE redrat_devices (
     last_status ENUM('online', 'offline', 'error') DEFAULT 'offline',
     device_model INT NULL,
     device_ports INT NULL,
+    firmware_version VARCHAR(64) NULL,
+    serial_number VARCHAR(64) NULL,
     port_descriptions JSON NULL,
     created_by INT NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -203,5 +234,13 @@ CREATE INDEX idx_redrat_devices_status ON redrat_devices(last_status);
 CREATE INDEX idx_schedules_next_run ON schedules(next_run);
 CREATE INDEX idx_schedules_status ON schedules(status);
 
+-- Upgrade existing installs (errors for already-present columns are ignored by init_db)
+ALTER TABLE redrat_devices ADD COLUMN firmware_version VARCHAR(64) NULL AFTER device_ports;
+ALTER TABLE redrat_devices ADD COLUMN serial_number VARCHAR(64) NULL AFTER firmware_version;
+ALTER TABLE commands ADD COLUMN port_power JSON NULL AFTER power;
+ALTER TABLE commands MODIFY COLUMN status ENUM('pending', 'executed', 'failed', 'expired') NOT NULL DEFAULT 'pending';
+ALTER TABLE sequence_commands ADD COLUMN parallel_group INT NULL AFTER delay_ms;
+ALTER TABLE sequence_commands ADD COLUMN redrat_device_id INT NULL AFTER parallel_group;
+
 -- Set default charset and collation
 ALTER DATABASE redrat_proxy CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;